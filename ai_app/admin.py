@@ -1,8 +1,13 @@
 from django.contrib import admin
-from .models import ModelInfo, UploadedFile
+from .models import ModelInfo, UploadedFile, MemoryProfileSample, UpstreamUsage, ApiCredential, AsyncJob
+from . import keypool
+from .media import file_response
+from .retention import delete_uploaded_files, format_bytes
+from .exports import stream_csv
 from constance.admin import ConstanceAdmin, Config, ConstanceForm
 from django.utils.translation import gettext_lazy as _
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
 from django.urls import reverse, path
 from django.http import HttpResponse, HttpResponseRedirect
 import os
@@ -11,9 +16,12 @@ from django.shortcuts import render
 from django.contrib.auth.admin import UserAdmin
 import csv
 from datetime import datetime
-from django.db.models import Sum, F, Func
+from django.db.models import Count, Sum, F, Func
 from django.db.models.functions import Cast
 from django.db.models import IntegerField
+import json
+import time
+from collections import defaultdict
 
 # 自定义 Constance 的 Admin 配置
 class CustomConstanceAdmin(ConstanceAdmin):
@@ -111,6 +119,12 @@ class ModelInfoAdmin(admin.ModelAdmin):
         }),
         ('详细信息', {
             'fields': ('context', 'cost')
+        }),
+        ('图片预处理', {
+            'fields': ('image_max_pixels', 'image_format', 'image_quality')
+        }),
+        ('对冲请求', {
+            'fields': ('hedge_model',)
         })
     )
 
@@ -139,11 +153,16 @@ class UploadedFileAdmin(admin.ModelAdmin):
     list_display = ('file_name', 'file_type', 'file_size_display', 'mime_type', 'upload_time', 'uploader', 'file_preview', 'file_actions')
     list_filter = ('file_type', 'upload_time', 'uploader')
     search_fields = ('file_name', 'uploader__username')
-    readonly_fields = ('file_size', 'mime_type', 'upload_time', 'file_type')
+    readonly_fields = ('file_size', 'mime_type', 'upload_time', 'file_type', 'file_hash',
+                       'width', 'height', 'orientation', 'duration', 'page_count', 'metadata_extracted_at')
+    # 上传者一次联表查出，避免每行单独查用户
+    list_select_related = ('uploader',)
+    actions = ['delete_with_files', 'export_csv']
+    change_list_template = 'admin/uploaded_file_change_list.html'
     
     def get_queryset(self, request):
-        # 按文件类型分组排序
-        return super().get_queryset(request).order_by('file_type', '-upload_time')
+        # 按文件类型分组排序（对应 upload_type_time_idx 索引）
+        return super().get_queryset(request).order_by('file_type', '-upload_time', '-id')
     
     def file_size_display(self, obj):
         """格式化文件大小显示"""
@@ -157,6 +176,43 @@ class UploadedFileAdmin(admin.ModelAdmin):
     
     file_size_display.short_description = '文件大小'
 
+    @admin.action(description='批量删除（含文件）', permissions=['delete'])
+    def delete_with_files(self, request, queryset):
+        """按主键分批删除选中记录和存储里的文件，不像默认的删除动作那样先把所有对象读进内存"""
+        report = delete_uploaded_files(queryset, category='删除')
+        self.message_user(request, f"已删除 {report.items.get('删除', (0, 0))[0]} 个文件，释放 {format_bytes(report.total_bytes)}")
+
+    @admin.action(description='导出CSV')
+    def export_csv(self, request, queryset):
+        """流式导出选中记录（全选时是当前筛选结果）"""
+        return stream_csv(queryset, [
+            ('ID', 'id'), ('文件名', 'file_name'), ('文件类型', 'file_type'), ('文件大小(字节)', 'file_size'),
+            ('MIME类型', 'mime_type'), ('上传时间', 'upload_time'), ('上传者', 'uploader__username'),
+            ('文件路径', 'file'), ('SHA-256', 'file_hash'), ('宽度', 'width'), ('高度', 'height'),
+            ('时长(秒)', 'duration'), ('页数', 'page_count'),
+        ], f"uploaded_files_{datetime.now():%Y%m%d%H%M%S}.csv")
+
+    def storage_summary_view(self, request):
+        """存储占用汇总，全部在数据库里分组求和"""
+        queryset = UploadedFile.objects.all()
+        totals = queryset.aggregate(files=Count('id'), total=Sum('file_size'))
+        by_type = queryset.values('file_type').annotate(files=Count('id'), total=Sum('file_size')).order_by('-total')
+        by_uploader = (queryset.values('uploader_id', 'uploader__username')
+                       .annotate(files=Count('id'), total=Sum('file_size')).order_by('-total')[:100])
+        type_names = dict(UploadedFile.FILE_TYPES)
+        context = {
+            **self.admin_site.each_context(request),
+            'title': '存储占用汇总',
+            'opts': self.model._meta,
+            'total_files': totals['files'],
+            'total_size': format_bytes(totals['total'] or 0),
+            'by_type': [{'name': type_names.get(row['file_type'], row['file_type']), 'files': row['files'],
+                         'size': format_bytes(row['total'] or 0)} for row in by_type],
+            'by_uploader': [{'name': row['uploader__username'], 'files': row['files'],
+                             'size': format_bytes(row['total'] or 0)} for row in by_uploader],
+        }
+        return render(request, 'admin/storage_summary.html', context)
+
     def file_actions(self, obj):
         """文件操作按钮"""
         return format_html(
@@ -170,22 +226,32 @@ class UploadedFileAdmin(admin.ModelAdmin):
     file_actions.short_description = '操作'
 
     def file_preview(self, obj):
-        """文件预览"""
+        """文件预览：只加载缩略图，视频/音频点击后才加载原文件（由 file_admin.js 替换成播放器）"""
         if obj.file_type == 'image':
-            return format_html(
-                '<img src="{}" style="max-width:100px; max-height:100px"/>',
-                obj.file.url
-            )
+            if obj.thumbnail:
+                return format_html(
+                    '<img src="{}" loading="lazy" decoding="async" style="max-width:100px; max-height:100px"/>',
+                    obj.thumbnail.url
+                )
+            return format_html('<a href="{}" target="_blank">缩略图生成中，查看原图</a>', obj.file.url)
         elif obj.file_type == 'video':
+            if obj.thumbnail:
+                poster = format_html(
+                    '<img src="{}" loading="lazy" decoding="async" style="max-width:100px; max-height:100px"/>',
+                    obj.thumbnail.url
+                )
+            else:
+                poster = mark_safe('<span style="display:inline-block; width:100px; line-height:60px; '
+                                   'text-align:center; background:#333; color:#fff">视频</span>')
             return format_html(
-                '<video width="100" height="100" controls>'
-                '<source src="{}" type="{}">不支持预览</video>',
-                obj.file.url, obj.mime_type
+                '<div class="media-placeholder" data-kind="video" data-src="{}" data-type="{}" '
+                'title="点击播放" style="cursor:pointer; display:inline-block">{}<br>▶ 点击播放</div>',
+                obj.file.url, obj.mime_type, poster
             )
         elif obj.file_type == 'audio':
             return format_html(
-                '<audio controls style="width:200px">'
-                '<source src="{}" type="{}">不支持预览</audio>',
+                '<button type="button" class="button media-placeholder" data-kind="audio" '
+                'data-src="{}" data-type="{}">▶ 播放音频</button>',
                 obj.file.url, obj.mime_type
             )
         elif obj.file_type == 'document':
@@ -207,11 +273,7 @@ class UploadedFileAdmin(admin.ModelAdmin):
         try:
             uploaded_file = self.get_object(request, file_id)
             if uploaded_file:
-                # 删除物理文件
-                file_path = os.path.join(settings.MEDIA_ROOT, str(uploaded_file.file))
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                # 删除数据库记录
+                # 删除数据库记录，原文件和缩略图由 post_delete 信号删除
                 uploaded_file.delete()
                 return HttpResponse('文件删除成功')
             return HttpResponse('文件不存在', status=404)
@@ -219,17 +281,15 @@ class UploadedFileAdmin(admin.ModelAdmin):
             return HttpResponse(f'删除失败: {str(e)}', status=500)
 
     def download_file(self, request, file_id):
-        """下载文件"""
+        """下载文件（分块流式输出，支持断点续传）"""
         uploaded_file = self.get_object(request, file_id)
         if uploaded_file is None:
             return HttpResponse('文件不存在', status=404)
             
         file_path = os.path.join(settings.MEDIA_ROOT, str(uploaded_file.file))
         if os.path.exists(file_path):
-            with open(file_path, 'rb') as fh:
-                response = HttpResponse(fh.read(), content_type=uploaded_file.mime_type)
-                response['Content-Disposition'] = f'attachment; filename={uploaded_file.file_name}'
-                return response
+            return file_response(request, file_path, content_type=uploaded_file.mime_type,
+                                 filename=uploaded_file.file_name, as_attachment=True)
         return HttpResponse('文件不存在', status=404)
 
     def rename_file(self, request, file_id):
@@ -265,6 +325,11 @@ class UploadedFileAdmin(admin.ModelAdmin):
                 self.admin_site.admin_view(self.download_file),
                 name='uploaded-file-download',
             ),
+            path(
+                'storage/',
+                self.admin_site.admin_view(self.storage_summary_view),
+                name='uploaded-file-storage',
+            ),
         ]
         return custom_urls + urls
 
@@ -284,3 +349,199 @@ class UploadedFileAdmin(admin.ModelAdmin):
             kwargs["initial"] = request.user.id  # 设置默认值为当前用户
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
+
+
+# 内存分析采样（ai_app.profiling 写入，只读）
+@admin.register(MemoryProfileSample)
+class MemoryProfileSampleAdmin(admin.ModelAdmin):
+    """内存分析结果"""
+    list_display = ('endpoint', 'method', 'status_code', 'request_size_display', 'peak_display',
+                    'rss_growth_display', 'created_at')
+    # 汇总页默认和最多统计的采样条数（?limit=）
+    top_sites_limit = 200
+    top_sites_max_limit = 5000
+    list_filter = ('endpoint', 'created_at')
+    readonly_fields = ('endpoint', 'method', 'status_code', 'request_bytes', 'peak_bytes', 'allocated_bytes',
+                       'rss_bytes', 'rss_growth_bytes', 'peak_rss_bytes', 'created_at', 'top_sites_display')
+    exclude = ('top_sites',)
+    change_list_template = 'admin/memory_profile_change_list.html'
+
+    @staticmethod
+    def _size(value):
+        if value is None:
+            return '-'
+        return f"{value / (1024 * 1024):.2f} MB"
+
+    def request_size_display(self, obj):
+        return self._size(obj.request_bytes)
+    request_size_display.short_description = '请求体'
+
+    def peak_display(self, obj):
+        return self._size(obj.peak_bytes)
+    peak_display.short_description = '峰值分配'
+    peak_display.admin_order_field = 'peak_bytes'
+
+    def rss_growth_display(self, obj):
+        return self._size(obj.rss_growth_bytes)
+    rss_growth_display.short_description = 'RSS增长'
+
+    def top_sites_display(self, obj):
+        """分配最多的代码位置"""
+        rows = format_html_join(
+            '',
+            '<tr><td>{}</td><td>{}</td><td><pre style="margin:0">{}</pre></td></tr>',
+            ((self._size(site['size']), site['count'], '\n'.join(site['site']))
+             for site in json.loads(obj.top_sites or '[]'))
+        )
+        return format_html('<table><tr><th>大小</th><th>次数</th><th>调用栈</th></tr>{}</table>', rows)
+    top_sites_display.short_description = '分配最多的位置'
+
+    actions = ['export_csv']
+
+    @admin.action(description='导出CSV')
+    def export_csv(self, request, queryset):
+        return stream_csv(queryset, [
+            ('接口', 'endpoint'), ('请求方法', 'method'), ('状态码', 'status_code'), ('请求体(字节)', 'request_bytes'),
+            ('峰值分配(字节)', 'peak_bytes'), ('最高点已分配(字节)', 'allocated_bytes'), ('RSS(字节)', 'rss_bytes'),
+            ('RSS增长(字节)', 'rss_growth_bytes'), ('采样时间', 'created_at'),
+        ], f"memory_profile_{datetime.now():%Y%m%d%H%M%S}.csv")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def top_sites_view(self, request):
+        """按接口汇总最近的采样，列出累计分配最多的代码位置"""
+        try:
+            limit = int(request.GET.get('limit', self.top_sites_limit))
+        except ValueError:
+            limit = self.top_sites_limit
+        limit = min(max(limit, 1), self.top_sites_max_limit)
+        endpoint = request.GET.get('endpoint')
+        queryset = MemoryProfileSample.objects.all()
+        if endpoint:
+            queryset = queryset.filter(endpoint=endpoint)
+
+        summary = defaultdict(lambda: {'samples': 0, 'peak_max': 0, 'peak_total': 0, 'sites': defaultdict(lambda: [0, 0])})
+        for sample in queryset.only('endpoint', 'peak_bytes', 'top_sites')[:limit]:
+            item = summary[sample.endpoint]
+            item['samples'] += 1
+            item['peak_max'] = max(item['peak_max'], sample.peak_bytes)
+            item['peak_total'] += sample.peak_bytes
+            for site in json.loads(sample.top_sites or '[]'):
+                # 以最内层帧作为分配位置，调用栈取第一次出现的
+                key = site['site'][0] if site['site'] else '?'
+                item['sites'][key][0] += site['size']
+                item['sites'][key][1] += 1
+
+        endpoints = []
+        for name, item in sorted(summary.items()):
+            sites = sorted(item['sites'].items(), key=lambda kv: kv[1][0], reverse=True)[:20]
+            endpoints.append({
+                'endpoint': name,
+                'samples': item['samples'],
+                'peak_max': self._size(item['peak_max']),
+                'peak_avg': self._size(item['peak_total'] // item['samples']),
+                'sites': [{'site': key, 'size': self._size(size // seen), 'seen': seen}
+                          for key, (size, seen) in sites],
+            })
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': '内存分配热点',
+            'opts': self.model._meta,
+            'endpoints': endpoints,
+        }
+        return render(request, 'admin/memory_profile_sites.html', context)
+
+    def get_urls(self):
+        urls = super().get_urls()
+        custom_urls = [
+            path('sites/', self.admin_site.admin_view(self.top_sites_view), name='memory-profile-sites'),
+        ]
+        return custom_urls + urls
+
+
+# 流式上游调用的用量（ai_app.cancellation 写入，只读）
+@admin.register(UpstreamUsage)
+class UpstreamUsageAdmin(admin.ModelAdmin):
+    """流式调用用量，客户端断开、超时的调用记录已生成部分"""
+    list_display = ('endpoint', 'model', 'user', 'status', 'total_tokens', 'text_chars', 'audio_size_display',
+                    'duration_ms', 'created_at')
+    list_filter = ('status', 'endpoint', 'model', 'created_at')
+    list_select_related = ('user',)
+    readonly_fields = ('endpoint', 'model', 'user', 'status', 'prompt_tokens', 'completion_tokens', 'total_tokens',
+                       'chunks', 'text_chars', 'audio_bytes', 'duration_ms', 'created_at')
+    actions = ['export_csv']
+
+    def audio_size_display(self, obj):
+        return format_bytes(obj.audio_bytes) if obj.audio_bytes else '-'
+    audio_size_display.short_description = '已输出音频'
+    audio_size_display.admin_order_field = 'audio_bytes'
+
+    @admin.action(description='导出CSV')
+    def export_csv(self, request, queryset):
+        return stream_csv(queryset, [
+            ('接口', 'endpoint'), ('模型', 'model'), ('用户', 'user__username'), ('结束方式', 'status'),
+            ('输入token', 'prompt_tokens'), ('输出token', 'completion_tokens'), ('总token', 'total_tokens'),
+            ('已接收块数', 'chunks'), ('已输出字数', 'text_chars'), ('已输出音频(字节)', 'audio_bytes'),
+            ('耗时(毫秒)', 'duration_ms'), ('记录时间', 'created_at'),
+        ], f"upstream_usage_{datetime.now():%Y%m%d%H%M%S}.csv")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+# 上游API密钥池（ai_app.keypool）
+@admin.register(ApiCredential)
+class ApiCredentialAdmin(admin.ModelAdmin):
+    """同一服务商配置多个密钥后按负载分配，用量每隔几秒由各进程写入"""
+    list_display = ('name', 'provider', 'masked_key', 'enabled', 'rpm_limit', 'status_display', 'request_count',
+                    'error_count', 'rate_limited_count', 'last_used_at')
+    list_filter = ('provider', 'enabled')
+    list_editable = ('enabled',)
+    search_fields = ('name',)
+    readonly_fields = ('request_count', 'error_count', 'rate_limited_count', 'last_used_at', 'created_at')
+    actions = ['clear_cooldown']
+
+    def masked_key(self, obj):
+        return f"{obj.key[:4]}****{obj.key[-4:]}" if len(obj.key) > 12 else '****'
+    masked_key.short_description = '密钥'
+
+    def status_display(self, obj):
+        until = keypool.cooldown_until(obj)
+        if until:
+            return format_html('<span style="color: #ba2121;">冷却中，{} 秒后恢复</span>', int(until - time.time()) + 1)
+        return '可用' if obj.enabled else '停用'
+    status_display.short_description = '状态'
+
+    @admin.action(description='解除冷却')
+    def clear_cooldown(self, request, queryset):
+        for obj in queryset:
+            keypool.clear_cooldown(obj)
+        self.message_user(request, f"已解除 {queryset.count()} 个密钥的冷却")
+
+
+# 异步任务（ai_app.jobs）
+@admin.register(AsyncJob)
+class AsyncJobAdmin(admin.ModelAdmin):
+    """async=true 提交的请求，由 run_jobs 的 worker 执行；请求体和结果不在后台显示"""
+    list_display = ('id', 'endpoint', 'owner', 'status', 'status_code', 'attempts', 'worker', 'created_at',
+                    'started_at', 'finished_at')
+    list_filter = ('status', 'endpoint', 'created_at')
+    search_fields = ('=id', 'owner')
+    fields = ('id', 'endpoint', 'path', 'owner', 'user', 'status', 'status_code', 'attempts', 'worker',
+              'lease_expires', 'error', 'created_at', 'started_at', 'finished_at')
+    readonly_fields = fields
+    list_select_related = ('user',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,267 @@
+# ai_app/audio.py
+"""
+语音接口的音频预处理（QwenAudio、Qwenomni）
+PCM WAV：解析后混成单声道、重采样到 16kHz、去掉首尾静音，重新编码成 16bit WAV，
+手机录的 48kHz 立体声体积约为原来的 1/6；其他格式不转码，只按文件头纠正 MIME 和格式标注
+长录音可以在静音处切成多段，由调用方并发识别后合并
+"""
+import base64
+import io
+import logging
+import mimetypes
+import struct
+import wave
+
+import numpy as np
+from django.conf import settings
+
+from .metadata import sniff_type
+
+logger = logging.getLogger(__name__)
+
+# 上游 input_audio.format 的取值
+AUDIO_FORMATS = {
+    'audio/wav': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/mpeg': 'mp3',
+    'audio/ogg': 'ogg',
+    'audio/flac': 'flac',
+    'audio/mp4': 'm4a',
+    'audio/aac': 'aac',
+    'audio/amr': 'amr',
+}
+_FORMAT_PCM = 1
+_FORMAT_FLOAT = 3
+_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def options():
+    result = {
+        'SAMPLE_RATE': 16000,
+        'TRIM_SILENCE': True,
+        'SILENCE_DB': -45,
+        'SILENCE_PADDING_MS': 200,
+        'MAX_UPLOAD_BYTES': 100 * 1024 * 1024,
+        'MAX_UPSTREAM_BYTES': 10 * 1024 * 1024,
+        'CHUNK_SECONDS': 300,
+        'CHUNK_WORKERS': 4,
+    }
+    result.update(getattr(settings, 'AUDIO_NORMALIZE', {}))
+    return result
+
+
+class NormalizedAudio:
+    """预处理结果：data 为上传给模型的字节，samples/rate 只有 PCM WAV 才有（切段用）"""
+
+    def __init__(self, data, mime, samples=None, rate=None, original_bytes=0):
+        self.data = data
+        self.mime = mime
+        self.samples = samples
+        self.rate = rate
+        self.original_bytes = original_bytes
+
+    @property
+    def format(self):
+        return AUDIO_FORMATS.get(self.mime, self.mime.split('/')[-1])
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.rate if self.samples is not None else None
+
+    def data_url(self):
+        return f"data:{self.mime};base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+
+# =============== WAV 解析和编码 ===============
+def read_wav(data):
+    """
+    解析 PCM/浮点 WAV，返回 (采样 float32 数组 [帧数, 声道数]，范围 -1~1, 采样率)
+    不是 WAV 或是压缩编码（如 ADPCM）时返回None
+    """
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(data):
+        chunk_id, size = data[offset:offset + 4], struct.unpack('<I', data[offset + 4:offset + 8])[0]
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            tag, channels, rate = struct.unpack('<HHI', data[body:body + 8])
+            bits = struct.unpack('<H', data[body + 14:body + 16])[0]
+            if tag == _FORMAT_EXTENSIBLE and size >= 40:
+                # 子格式 GUID 的前两个字节是真正的格式编号
+                tag = struct.unpack('<H', data[body + 24:body + 26])[0]
+            fmt = (tag, channels, rate, bits)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            # 录音中断时 data 块长度可能写的是0或超过文件长度，以实际数据为准
+            payload = data[body:body + size] if size else data[body:]
+            return _decode_pcm(payload, *fmt)
+        offset = body + size + size % 2
+    return None
+
+
+def _decode_pcm(payload, tag, channels, rate, bits):
+    if not channels or not rate:
+        return None
+    width = bits // 8
+    frame = width * channels
+    payload = payload[:len(payload) - len(payload) % frame] if frame else b''
+    if tag == _FORMAT_FLOAT and bits in (32, 64):
+        samples = np.frombuffer(payload, dtype='<f4' if bits == 32 else '<f8').astype(np.float32)
+    elif tag == _FORMAT_PCM and bits == 8:
+        samples = (np.frombuffer(payload, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif tag == _FORMAT_PCM and bits == 16:
+        samples = np.frombuffer(payload, dtype='<i2').astype(np.float32) / 32768
+    elif tag == _FORMAT_PCM and bits == 24:
+        raw = np.frombuffer(payload, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values = np.where(values & 0x800000, values - 0x1000000, values)
+        samples = values.astype(np.float32) / 8388608
+    elif tag == _FORMAT_PCM and bits == 32:
+        samples = np.frombuffer(payload, dtype='<i4').astype(np.float32) / 2147483648
+    else:
+        return None
+    return samples.reshape(-1, channels), rate
+
+
+def write_wav(samples, rate):
+    """单声道 float32 采样编码成 16bit PCM WAV"""
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2')
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(rate)
+        writer.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def wrap_pcm16(pcm, rate, channels=1):
+    """给裸 16bit PCM 加上 WAV 文件头（WebSocket 语音会话里客户端直接发 PCM）"""
+    pcm = pcm[:len(pcm) - len(pcm) % (2 * channels)]
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as writer:
+        writer.setnchannels(channels)
+        writer.setsampwidth(2)
+        writer.setframerate(rate)
+        writer.writeframes(pcm)
+    return buffer.getvalue()
+
+
+# =============== 处理步骤 ===============
+def to_mono(samples):
+    return samples.mean(axis=1, dtype=np.float32) if samples.shape[1] > 1 else samples[:, 0]
+
+
+def _lowpass(samples, cutoff, taps=63):
+    """加汉宁窗的 sinc 低通滤波，cutoff 为相对采样率的比例（0~0.5）"""
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hanning(taps)
+    kernel /= kernel.sum()
+    return np.convolve(samples, kernel.astype(np.float32), mode='same')
+
+
+def resample(samples, rate, target):
+    """降采样先低通滤掉目标采样率奈奎斯特频率以上的成分防止混叠，再线性插值；整数倍时直接抽取"""
+    if rate == target or not len(samples):
+        return samples
+    if target < rate:
+        samples = _lowpass(samples, 0.5 * target / rate * 0.9)
+        if rate % target == 0:
+            return samples[::rate // target]
+    count = int(round(len(samples) * target / rate))
+    positions = np.arange(count, dtype=np.float64) * rate / target
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def _frame_levels(samples, rate, frame_ms=20):
+    """每帧的 RMS（dBFS），返回 (电平数组, 每帧采样数)"""
+    size = max(1, rate * frame_ms // 1000)
+    count = len(samples) // size
+    if not count:
+        return np.array([], dtype=np.float32), size
+    frames = samples[:count * size].reshape(count, size)
+    # einsum 逐帧求平方和，不生成和原数组一样大的临时数组
+    rms = np.sqrt(np.einsum('ij,ij->i', frames, frames) / size)
+    return 20 * np.log10(np.maximum(rms, 1e-10)), size
+
+
+def trim_silence(samples, rate, threshold_db=-45, padding_ms=200):
+    """去掉首尾低于阈值的静音，前后各留 padding_ms；整段都是静音时原样返回"""
+    levels, size = _frame_levels(samples, rate)
+    voiced = np.flatnonzero(levels > threshold_db)
+    if not len(voiced):
+        return samples
+    padding = rate * padding_ms // 1000
+    start = max(0, voiced[0] * size - padding)
+    end = min(len(samples), (voiced[-1] + 1) * size + padding)
+    return samples[start:end]
+
+
+def split_chunks(samples, rate, seconds, search_seconds=2.0):
+    """
+    按 seconds 切段，切点选在每个边界前 search_seconds 内最安静的一帧，尽量不把一个字切成两半
+    返回每段的采样数组
+    """
+    length = int(seconds * rate)
+    if length <= 0 or len(samples) <= length:
+        return [samples]
+    chunks = []
+    start = 0
+    while len(samples) - start > length:
+        boundary = start + length
+        window_start = max(start + 1, boundary - int(search_seconds * rate))
+        levels, size = _frame_levels(samples[window_start:boundary], rate)
+        # 一样安静时取最靠后的，段长尽量接近 seconds
+        quietest = len(levels) - 1 - int(np.argmin(levels[::-1])) if len(levels) else None
+        cut = window_start + quietest * size + size // 2 if quietest is not None else boundary
+        chunks.append(samples[start:cut])
+        start = cut
+    chunks.append(samples[start:])
+    return chunks
+
+
+# =============== 入口 ===============
+def guess_mime(data, name='', content_type=''):
+    """按文件头判断音频 MIME，认不出时用扩展名，再退回客户端声明的类型"""
+    ext = ('.' + name.rsplit('.', 1)[-1].lower()) if '.' in name else ''
+    sniffed = sniff_type(data[:64], ext)
+    if sniffed and sniffed[1] in ('audio', 'video'):
+        return sniffed[0]
+    if data[:6] == b'#!AMR\n':
+        return 'audio/amr'
+    return mimetypes.guess_type(name)[0] or content_type or 'audio/wav'
+
+
+def normalize_audio(data, name='', content_type=''):
+    """返回 NormalizedAudio；PCM WAV 重新编码，其他格式原样返回并纠正 MIME"""
+    opts = options()
+    mime = guess_mime(data, name, content_type)
+    if mime not in ('audio/wav', 'audio/x-wav'):
+        return NormalizedAudio(data, mime, original_bytes=len(data))
+    try:
+        decoded = read_wav(data)
+    except (struct.error, ValueError) as e:
+        logger.warning('WAV 解析失败，使用原文件: %s', e)
+        decoded = None
+    if decoded is None:
+        return NormalizedAudio(data, 'audio/wav', original_bytes=len(data))
+
+    samples, rate = decoded
+    samples = resample(to_mono(samples), rate, opts['SAMPLE_RATE'])
+    rate = opts['SAMPLE_RATE']
+    if opts['TRIM_SILENCE']:
+        samples = trim_silence(samples, rate, opts['SILENCE_DB'], opts['SILENCE_PADDING_MS'])
+    return NormalizedAudio(write_wav(samples, rate), 'audio/wav', samples, rate, original_bytes=len(data))
+
+
+def chunk_audio(audio, seconds):
+    """把 PCM WAV 预处理结果切成多段 NormalizedAudio；不是 PCM WAV 的不切"""
+    if audio.samples is None:
+        return [audio]
+    chunks = split_chunks(audio.samples, audio.rate, seconds)
+    if len(chunks) == 1:
+        return [audio]
+    return [NormalizedAudio(write_wav(chunk, audio.rate), audio.mime, chunk, audio.rate) for chunk in chunks]
@@ -0,0 +1,188 @@
+# ai_app/bench/fakes.py
+"""
+各家SDK的进程内假实现，基准测试时替换 ai_app.views 里的客户端，完全不走网络
+只实现视图里实际用到的属性，返回固定内容，用来测网关自身的开销
+"""
+import base64
+import json
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest import mock
+
+import requests
+from cozepy import ChatEventType
+
+FAKE_TEXT = '这是基准测试用的固定回复。' * 8
+# 约0.1秒 24kHz 16bit 的静音PCM，模拟 omni 的音频增量
+FAKE_AUDIO_DELTA = base64.b64encode(b'\x00\x00' * 2400).decode('ascii')
+
+
+def _usage():
+    return SimpleNamespace(prompt_tokens=32, completion_tokens=64, total_tokens=96)
+
+
+def _chat_completion(model, content=FAKE_TEXT):
+    message = SimpleNamespace(role='assistant', content=content)
+    return SimpleNamespace(
+        id='bench-completion',
+        created=0,
+        model=model,
+        choices=[SimpleNamespace(index=0, finish_reason='stop', message=message)],
+        usage=_usage(),
+    )
+
+
+# ---------- requests（GLM HTTP接口）----------
+def fake_requests_post(url, headers=None, json=None, **kwargs):
+    if url.endswith('/images/generations'):
+        body = {'created': 0, 'data': [{'url': 'https://example.com/bench.png'}]}
+    else:
+        body = {
+            'id': 'bench-completion',
+            'created': 0,
+            'model': (json or {}).get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': FAKE_TEXT}}],
+            'usage': {'prompt_tokens': 32, 'completion_tokens': 64, 'total_tokens': 96},
+        }
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/json'
+    response._content = _json_bytes(body)
+    response.url = url
+    return response
+
+
+def _json_bytes(body):
+    return json.dumps(body, ensure_ascii=False).encode('utf-8')
+
+
+# ---------- ZhipuAI SDK ----------
+class _ZhipuCompletions:
+    def create(self, model=None, messages=None, **kwargs):
+        completion = _chat_completion(model)
+        completion.choices[0].message.audio = {'id': 'bench-audio', 'data': FAKE_AUDIO_DELTA}
+        return completion
+
+
+class _ZhipuVideos:
+    def generations(self, **kwargs):
+        return SimpleNamespace(id='bench-video-task')
+
+    def retrieve_videos_result(self, id=None, **kwargs):
+        video = SimpleNamespace(url='https://example.com/bench.mp4', cover_image_url='https://example.com/bench.jpg')
+        return SimpleNamespace(task_status='SUCCESS', video_result=[video])
+
+
+class FakeZhipuAI:
+    def __init__(self, api_key=None, **kwargs):
+        self.chat = SimpleNamespace(completions=_ZhipuCompletions())
+        self.videos = _ZhipuVideos()
+
+
+# ---------- OpenAI 兼容接口（DashScope compatible-mode）----------
+class _OpenAIStream:
+    """模拟 openai.Stream：可迭代，可 close"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def close(self):
+        pass
+
+
+def _omni_chunks():
+    chunks = []
+    for _ in range(10):
+        chunks.append(SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(audio={'transcript': '好'}))]))
+        chunks.append(SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(audio={'data': FAKE_AUDIO_DELTA}))]))
+    chunks.append(SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None))]))
+    # stream_options={"include_usage": True} 时最后一块只有 usage
+    chunks.append(SimpleNamespace(choices=[], usage=_usage()))
+    return chunks
+
+
+class _OpenAICompletions:
+    def create(self, model=None, messages=None, stream=False, **kwargs):
+        if stream:
+            return _OpenAIStream(_omni_chunks())
+        return _chat_completion(model)
+
+
+class _OpenAIFiles:
+    def create(self, file=None, purpose=None, **kwargs):
+        return SimpleNamespace(id='file-bench', purpose=purpose)
+
+
+class FakeOpenAI:
+    def __init__(self, api_key=None, base_url=None, **kwargs):
+        self.chat = SimpleNamespace(completions=_OpenAICompletions())
+        self.files = _OpenAIFiles()
+
+
+# ---------- dashscope 原生SDK ----------
+def _dashscope_response(output):
+    return SimpleNamespace(status_code=200, code='', message='', request_id='bench-request', output=output)
+
+
+class FakeGeneration:
+    @staticmethod
+    def call(model=None, messages=None, **kwargs):
+        message = SimpleNamespace(role='assistant', content=FAKE_TEXT)
+        return _dashscope_response(SimpleNamespace(choices=[SimpleNamespace(message=message)]))
+
+
+class FakeApplication:
+    @staticmethod
+    def call(app_id=None, prompt=None, session_id=None, **kwargs):
+        return _dashscope_response(SimpleNamespace(
+            session_id=session_id or 'bench-session',
+            text=FAKE_TEXT,
+            thoughts=[{'thought': 'bench'}],
+        ))
+
+
+class FakeMultiModalConversation:
+    @staticmethod
+    def call(model=None, messages=None, **kwargs):
+        message = SimpleNamespace(role='assistant', content=[{'text': FAKE_TEXT}])
+        return _dashscope_response(SimpleNamespace(choices=[SimpleNamespace(message=message)]))
+
+
+# ---------- Coze SDK ----------
+class _CozeChat:
+    def stream(self, bot_id=None, user_id=None, additional_messages=None, **kwargs):
+        for piece in FAKE_TEXT.split('。'):
+            yield SimpleNamespace(event=ChatEventType.CONVERSATION_MESSAGE_DELTA,
+                                  message=SimpleNamespace(content=piece))
+        yield SimpleNamespace(event=ChatEventType.CONVERSATION_CHAT_COMPLETED,
+                              chat=SimpleNamespace(usage=SimpleNamespace(token_count=96, input_count=32,
+                                                                       output_count=64)))
+
+
+class FakeCoze:
+    def __init__(self, auth=None, base_url=None, **kwargs):
+        self.chat = _CozeChat()
+
+
+# 需要替换的位置：(目标, 假实现)
+PATCH_TARGETS = [
+    ('ai_app.views.requests.post', fake_requests_post),
+    ('ai_app.views.ZhipuAI', FakeZhipuAI),
+    ('ai_app.views.OpenAI', FakeOpenAI),
+    ('ai_app.views.Generation', FakeGeneration),
+    ('ai_app.views.Application', FakeApplication),
+    ('ai_app.views.dashscope.MultiModalConversation', FakeMultiModalConversation),
+    ('ai_app.views.Coze', FakeCoze),
+]
+
+
+def patch_providers():
+    """返回一个 ExitStack，with 块内所有上游SDK都被替换成假实现"""
+    stack = ExitStack()
+    for target, fake in PATCH_TARGETS:
+        stack.enter_context(mock.patch(target, fake))
+    return stack
@@ -0,0 +1,152 @@
+# ai_app/bench/loadgen.py
+"""
+压测发生器：按目标RPS回放请求组合（开环，按计划时间发请求，不会因为网关变慢而自动降速）
+统计 p50/p95/p99、首包时间、吞吐量和错误率，用来对比 WSGI/ASGI、连接池等部署参数
+"""
+import json
+import random
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+DEFAULT_MIX = Path(__file__).resolve().parent / 'request_mix.jsonl'
+
+
+def load_mix(path):
+    """
+    请求组合，每行一个JSON：
+    {"name": "qwen_chat", "method": "POST", "path": "/QwenChat/", "form": {...}, "json": {...},
+     "files": {"file": "相对mix文件的路径"}, "weight": 3}
+    """
+    path = Path(path)
+    entries = []
+    for line in path.read_text(encoding='utf-8').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        entry = json.loads(line)
+        entry.setdefault('method', 'POST')
+        entry.setdefault('weight', 1)
+        entry.setdefault('name', entry['path'])
+        entry['files'] = {field: (path.parent / name) for field, name in entry.get('files', {}).items()}
+        entries.append(entry)
+    return entries
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class LoadGenerator:
+    def __init__(self, target, mix, rps, duration, concurrency=256, timeout=120, seed=None):
+        self.target = target.rstrip('/')
+        self.mix = mix
+        self.rps = rps
+        self.duration = duration
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='loadgen')
+        self._random = random.Random(seed)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.samples = []  # (name, status, 排队+响应ms, 首包ms, 响应ms)
+        self.file_cache = {}
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _pick(self):
+        return self._random.choices(self.mix, weights=[entry['weight'] for entry in self.mix])[0]
+
+    def _file_bytes(self, path):
+        if path not in self.file_cache:
+            self.file_cache[path] = path.read_bytes()
+        return self.file_cache[path]
+
+    def _send(self, entry, scheduled_at):
+        started = time.perf_counter()
+        status_code, first_byte_ms = 'error', None
+        try:
+            kwargs = {'timeout': self.timeout, 'stream': True}
+            if entry.get('json') is not None:
+                kwargs['json'] = entry['json']
+            else:
+                kwargs['data'] = entry.get('form') or {}
+            if entry['files']:
+                kwargs['files'] = {field: (path.name, self._file_bytes(path)) for field, path in entry['files'].items()}
+            with self._session().request(entry['method'], self.target + entry['path'], **kwargs) as response:
+                for index, _ in enumerate(response.iter_content(chunk_size=8192)):
+                    if index == 0:
+                        first_byte_ms = (time.perf_counter() - started) * 1000
+                status_code = response.status_code
+        except requests.RequestException as e:
+            status_code = type(e).__name__
+        finished = time.perf_counter()
+        with self._lock:
+            self.samples.append((entry['name'], status_code, (finished - scheduled_at) * 1000,
+                                 first_byte_ms, (finished - started) * 1000))
+
+    def run(self, progress=None):
+        interval = 1 / self.rps
+        start = time.perf_counter()
+        total = int(self.rps * self.duration)
+        futures = []
+        for index in range(total):
+            scheduled_at = start + index * interval
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self.pool.submit(self._send, self._pick(), scheduled_at))
+            if progress and index and index % max(int(self.rps), 1) == 0:
+                progress(index, total)
+        for future in futures:
+            future.result()
+        self.pool.shutdown()
+        self.elapsed = time.perf_counter() - start
+        return self.report()
+
+    def report(self):
+        def summarize(samples):
+            latencies = [item[2] for item in samples]
+            service = [item[4] for item in samples]
+            first_bytes = [item[3] for item in samples if item[3] is not None]
+            statuses = Counter(str(item[1]) for item in samples)
+            errors = sum(count for status, count in statuses.items() if not status.startswith(('2', '3')))
+            return {
+                'requests': len(samples),
+                'error_rate': round(errors / len(samples), 4) if samples else 0,
+                'statuses': dict(statuses),
+                'p50_ms': _round(percentile(latencies, 50)),
+                'p95_ms': _round(percentile(latencies, 95)),
+                'p99_ms': _round(percentile(latencies, 99)),
+                'max_ms': _round(max(latencies) if latencies else None),
+                'mean_ms': _round(statistics.mean(latencies) if latencies else None),
+                'service_p99_ms': _round(percentile(service, 99)),
+                'ttfb_p50_ms': _round(percentile(first_bytes, 50)),
+                'ttfb_p99_ms': _round(percentile(first_bytes, 99)),
+            }
+
+        by_name = defaultdict(list)
+        for sample in self.samples:
+            by_name[sample[0]].append(sample)
+        overall = summarize(self.samples)
+        overall['target_rps'] = self.rps
+        overall['throughput_rps'] = round(len(self.samples) / self.elapsed, 2) if self.elapsed else 0
+        overall['ok_throughput_rps'] = round(
+            sum(1 for item in self.samples if str(item[1]).startswith('2')) / self.elapsed, 2) if self.elapsed else 0
+        return {'overall': overall, 'by_name': {name: summarize(items) for name, items in sorted(by_name.items())}}
+
+
+def _round(value):
+    return round(value, 1) if value is not None else None
@@ -0,0 +1,289 @@
+# ai_app/bench/runner.py
+"""
+接口基准测试：用 Django 测试客户端逐个请求 ai_app/urls.py 里的接口，上游全部替换成 fakes 里的假实现
+每个场景统计 CPU时间、墙钟时间、内存分配和数据库查询次数，结果可以存成基线做对比
+"""
+import base64
+import io
+import json
+import statistics
+import tempfile
+import time
+import tracemalloc
+import wave
+from unittest import mock
+
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import get_resolver
+
+from ai_app.bench.fakes import patch_providers
+
+# 不需要测的路由（媒体文件下载不经过上游）
+SKIP_ROUTES = {None, 'media'}
+
+
+def _png_bytes(width=1280, height=960):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 120, 80)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _wav_bytes(seconds=2, rate=16000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b'\x00\x01' * rate * seconds)
+    return buffer.getvalue()
+
+
+def _upload(name, data):
+    upload = io.BytesIO(data)
+    upload.name = name
+    return upload
+
+
+class Scenario:
+    """
+    一个基准场景：route 是 URL name，files 是 {字段名: (文件名, 内容) 或 [(文件名, 内容), ...]}
+    setup(user) 在跑之前准备数据，返回 URL 参数（如任务ID）
+    """
+
+    def __init__(self, name, route, method='post', data=None, content_type=None, files=None, login=False,
+                 setup=None):
+        self.name = name
+        self.route = route
+        self.method = method
+        self.data = data or {}
+        self.content_type = content_type
+        self.files = files or {}
+        self.login = login
+        self.setup = setup
+
+    def request(self, client, path):
+        if self.method == 'get':
+            return client.get(path, self.data)
+        if self.files:
+            payload = dict(self.data)
+            for key, value in self.files.items():
+                if isinstance(value, list):
+                    payload[key] = [_upload(name, data) for name, data in value]
+                else:
+                    payload[key] = _upload(*value)
+            return client.post(path, payload)
+        if self.content_type == 'json':
+            return client.post(path, json.dumps(self.data), content_type='application/json')
+        return client.post(path, self.data)
+
+
+def _finished_job(user):
+    """一个已完成的异步任务，提交者是登录的基准用户"""
+    from ai_app.models import AsyncJob
+
+    job = AsyncJob.objects.create(
+        endpoint='glm-4-api', method='POST', path='/GLM-4/', content_type='application/json',
+        request_body=b'{}', user=user, owner=f'user:{user.pk}', status=AsyncJob.DONE,
+        status_code=200, response_content_type='application/json',
+        response_body=json.dumps({'answer': '你好'}).encode('utf-8'),
+    )
+    return {'job_id': job.pk}
+
+
+def build_scenarios():
+    png = _png_bytes()
+    wav = _wav_bytes()
+    png_b64 = base64.b64encode(png).decode('ascii')
+    return [
+        Scenario('api_docs', 'api-docs', method='get'),
+        Scenario('api_docs_page', 'api_docs', method='get'),
+        Scenario('glm4', 'glm-4-api', data={'question': '你好', 'model': 'glm-4-flash'}, content_type='json'),
+        Scenario('glm4v', 'glm-4v-api', content_type='json', data={
+            'model': 'glm-4v-flash',
+            'messages': [{'role': 'user', 'content': [
+                {'type': 'image_url', 'image_url': {'url': f'data:image/png;base64,{png_b64}'}},
+                {'type': 'text', 'text': '图里有什么'},
+            ]}],
+        }),
+        Scenario('glm_cogview', 'glm-cog-api', data={'prompt': '一只猫', 'model': 'cogview-3-flash'}, content_type='json'),
+        Scenario('glm_cogvideo', 'glm-cogvideo-api', data={'prompt': '一只猫在跑'}, content_type='json'),
+        Scenario('glm_cogvideo_status', 'glm-cogvideo-api', data={'action': 'check_status', 'task_id': 't'},
+                 content_type='json'),
+        Scenario('glm4_voice', 'glm-4-voice-api', content_type='json', data={
+            'messages': [{'role': 'user', 'content': '你好'}],
+        }),
+        Scenario('coze_chat', 'coze-chat-api', data={'question': '你好', 'user_id': 'bench'}, content_type='json'),
+        Scenario('qwen_chat', 'qwen-chat-api', data={'content': '你好'}),
+        Scenario('qwen_chat_file', 'qwen-chat-file-api', data={'text': '总结'},
+                 files={'file': ('bench.txt', '基准测试文档。'.encode('utf-8') * 2000)}),
+        Scenario('qwen_chat_toke', 'qwen-chat-toke-api', data={'content': '你好'}),
+        Scenario('qwen_ocr', 'qwen-ocr-api', files={'file': ('bench.png', png)}),
+        Scenario('qwen_ocr_document', 'qwen-ocr-document-api',
+                 files={'files': [('bench1.png', png), ('bench2.png', png)]}),
+        Scenario('qwen_omni_text', 'qwen-omni-api', data={'type': 'text', 'text': '你好'}),
+        Scenario('qwen_omni_binary', 'qwen-omni-api', data={'type': 'text', 'text': '你好', 'stream_format': 'binary'}),
+        Scenario('qwen_omni_audio', 'qwen-omni-api', data={'type': 'audio', 'text': '听听这个'},
+                 files={'file': ('bench.wav', wav)}),
+        Scenario('qwen_audio', 'qwen-audio-api', files={'file': ('bench.wav', wav)}),
+        Scenario('file_upload', 'file-upload', files={'file': ('bench.png', png)}, login=True),
+        Scenario('file_bulk_upload', 'file-bulk-upload', login=True,
+                 files={'files': [(f'bench{i}.png', png) for i in range(20)]}),
+        Scenario('file_list', 'file-upload', method='get', data={'type': 'image'}, login=True),
+        Scenario('qwen_vl', 'qwen-vl-api', data={'text': '这是什么', 'file': png_b64}, content_type='json'),
+        Scenario('deeskeep', 'qwen-deeskeep-api', data={'content': '你好'}, content_type='json'),
+        Scenario('async_submit', 'glm-4-api', content_type='json', login=True,
+                 data={'question': '你好', 'model': 'glm-4-flash', 'async': True}),
+        Scenario('async_job', 'async-job', method='get', login=True, setup=_finished_job),
+    ]
+
+
+def uncovered_routes(scenarios):
+    """ai_app/urls.py 里还没有场景覆盖的路由"""
+    covered = {scenario.route for scenario in scenarios}
+    names = set()
+    for pattern in get_resolver('ai_app.urls').url_patterns:
+        name = getattr(pattern, 'name', None)
+        if name not in SKIP_ROUTES:
+            names.add(name)
+    return sorted(names - covered)
+
+
+def _consume(response):
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+class _QueryCounter:
+    """用 execute_wrapper 计数；测试客户端每个请求开始时会清空 connection.queries，不能直接用"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _run_once(client, scenario, path):
+    if not scenario.login:
+        # 不带会话，避免 Qwenomni 这类把对话历史存在 session 里的接口越跑越慢
+        client.cookies.clear()
+    response = scenario.request(client, path)
+    size = _consume(response)
+    return response.status_code, size
+
+
+def run_scenario(scenario, iterations, user=None):
+    from django.urls import reverse
+
+    client = Client()
+    if scenario.login and user is not None:
+        client.force_login(user)
+    path = reverse(scenario.route, kwargs=scenario.setup(user) if scenario.setup else None)
+
+    # 预热一次，排除导入和首次查询的开销
+    status, size = _run_once(client, scenario, path)
+
+    cpu_samples, wall_samples = [], []
+    queries = _QueryCounter()
+    with connection.execute_wrapper(queries):
+        for _ in range(iterations):
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            status, size = _run_once(client, scenario, path)
+            cpu_samples.append((time.process_time() - cpu_start) * 1000)
+            wall_samples.append((time.perf_counter() - wall_start) * 1000)
+
+    # 内存单独跑一次，tracemalloc 会明显拖慢计时
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        _run_once(client, scenario, path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'route': scenario.route,
+        'status': status,
+        'response_bytes': size,
+        'cpu_ms': round(statistics.median(cpu_samples), 3),
+        'wall_ms': round(statistics.median(wall_samples), 3),
+        'peak_alloc_bytes': peak - before,
+        'queries': round(queries.count / iterations, 2),
+    }
+
+
+def run_all(iterations=20, only=None):
+    """运行所有场景，返回 {场景名: 结果}"""
+    from django.contrib.auth import get_user_model
+
+    scenarios = [s for s in build_scenarios() if not only or s.name in only]
+    results = {}
+    with tempfile.TemporaryDirectory() as media_root, \
+            override_settings(MEDIA_ROOT=media_root, SLOW_REQUEST_THRESHOLD_MS=None,
+                              MEMORY_PROFILING={'ENABLED': False},
+                              # 限流照常计入开销，预算放大到压测用不完
+                              RATE_LIMITS={'DEFAULT': {'REQUESTS': 10 ** 9, 'TOKENS': 10 ** 12}, 'ENDPOINTS': {}}), \
+            patch_providers(), \
+            mock.patch('ai_app.workers.BoundedExecutor.submit', return_value=None):
+        # 缩略图、元数据等后台任务不计入接口耗时，直接丢弃
+        user, _ = get_user_model().objects.get_or_create(username='bench', defaults={'is_staff': True})
+        for scenario in scenarios:
+            results[scenario.name] = run_scenario(scenario, iterations, user=user)
+    return results
+
+
+# 绝对误差下限：差值小于这些值不算回归
+MIN_REGRESSION = {
+    'peak_alloc_bytes': 64 * 1024,
+}
+# 计时受机器和负载影响很大，换台机器跑就会超出基线，只提示不算回归
+MIN_SLOWDOWN = {
+    'cpu_ms': 2.0,
+}
+
+
+def missing_baseline(results, baseline):
+    """基线里没有的场景，这些场景无从对比，新增场景后要重新 --save"""
+    return sorted(name for name in results if name not in baseline)
+
+
+def _exceeded(results, baseline, tolerance, floors):
+    changes = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric, floor in floors.items():
+            before, after = previous[metric], current[metric]
+            if after > before * (1 + tolerance) and after - before > floor:
+                changes.append((name, metric, before, after))
+    return changes
+
+
+def compare(results, baseline, tolerance):
+    """
+    与基线对比，返回回归列表
+    内存超过基线 (1 + tolerance) 倍且差值超过 MIN_REGRESSION 算回归，查询次数只要变多、状态码变了就算回归
+    基线里没有的场景不在这里处理，见 missing_baseline；CPU时间见 slowdowns
+    """
+    regressions = _exceeded(results, baseline, tolerance, MIN_REGRESSION)
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current['queries'] > previous['queries']:
+            regressions.append((name, 'queries', previous['queries'], current['queries']))
+        if current['status'] != previous['status']:
+            regressions.append((name, 'status', previous['status'], current['status']))
+    return regressions
+
+
+def slowdowns(results, baseline, tolerance):
+    """CPU时间超过基线 (1 + tolerance) 倍且差值超过 MIN_SLOWDOWN 的场景，仅供参考，不影响 --fail-on-regression"""
+    return _exceeded(results, baseline, tolerance, MIN_SLOWDOWN)
@@ -0,0 +1,317 @@
+# ai_app/bench/stub_servers.py
+"""
+本地假上游：模拟 GLM（chat/images/videos）、DashScope（compatible-mode 和原生接口）、Coze 流式对话
+延迟、错误率、卡顿都可以配置，用来对网关做可复现的端到端压测
+"""
+import base64
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_TEXT = '这是本地假上游返回的固定内容，用于压测。'
+STUB_AUDIO_CHUNK = base64.b64encode(b'\x00\x00' * 2400).decode('ascii')
+
+
+class Behaviour:
+    """
+    延迟和错误分布
+    latency_ms/jitter_ms：首包延迟，dist 可选 fixed/uniform/normal/lognormal/exponential
+    error_rate + error_statuses：按比例返回错误，429 会带 Retry-After
+    stall_rate/stall_ms：少量请求额外卡顿，模拟长尾
+    """
+
+    def __init__(self, latency_ms=200, jitter_ms=50, dist='lognormal', error_rate=0.0,
+                 error_statuses=None, stall_rate=0.0, stall_ms=20000, chunk_count=20, chunk_interval_ms=20,
+                 seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.dist = dist
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses or {429: 0.5, 500: 0.25, 503: 0.25}
+        self.stall_rate = stall_rate
+        self.stall_ms = stall_ms
+        self.chunk_count = chunk_count
+        self.chunk_interval_ms = chunk_interval_ms
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def first_byte_delay(self):
+        with self._lock:
+            mean, spread = self.latency_ms, self.jitter_ms
+            if self.dist == 'fixed' or spread <= 0:
+                delay = mean
+            elif self.dist == 'uniform':
+                delay = self._random.uniform(mean - spread, mean + spread)
+            elif self.dist == 'normal':
+                delay = self._random.gauss(mean, spread)
+            elif self.dist == 'exponential':
+                delay = self._random.expovariate(1 / mean) if mean > 0 else 0
+            else:
+                # 对数正态：均值为 mean，标准差约为 spread，右侧长尾更接近真实上游
+                sigma = math.sqrt(math.log(1 + (spread / mean) ** 2)) if mean > 0 else 0
+                mu = math.log(mean) - sigma ** 2 / 2 if mean > 0 else 0
+                delay = self._random.lognormvariate(mu, sigma) if mean > 0 else 0
+            if self._random.random() < self.stall_rate:
+                delay += self.stall_ms
+        return max(delay, 0) / 1000
+
+    def pick_error(self):
+        with self._lock:
+            if self._random.random() >= self.error_rate:
+                return None
+            roll, total = self._random.random(), 0.0
+            weight_sum = sum(self.error_statuses.values())
+            for status_code, weight in self.error_statuses.items():
+                total += weight / weight_sum
+                if roll < total:
+                    return status_code
+            return next(iter(self.error_statuses))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """按路径分发到各平台的假接口，server.behaviour 决定延迟和错误"""
+
+    protocol_version = 'HTTP/1.1'
+    routes = []  # [(method, 正则, 处理函数名)]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length else b''
+        for route_method, pattern, handler_name in self.routes:
+            match = re.fullmatch(pattern, self.path.split('?')[0])
+            if route_method == method and match:
+                break
+        else:
+            self._send_json(404, {'error': {'message': f'stub: 没有 {method} {self.path}'}})
+            return
+
+        behaviour = self.server.behaviour
+        error_status = behaviour.pick_error()
+        time.sleep(behaviour.first_byte_delay())
+        if error_status:
+            headers = {'Retry-After': '1'} if error_status == 429 else {}
+            self._send_json(error_status, {'error': {'code': str(error_status), 'message': 'stub injected error'},
+                                           'code': str(error_status), 'message': 'stub injected error'}, headers)
+            return
+
+        content_type = self.headers.get('Content-Type', '')
+        body = {}
+        if raw_body and 'json' in content_type:
+            try:
+                body = json.loads(raw_body)
+            except ValueError:
+                body = {}
+        getattr(self, handler_name)(body, **match.groupdict())
+
+    # ---------- 输出工具 ----------
+    def _send_json(self, status_code, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_sse(self, events):
+        """events 是 (event名或None, data字符串) 的迭代器，按 chunk_interval_ms 间隔分块发送"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        interval = self.server.behaviour.chunk_interval_ms / 1000
+        try:
+            for index, (event, data) in enumerate(events):
+                if index and interval:
+                    time.sleep(interval)
+                frame = (f'event: {event}\n' if event else '') + f'data: {data}\n\n'
+                self._write_chunk(frame.encode('utf-8'))
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开
+            pass
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def _pieces(self):
+        count = max(self.server.behaviour.chunk_count, 1)
+        return [STUB_TEXT[i % len(STUB_TEXT)] for i in range(count)]
+
+    @staticmethod
+    def _usage():
+        return {'prompt_tokens': 32, 'completion_tokens': 64, 'total_tokens': 96}
+
+    # ---------- GLM ----------
+    def glm_chat(self, body):
+        if body.get('stream'):
+            self._openai_stream(body)
+            return
+        message = {'role': 'assistant', 'content': STUB_TEXT}
+        if 'voice' in (body.get('model') or ''):
+            message['audio'] = {'id': 'stub-audio', 'data': STUB_AUDIO_CHUNK}
+        self._send_json(200, {
+            'id': uuid.uuid4().hex, 'created': int(time.time()), 'model': body.get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': message}],
+            'usage': self._usage(),
+        })
+
+    def glm_images(self, body):
+        self._send_json(200, {'created': int(time.time()), 'data': [{'url': 'https://example.com/stub.png'}]})
+
+    def glm_videos(self, body):
+        self._send_json(200, {'id': uuid.uuid4().hex, 'model': body.get('model'), 'task_status': 'PROCESSING'})
+
+    def glm_async_result(self, body, task_id):
+        self._send_json(200, {
+            'id': task_id, 'task_status': 'SUCCESS', 'model': 'cogvideox-flash',
+            'video_result': [{'url': 'https://example.com/stub.mp4', 'cover_image_url': 'https://example.com/stub.jpg'}],
+        })
+
+    # ---------- DashScope compatible-mode（OpenAI 格式）----------
+    def compat_chat(self, body):
+        if body.get('stream'):
+            self._openai_stream(body)
+            return
+        self._send_json(200, {
+            'id': f'chatcmpl-{uuid.uuid4().hex}', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': STUB_TEXT}}],
+            'usage': self._usage(),
+        })
+
+    def compat_files(self, body):
+        self._send_json(200, {
+            'id': f'file-{uuid.uuid4().hex}', 'object': 'file', 'bytes': 0, 'created_at': int(time.time()),
+            'filename': 'stub.txt', 'purpose': 'file-extract', 'status': 'processed',
+        })
+
+    def _openai_stream(self, body):
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+        audio = 'audio' in (body.get('modalities') or [])
+
+        def events():
+            for piece in self._pieces():
+                if audio:
+                    delta = {'audio': {'transcript': piece}}
+                    yield None, json.dumps(self._chunk(completion_id, body, delta), ensure_ascii=False)
+                    delta = {'audio': {'data': STUB_AUDIO_CHUNK}}
+                else:
+                    delta = {'content': piece}
+                yield None, json.dumps(self._chunk(completion_id, body, delta), ensure_ascii=False)
+            final = self._chunk(completion_id, body, {}, finish_reason='stop')
+            final['usage'] = self._usage()
+            yield None, json.dumps(final)
+            yield None, '[DONE]'
+
+        self._send_sse(events())
+
+    @staticmethod
+    def _chunk(completion_id, body, delta, finish_reason=None):
+        return {
+            'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+        }
+
+    # ---------- DashScope 原生接口 ----------
+    def dashscope_generation(self, body):
+        self._dashscope_response({'choices': [{'finish_reason': 'stop',
+                                               'message': {'role': 'assistant', 'content': STUB_TEXT}}]})
+
+    def dashscope_multimodal(self, body):
+        self._dashscope_response({'choices': [{'finish_reason': 'stop',
+                                               'message': {'role': 'assistant', 'content': [{'text': STUB_TEXT}]}}]})
+
+    def dashscope_application(self, body, app_id):
+        session_id = (body.get('input') or {}).get('session_id') or uuid.uuid4().hex
+        self._dashscope_response({'text': STUB_TEXT, 'session_id': session_id, 'finish_reason': 'stop'})
+
+    def _dashscope_response(self, output):
+        self._send_json(200, {
+            'request_id': uuid.uuid4().hex,
+            'output': output,
+            'usage': {'input_tokens': 32, 'output_tokens': 64, 'total_tokens': 96},
+        })
+
+    # ---------- Coze ----------
+    def coze_chat(self, body):
+        chat = {'id': uuid.uuid4().hex, 'conversation_id': uuid.uuid4().hex, 'bot_id': body.get('bot_id'),
+                'status': 'in_progress'}
+
+        def events():
+            yield 'conversation.chat.created', json.dumps(chat)
+            for piece in self._pieces():
+                message = {'role': 'assistant', 'type': 'answer', 'content': piece, 'content_type': 'text',
+                           'chat_id': chat['id'], 'conversation_id': chat['conversation_id']}
+                yield 'conversation.message.delta', json.dumps(message, ensure_ascii=False)
+            completed = dict(chat, status='completed',
+                             usage={'token_count': 96, 'output_count': 64, 'input_count': 32})
+            yield 'conversation.chat.completed', json.dumps(completed)
+            yield 'done', '"[DONE]"'
+
+        self._send_sse(events())
+
+
+StubHandler.routes = [
+    ('POST', r'/api/paas/v4/chat/completions', 'glm_chat'),
+    ('POST', r'/api/paas/v4/images/generations', 'glm_images'),
+    ('POST', r'/api/paas/v4/videos/generations', 'glm_videos'),
+    ('GET', r'/api/paas/v4/async-result/(?P<task_id>[^/]+)', 'glm_async_result'),
+    ('POST', r'/compatible-mode/v1/chat/completions', 'compat_chat'),
+    ('POST', r'/compatible-mode/v1/files', 'compat_files'),
+    ('POST', r'/api/v1/services/aigc/text-generation/generation', 'dashscope_generation'),
+    ('POST', r'/api/v1/services/aigc/multimodal-generation/generation', 'dashscope_multimodal'),
+    ('POST', r'/api/v1/apps/(?P<app_id>[^/]+)/completion', 'dashscope_application'),
+    ('POST', r'/v3/chat', 'coze_chat'),
+]
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, behaviour, verbose=False):
+        super().__init__(address, StubHandler)
+        self.behaviour = behaviour
+        self.verbose = verbose
+
+
+def start_stub_servers(host, ports, behaviour, verbose=False):
+    """
+    每个平台一个端口，ports 形如 {'glm': 18001, 'dashscope': 18002, 'coze': 18003}
+    返回 (servers, 给网关用的地址配置)
+    """
+    servers = {}
+    for name, port in ports.items():
+        server = StubServer((host, port), behaviour, verbose=verbose)
+        threading.Thread(target=server.serve_forever, name=f'stub-{name}', daemon=True).start()
+        servers[name] = server
+
+    def base(name):
+        return f'http://{host}:{servers[name].server_address[1]}'
+
+    env = {
+        'GLM_BASE_URL': f'{base("glm")}/api/paas/v4',
+        'DASHSCOPE_COMPATIBLE_BASE_URL': f'{base("dashscope")}/compatible-mode/v1',
+        'DASHSCOPE_HTTP_BASE_URL': f'{base("dashscope")}/api/v1',
+        'COZE_BASE_URL': base('coze'),
+    }
+    return servers, env
@@ -0,0 +1,238 @@
+# ai_app/cancellation.py
+"""
+上游调用的截止时间和流式输出的取消
+- 截止时间：客户端可以用请求头 X-Request-Timeout（秒）声明最多等多久，不传时非流式接口用后台配置 API_TIMEOUT，
+  流式输出用 settings.UPSTREAM_DEADLINES['STREAM_SECONDS']；剩余时间作为超时传给上游 SDK，过了截止时间不再发起调用
+- 取消：客户端断开后 WSGI/ASGI 服务器会关闭响应，流式生成器在 yield 处收到 GeneratorExit，
+  UpstreamStream 在这时关闭上游的流式连接（上游停止生成、不再计费），工作线程立即释放
+- 用量：每次流式调用结束（正常、断开、超时、出错）都写一条 UpstreamUsage，断开时记录已生成部分的字数和音频字节数
+"""
+import logging
+import threading
+import time
+
+import httpx
+import openai
+import requests
+import zhipuai
+from constance import config
+from django.conf import settings
+from django.core.cache import cache
+
+from .tracing import current_trace
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_HEADER = 'HTTP_X_REQUEST_TIMEOUT'
+DEFAULT_TIMEOUT_CACHE_KEY = 'ai_app:api_timeout'
+DEFAULT_TIMEOUT_CACHE_SECONDS = 60
+
+STATUS_COMPLETED = 'completed'
+STATUS_DISCONNECTED = 'disconnected'
+STATUS_CANCELLED = 'cancelled'
+STATUS_DEADLINE = 'deadline'
+STATUS_ERROR = 'error'
+
+
+class DeadlineExceeded(Exception):
+    """已经超过请求的截止时间，不再调用上游"""
+
+
+# 各 SDK 的超时异常，视图里统一返回 504
+TIMEOUT_ERRORS = (
+    DeadlineExceeded,
+    requests.exceptions.Timeout,
+    httpx.TimeoutException,
+    openai.APITimeoutError,
+    zhipuai.APITimeoutError,
+)
+
+
+def options():
+    result = {
+        'STREAM_SECONDS': 300,
+        'MAX_SECONDS': 600,
+    }
+    result.update(getattr(settings, 'UPSTREAM_DEADLINES', {}))
+    return result
+
+
+# =============== 截止时间 ===============
+def default_timeout():
+    """后台配置的 API_TIMEOUT；constance 是数据库后端，每次读取都要查库，这里缓存起来，后台修改后清除"""
+    seconds = cache.get(DEFAULT_TIMEOUT_CACHE_KEY)
+    if seconds is None:
+        seconds = float(config.API_TIMEOUT)
+        cache.set(DEFAULT_TIMEOUT_CACHE_KEY, seconds, DEFAULT_TIMEOUT_CACHE_SECONDS)
+    return seconds
+
+
+def clear_default_timeout():
+    cache.delete(DEFAULT_TIMEOUT_CACHE_KEY)
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def timeout(self):
+        """传给上游 SDK 的超时秒数；已经超时的直接抛 DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f'已超过请求截止时间（{self.seconds:g}秒）')
+        return remaining
+
+
+def request_deadline(request, stream=False):
+    """
+    按请求头 X-Request-Timeout 建立截止时间，从视图开始执行时算起
+    头缺失或不合法时用默认值，不超过 MAX_SECONDS
+    """
+    opts = options()
+    try:
+        seconds = float(request.META.get(TIMEOUT_HEADER) or 0)
+    except (TypeError, ValueError):
+        seconds = 0
+    if not seconds > 0:
+        seconds = opts['STREAM_SECONDS'] if stream else default_timeout()
+    return Deadline(min(seconds, opts['MAX_SECONDS']))
+
+
+class CancelToken:
+    """跨线程的取消标记，和 threading.Event 一样用 is_set() 判断，另外记录取消原因"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason=STATUS_CANCELLED):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+
+# =============== 用量记录 ===============
+class StreamUsage:
+    """一次流式调用的用量，上游最后一块带 usage 时记录 token 数，中途结束的只有字数和音频字节数"""
+
+    def __init__(self, endpoint, model, user_id=None):
+        self.endpoint = endpoint
+        self.model = model
+        self.user_id = user_id
+        self.status = STATUS_COMPLETED
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.total_tokens = None
+        self.chunks = 0
+        self.text_chars = 0
+        self.audio_bytes = 0
+        self.started = time.monotonic()
+        # 流式输出在中间件返回后才结束，先记下请求追踪，结束时把 token 数写回去（限流按用量扣预算）
+        self.trace = current_trace()
+
+    def observe(self, chunk):
+        self.chunks += 1
+        usage = getattr(chunk, 'usage', None)
+        if usage:
+            self.set_tokens(usage)
+
+    def set_tokens(self, usage):
+        self.prompt_tokens = getattr(usage, 'prompt_tokens', None)
+        self.completion_tokens = getattr(usage, 'completion_tokens', None)
+        self.total_tokens = getattr(usage, 'total_tokens', None)
+
+    def add(self, kind, value):
+        """记录一项输出，kind/value 同 omni.iter_deltas；音频按 base64 长度折算字节数"""
+        if kind == 'audio':
+            self.audio_bytes += len(value) * 3 // 4
+        else:
+            self.text_chars += len(value)
+
+    def save(self):
+        from .models import UpstreamUsage
+
+        if self.trace is not None and self.total_tokens:
+            self.trace.annotate(tokens=self.total_tokens)
+        try:
+            UpstreamUsage.objects.create(
+                endpoint=self.endpoint,
+                model=self.model,
+                user_id=self.user_id,
+                status=self.status,
+                prompt_tokens=self.prompt_tokens,
+                completion_tokens=self.completion_tokens,
+                total_tokens=self.total_tokens,
+                chunks=self.chunks,
+                text_chars=self.text_chars,
+                audio_bytes=self.audio_bytes,
+                duration_ms=int((time.monotonic() - self.started) * 1000),
+            )
+        except Exception:
+            # 记录失败不影响响应
+            logger.exception('上游用量记录写入失败: %s', self.endpoint)
+
+
+# =============== 流式调用 ===============
+def close_upstream(stream):
+    """关闭上游流式响应的连接，SDK 没有 close 的忽略"""
+    close = getattr(stream, 'close', None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception:
+        logger.warning('关闭上游流式连接失败', exc_info=True)
+
+
+class UpstreamStream:
+    """
+    包装上游的流式响应，必须用 with：
+        with UpstreamStream(completion, usage, deadline) as upstream:
+            for chunk in upstream: ...
+    每块之后检查截止时间和取消标记，到了就停止迭代；退出 with 时关闭上游连接并写用量记录
+    with 块里收到 GeneratorExit（客户端断开）记为 disconnected，其他异常记为 error
+    """
+
+    def __init__(self, completion, usage, deadline=None, token=None):
+        self.completion = completion
+        self.usage = usage
+        self.deadline = deadline
+        self.token = token
+
+    @property
+    def status(self):
+        return self.usage.status
+
+    def __iter__(self):
+        for chunk in self.completion:
+            self.usage.observe(chunk)
+            yield chunk
+            if self.token is not None and self.token.is_set():
+                self.usage.status = self.token.reason or STATUS_CANCELLED
+                return
+            if self.deadline is not None and self.deadline.expired():
+                self.usage.status = STATUS_DEADLINE
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is GeneratorExit:
+            self.usage.status = STATUS_DISCONNECTED
+        elif exc_type is not None:
+            self.usage.status = STATUS_DEADLINE if issubclass(exc_type, TIMEOUT_ERRORS) else STATUS_ERROR
+        close_upstream(self.completion)
+        self.usage.save()
+        return False
+
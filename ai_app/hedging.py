@@ -0,0 +1,334 @@
+# ai_app/hedging.py
+"""
+对冲请求（客户端传 hedge=true 或请求头 X-Hedge: 1 时启用，只对 ENDPOINTS 里的接口生效）
+- 先发一次上游调用，超过阈值还没返回就再发一次相同的请求（后台“所有接口配置”里设了对冲备用模型时发给备用模型）
+- 阈值取这个接口、这个模型最近调用耗时的 PERCENTILE 分位（样本不够时用 DEFAULT_DELAY），慢的那一小部分才会对冲
+- 先成功返回的为准，另一个立即断开连接（上游停止处理，密钥和排队空位马上归还），不会再重试
+- 对冲次数不超过最近 WINDOW 秒内对冲模式调用数的 MAX_RATE（另加 BURST 次），额外的上游费用有上限
+对冲模式的调用走单独的 httpx 连接（断开时要关掉底层 socket），每次调用都要新建连接，正常延迟略高
+"""
+import copy
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpcore
+import httpx
+from django.conf import settings
+
+from .tracing import annotate
+from .workers import with_request_context
+
+logger = logging.getLogger(__name__)
+
+HEDGE_HEADER = 'HTTP_X_HEDGE'
+
+
+def options():
+    result = {
+        'ENABLED': True,
+        'ENDPOINTS': ('glm-4-api', 'qwen-chat-api'),
+        'PERCENTILE': 0.9,
+        'MIN_SAMPLES': 20,
+        'SAMPLES': 200,
+        'DEFAULT_DELAY': 3.0,
+        'MIN_DELAY': 0.5,
+        'MAX_RATE': 0.1,
+        'BURST': 2,
+        'WINDOW': 60,
+        'WORKERS': 32,
+    }
+    result.update(getattr(settings, 'HEDGING', {}))
+    return result
+
+
+def wanted(request):
+    """这个请求是否走对冲模式"""
+    opts = options()
+    match = request.resolver_match
+    if not opts['ENABLED'] or match is None or match.view_name not in opts['ENDPOINTS']:
+        return False
+    flag = request.META.get(HEDGE_HEADER) or request.data.get('hedge')
+    return str(flag).lower() in ('1', 'true', 'yes')
+
+
+def equivalent_model(model):
+    """后台给这个模型设置的对冲备用模型（同类型），没有时返回None"""
+    from .models import ModelInfo
+
+    info = ModelInfo.objects.filter(model=model, hedge_model__isnull=False).select_related('hedge_model').first()
+    return info.hedge_model.model if info is not None else None
+
+
+# =============== 阈值和对冲配额 ===============
+_lock = threading.Lock()
+_latencies = defaultdict(deque)
+_calls = deque()
+_hedges = deque()
+
+
+def observe(key, seconds):
+    """记录一次上游调用耗时，key 为 (接口, 模型)"""
+    samples = options()['SAMPLES']
+    with _lock:
+        latencies = _latencies[key]
+        latencies.append(seconds)
+        while len(latencies) > samples:
+            latencies.popleft()
+
+
+def threshold(key):
+    opts = options()
+    with _lock:
+        latencies = sorted(_latencies.get(key, ()))
+    if len(latencies) < opts['MIN_SAMPLES']:
+        return opts['DEFAULT_DELAY']
+    return max(opts['MIN_DELAY'], latencies[min(len(latencies) - 1, int(len(latencies) * opts['PERCENTILE']))])
+
+
+def _prune(events, now, window):
+    while events and events[0] < now - window:
+        events.popleft()
+
+
+def _allow_hedge():
+    opts = options()
+    now = time.monotonic()
+    with _lock:
+        _prune(_calls, now, opts['WINDOW'])
+        _prune(_hedges, now, opts['WINDOW'])
+        if len(_hedges) >= opts['MAX_RATE'] * len(_calls) + opts['BURST']:
+            return False
+        _hedges.append(now)
+        return True
+
+
+# =============== 可以中途断开的连接 ===============
+_ssl_context = None
+
+
+def _get_ssl_context():
+    # 加载 CA 证书约 20ms CPU，所有对冲连接共用一个
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return _ssl_context
+
+
+class _TrackedStream(httpcore.NetworkStream):
+    """记录连接用到的 socket（TLS 握手后换成新的 socket 对象）"""
+
+    def __init__(self, stream, backend):
+        self._stream = stream
+        self._backend = backend
+        backend.track(stream.get_extra_info('socket'))
+
+    def read(self, max_bytes, timeout=None):
+        return self._stream.read(max_bytes, timeout)
+
+    def write(self, buffer, timeout=None):
+        self._stream.write(buffer, timeout)
+
+    def close(self):
+        self._stream.close()
+
+    def start_tls(self, ssl_context, server_hostname=None, timeout=None):
+        return _TrackedStream(self._stream.start_tls(ssl_context, server_hostname, timeout), self._backend)
+
+    def get_extra_info(self, info):
+        return self._stream.get_extra_info(info)
+
+
+class _AbortableBackend(httpcore.SyncBackend):
+    """
+    在另一个线程里关闭 socket 不会唤醒阻塞在 recv 上的线程，要用 shutdown
+    abort 后已有的连接立即报错，新连接直接失败
+    """
+
+    def __init__(self):
+        self._sockets = []
+        self._lock = threading.Lock()
+        self.aborted = False
+
+    def track(self, sock):
+        with self._lock:
+            self._sockets.append(sock)
+            aborted = self.aborted
+        if aborted:
+            _shutdown(sock)
+
+    def connect_tcp(self, *args, **kwargs):
+        if self.aborted:
+            raise httpcore.ConnectError('对冲请求已取消')
+        return _TrackedStream(super().connect_tcp(*args, **kwargs), self)
+
+    def abort(self):
+        with self._lock:
+            self.aborted = True
+            sockets = list(self._sockets)
+        for sock in sockets:
+            _shutdown(sock)
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        # 已经关闭，或是 TLS 握手前被替换掉的原始 socket
+        pass
+
+
+_CORE_ERRORS = (httpcore.TimeoutException, httpcore.NetworkError, httpcore.ProtocolError, httpcore.ProxyError)
+
+
+def _transport_error(exc, request):
+    """httpcore 的异常换成 httpx 同名的异常（call_with_retry 按 httpx 的异常类型判断超时、连接错误）"""
+    error_class = getattr(httpx, type(exc).__name__, None)
+    if not (isinstance(error_class, type) and issubclass(error_class, httpx.TransportError)):
+        error_class = httpx.TransportError
+    return error_class(str(exc), request=request)
+
+
+class _ResponseStream(httpx.SyncByteStream):
+    def __init__(self, stream, request):
+        self._stream = stream
+        self._request = request
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        except _CORE_ERRORS as e:
+            raise _transport_error(e, self._request) from e
+
+    def close(self):
+        self._stream.close()
+
+
+class _AbortableTransport(httpx.BaseTransport):
+    """
+    httpx 的 HTTPTransport 不能指定 network_backend，这里直接用自己的 httpcore 连接池
+    只用 httpx / httpcore 的公开接口，升级版本不会悄悄换回不能中断的连接
+    """
+
+    def __init__(self, backend):
+        self._pool = httpcore.ConnectionPool(ssl_context=_get_ssl_context(), network_backend=backend)
+
+    def handle_request(self, request):
+        url = request.url
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=url.raw_scheme, host=url.raw_host, port=url.port, target=url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        try:
+            response = self._pool.handle_request(core_request)
+        except _CORE_ERRORS as e:
+            raise _transport_error(e, request) from e
+        return httpx.Response(status_code=response.status, headers=response.headers,
+                              stream=_ResponseStream(response.stream, request), extensions=response.extensions)
+
+    def close(self):
+        self._pool.close()
+
+
+class Attempt:
+    """一次对冲模式的上游调用：独立的连接和截止时间，cancel 后连接断开、截止时间立即到期（call_with_retry 不再重试）"""
+
+    def __init__(self, deadline, model):
+        self.deadline = copy.copy(deadline)
+        self.model = model
+        self.started = time.monotonic()
+        self._backend = _AbortableBackend()
+        self.client = httpx.Client(transport=_AbortableTransport(self._backend))
+
+    def post(self, url, api_key, data, timeout):
+        """POST JSON，非2xx抛 httpx.HTTPStatusError"""
+        response = self.client.post(url, json=data, timeout=timeout,
+                                    headers={'Authorization': f'Bearer {api_key}'})
+        response.raise_for_status()
+        return response
+
+    @property
+    def cancelled(self):
+        return self._backend.aborted
+
+    def cancel(self):
+        self.deadline.expires = time.monotonic()
+        self._backend.abort()
+
+    def close(self):
+        self.client.close()
+
+
+# =============== 对冲调用 ===============
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=options()['WORKERS'], thread_name_prefix='hedge')
+        return _executor
+
+
+def _submit(fn, attempt, key):
+    def run():
+        try:
+            result = fn(attempt, attempt.model)
+        except Exception:
+            if attempt.cancelled:
+                # 被取消时已经等了这么久，按这个耗时计入，避免阈值越算越低
+                observe(key, time.monotonic() - attempt.started)
+            raise
+        else:
+            observe(key, time.monotonic() - attempt.started)
+            return result
+        finally:
+            attempt.close()
+
+    # 线程里沿用请求的追踪、排队通道等上下文
+    return _get_executor().submit(with_request_context(run))
+
+
+def run(key, fn, deadline, model):
+    """
+    key: (接口, 模型)，按它统计耗时
+    fn(attempt, model): 调用一次上游并返回结果，用 attempt.post 发请求、attempt.deadline 作截止时间
+    返回先成功的结果；都失败时抛主请求的异常
+    """
+    with _lock:
+        _calls.append(time.monotonic())
+    primary = Attempt(deadline, model)
+    first = _submit(fn, primary, key)
+    delay = threshold(key)
+    remaining = deadline.remaining()
+    if remaining <= delay:
+        # 等到阈值时截止时间已经用完，对冲请求发出去也来不及返回，白占对冲预算和上游
+        return first.result()
+    done, _ = wait([first], timeout=delay)
+    if done or not _allow_hedge():
+        return first.result()
+
+    hedge_model = equivalent_model(model) or model
+    logger.info('上游 %.2f 秒未返回，发出对冲请求（%s）', delay, hedge_model, extra={'endpoint': key[0]})
+    annotate(hedged=hedge_model)
+    second = Attempt(deadline, hedge_model)
+    attempts = {first: primary, _submit(fn, second, (key[0], hedge_model)): second}
+    pending = set(attempts)
+    winner = None
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winner = next((future for future in done if future.exception() is None), None)
+    for future in pending:
+        attempts[future].cancel()
+    if winner is None:
+        return first.result()
+    annotate(hedge_winner='hedge' if attempts[winner] is second else 'primary')
+    return winner.result()
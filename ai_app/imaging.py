@@ -0,0 +1,193 @@
+# ai_app/imaging.py
+"""
+视觉/OCR接口的图片预处理
+上游模型会把图片缩到自己的像素上限（如 qwen-vl-ocr 的 max_pixels=28*28*1280），手机原图传上去大部分像素都被丢掉，
+这里先在本地按同样的上限解码、按EXIF转正、缩小并重新编码，上传体积通常能小好几倍，识别效果不变
+每个模型的参数取自 ModelInfo（后台“所有接口配置”），没有配置的用 settings.IMAGE_PROFILES
+"""
+import base64
+import io
+import logging
+import math
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+PROFILE_CACHE_SECONDS = 60
+_DATA_URL_RE = re.compile(r'^data:(?P<mime>[\w.+/-]+);base64,(?P<data>.+)$', re.S)
+_FORMAT_MIME = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+# 无损格式的原图：截图、扫描件里的细小文字经有损压缩会糊
+LOSSLESS_FORMATS = ('PNG', 'BMP', 'GIF', 'TIFF')
+
+
+def get_profile(model):
+    """模型的预处理参数：ModelInfo 里填了的字段优先，其余取 settings.IMAGE_PROFILES[模型] 或 ['default']"""
+    cache_key = f'ai_app:image_profile:{model}'
+    profile = cache.get(cache_key)
+    if profile is not None:
+        return profile
+
+    from .models import ModelInfo
+
+    defaults = getattr(settings, 'IMAGE_PROFILES', {})
+    profile = {'MAX_PIXELS': 28 * 28 * 1280, 'FORMAT': 'JPEG', 'QUALITY': 85, 'MIN_BYTES': 0, 'KEEP_LOSSLESS': False}
+    profile.update(defaults.get('default', {}))
+    profile.update(defaults.get(model, {}))
+    info = (ModelInfo.objects.filter(model=model)
+            .values('image_max_pixels', 'image_format', 'image_quality').first())
+    if info:
+        if info['image_max_pixels']:
+            profile['MAX_PIXELS'] = info['image_max_pixels']
+        if info['image_format']:
+            profile['FORMAT'] = info['image_format']
+        if info['image_quality']:
+            profile['QUALITY'] = info['image_quality']
+    cache.set(cache_key, profile, PROFILE_CACHE_SECONDS)
+    return profile
+
+
+def clear_profile(model):
+    cache.delete(f'ai_app:image_profile:{model}')
+
+
+def _flatten(image):
+    """JPEG 不支持透明通道，透明部分铺白底"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def _orientation(image):
+    """EXIF方向；PNG 的 getexif 找不到文件头里的 eXIf 块时会解码整张图去找，截图一般没有，直接当作不用转"""
+    if image.format == 'PNG' and 'exif' not in image.info:
+        return 1
+    return image.getexif().get(0x0112, 1)
+
+
+def encode_image(image, profile, lossless=False):
+    """按 profile 的格式和质量编码，返回 (图片字节, MIME类型)；lossless 为 True 时编码成 PNG"""
+    fmt = 'PNG' if lossless else profile['FORMAT'].upper()
+    if fmt == 'JPEG':
+        image = _flatten(image)
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=profile['QUALITY'])
+    return buffer.getvalue(), _FORMAT_MIME.get(fmt, 'image/jpeg')
+
+
+def preprocess_image(data, profile):
+    """
+    返回 (图片字节, MIME类型)
+    解码失败或重新编码后反而更大（纯色截图之类 PNG 压得很小的图）时原样返回，上游自己会缩放；
+    MIME 为None表示沿用调用方原来的类型
+    缩小和重新编码要花 20~60ms CPU（百万像素级），只在超过像素上限、需要转正或图片较大时做
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        max_pixels = profile['MAX_PIXELS']
+        scale = min(1.0, math.sqrt(max_pixels / (width * height))) if width and height else 1.0
+        lossless = profile.get('KEEP_LOSSLESS') and image.format in LOSSLESS_FORMATS
+        # 不用缩小、不用转正时，本身已是有损压缩格式、要保持无损、或者本来就不大的，直接用原图
+        if scale >= 1.0 and _orientation(image) == 1 and (
+                image.format in ('JPEG', 'WEBP') or lossless or len(data) < profile.get('MIN_BYTES', 0)):
+            return data, None
+        target = (max(1, int(width * scale)), max(1, int(height * scale)))
+        # JPEG 直接按缩小后的尺寸解码，大照片省很多时间和内存
+        image.draft('RGB', target)
+        image = ImageOps.exif_transpose(image)
+        if scale < 1.0:
+            # exif_transpose 旋转90度后宽高对调，目标尺寸跟着对调
+            if (image.size[0] < image.size[1]) != (target[0] < target[1]):
+                target = target[::-1]
+            image.thumbnail(target, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        encoded, mime = encode_image(image, profile, lossless)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+        logger.warning('图片预处理失败，使用原图: %s', e)
+        return data, None
+
+    if len(encoded) >= len(data):
+        return data, None
+    return encoded, mime
+
+
+def split_tall_image(data, profile, tall_ratio=2.0, overlap=0.1):
+    """
+    长图（高宽比超过 tall_ratio 且超过像素上限，如长截图、小票）按从上到下切成有重叠的块，返回 [(图片字节, MIME类型)]
+    整张缩到像素上限时文字会小到认不出，切块后每块按接近正方形、恰好用满上限的尺寸识别
+    相邻块重叠 overlap（块高的比例），保证被切开的那一行至少在一块里是完整的；不是长图的返回单元素列表
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        lossless = profile.get('KEEP_LOSSLESS') and image.format in LOSSLESS_FORMATS
+        if _orientation(image) in (5, 6, 7, 8):
+            width, height = height, width
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+        logger.warning('图片预处理失败，使用原图: %s', e)
+        return [(data, None)]
+
+    max_pixels = profile['MAX_PIXELS']
+    if not width or height / width <= tall_ratio or width * height <= max_pixels:
+        return [preprocess_image(data, profile)]
+
+    tile_width = min(width, math.isqrt(max_pixels))
+    scale = tile_width / width
+    scaled_height = max(1, round(height * scale))
+    tile_height = min(max_pixels // tile_width, scaled_height)
+    overlap_px = int(tile_height * overlap)
+    # 满足最小重叠所需的最少块数，再把块均匀分布，避免最后剩一条很窄的块
+    count = 1 if scaled_height <= tile_height else \
+        math.ceil((scaled_height - overlap_px) / max(1, tile_height - overlap_px))
+    tops = [round(index * (scaled_height - tile_height) / (count - 1)) for index in range(count)] if count > 1 else [0]
+    try:
+        image.draft('RGB', (tile_width, scaled_height))
+        image = ImageOps.exif_transpose(image)
+        if image.size != (tile_width, scaled_height):
+            image = image.resize((tile_width, scaled_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        return [encode_image(image.crop((0, top, tile_width, top + tile_height)), profile, lossless)
+                for top in tops]
+    except (Image.DecompressionBombError, OSError, ValueError) as e:
+        logger.warning('长图切块失败，整张识别: %s', e)
+        return [preprocess_image(data, profile)]
+
+
+def preprocess_base64(value, profile, default_mime='image/jpeg'):
+    """处理 base64 字符串或 data URL，返回 data URL；不是base64的（如 http 地址）原样返回"""
+    match = _DATA_URL_RE.match(value)
+    mime, payload = (match.group('mime'), match.group('data')) if match else (default_mime, value)
+    try:
+        data = base64.b64decode(payload, validate=False)
+    except (ValueError, TypeError):
+        return value
+    if not data:
+        return value
+    processed, new_mime = preprocess_image(data, profile)
+    if new_mime is None:
+        return value if match else f"data:{mime};base64,{payload}"
+    return f"data:{new_mime};base64,{base64.b64encode(processed).decode('ascii')}"
+
+
+def preprocess_messages(messages, profile):
+    """OpenAI 格式消息里 image_url 是 data URL 的图片逐个预处理，返回处理过的字节数变化 (原始, 处理后)"""
+    before = after = 0
+    for message in messages:
+        content = message.get('content') if isinstance(message, dict) else None
+        if not isinstance(content, list):
+            continue
+        for item in content:
+            image_url = item.get('image_url') if isinstance(item, dict) else None
+            url = image_url.get('url') if isinstance(image_url, dict) else None
+            if not isinstance(url, str) or not url.startswith('data:'):
+                continue
+            processed = preprocess_base64(url, profile)
+            before += len(url)
+            after += len(processed)
+            image_url['url'] = processed
+    return before, after
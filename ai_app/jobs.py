@@ -0,0 +1,453 @@
+# ai_app/jobs.py
+"""
+异步任务：长时间的调用（长文档对话、语音识别、文生图等）带 async=true 提交时立即返回任务ID，不占着同步 worker 等上游
+- 提交：查询参数 ?async=true、请求头 X-Async: 1，或 JSON / 表单里的 async 字段
+  multipart 上传只能用前两种，表单里带 async 字段时返回 400（文件已经解析，原始请求体没法保存）
+  限流、登录和 CSRF 检查照常在提交时做；原始请求（请求体、请求头、用户、会话）存进 AsyncJob 表，返回 202
+- 执行：python manage.py run_jobs 启动 PROCESSES 个 worker 进程，从数据库领取最早的任务，按原请求调用同一个视图
+  领取用条件更新（状态和租约都没变才算领到），多个进程、多台机器同时领取也不会重复执行
+- 租约：执行期间每 HEARTBEAT_SECONDS 秒续期到 LEASE_SECONDS 秒后；worker 进程崩溃、机器重启后租约到期，
+  任务由其他 worker 重新领取，最多执行 MAX_ATTEMPTS 次；视图本身抛异常的不重试
+- 结果：GET /jobs/<任务ID>/?wait=秒数，完成时原样返回视图的响应（状态码、类型、内容），未完成返回 202；
+  wait 最多 LONG_POLL_SECONDS 秒，期间完成立即返回；只有提交者（登录用户或同一IP）和管理员能查询
+- 完成超过 RETENTION_SECONDS 秒的任务由 worker 定时删除
+不需要 Redis / Celery 等消息队列，单机部署直接用现有数据库；上游调用在 batch 通道排队（ai_app.scheduler）
+"""
+import io
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections, connections
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse
+from django.http.multipartparser import MultiPartParserError
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from . import scheduler
+from .cancellation import TIMEOUT_HEADER
+from .ratelimit import ENDPOINTS as MODEL_ENDPOINTS, charge_tokens, get_limits, identity, options as rate_options
+from .tracing import background_trace
+
+logger = logging.getLogger(__name__)
+
+ASYNC_HEADER = 'HTTP_X_ASYNC'
+# 不保存到数据库的请求头（登录凭据），worker 里按保存的用户和会话执行
+SKIPPED_HEADERS = ('HTTP_COOKIE', 'HTTP_AUTHORIZATION')
+
+
+def options():
+    result = {
+        'ENABLED': True,
+        # 可以异步执行的接口（URL name），None 为所有调用上游模型的接口
+        'ENDPOINTS': None,
+        'PROCESSES': 2,
+        'LEASE_SECONDS': 60,
+        'HEARTBEAT_SECONDS': 15,
+        'MAX_ATTEMPTS': 2,
+        'POLL_SECONDS': 1,
+        'TIMEOUT': 600,
+        'LONG_POLL_SECONDS': 30,
+        'RETENTION_SECONDS': 24 * 3600,
+        'MAX_BODY_BYTES': 50 * 1024 * 1024,
+    }
+    result.update(getattr(settings, 'ASYNC_JOBS', {}))
+    return result
+
+
+def _flag(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def wanted(request):
+    """请求是否要求异步执行；multipart 请求不读请求体（读了就没法原样保存）"""
+    if _flag(request.GET.get('async')) or _flag(request.META.get(ASYNC_HEADER)):
+        return True
+    if request.content_type not in ('application/json', 'application/x-www-form-urlencoded'):
+        return False
+    # 请求体里没有 async 字样就不解析（图片的 base64 可能有几MB）
+    if b'async' not in request.body:
+        return False
+    if request.content_type == 'application/x-www-form-urlencoded':
+        return _flag(request.POST.get('async'))
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return False
+    return isinstance(data, dict) and _flag(data.get('async'))
+
+
+def _multipart_async(request):
+    """
+    multipart 表单里是否带了 async 字段；解析后的 POST/FILES 留在请求上，视图（包括 DRF）直接复用，不会解析两次
+    解析出错时返回 False，由视图按原来的方式报错
+    """
+    if request.content_type != 'multipart/form-data':
+        return False
+    try:
+        return _flag(request.POST.get('async'))
+    except MultiPartParserError:
+        return False
+
+
+def _error(message, status):
+    return JsonResponse({'error': message}, status=status, json_dumps_params={'ensure_ascii': False})
+
+
+# =============== 提交 ===============
+def _check_csrf(request):
+    """视图不执行，DRF 的 CSRF 检查要在这里做（会话登录的用户才检查）"""
+    from rest_framework.authentication import SessionAuthentication
+    from rest_framework.exceptions import PermissionDenied
+    from rest_framework.request import Request
+
+    try:
+        SessionAuthentication().authenticate(Request(request))
+    except PermissionDenied as e:
+        return _error(str(e.detail), 403)
+    return None
+
+
+def submit(request, endpoint, opts):
+    from .models import AsyncJob
+
+    if int(request.META.get('CONTENT_LENGTH') or 0) > opts['MAX_BODY_BYTES']:
+        return _error(f'异步任务的请求体不能超过 {opts["MAX_BODY_BYTES"]} 字节', 413)
+    # JSON 和表单的请求体在 wanted 里已经读过；multipart 直接读原始数据，不解析上传的文件
+    body = request.read() if request.content_type == 'multipart/form-data' else request.body
+    denied = _check_csrf(request)
+    if denied is not None:
+        return denied
+
+    headers = {key: value for key, value in request.META.items()
+               if key.startswith('HTTP_') and key not in SKIPPED_HEADERS and isinstance(value, str)}
+    headers['REMOTE_ADDR'] = request.META.get('REMOTE_ADDR', '')
+    session = getattr(request, 'session', None)
+    user = getattr(request, 'user', None)
+    job = AsyncJob.objects.create(
+        endpoint=endpoint,
+        method=request.method,
+        path=request.path_info,
+        query_string=request.META.get('QUERY_STRING', ''),
+        content_type=request.META.get('CONTENT_TYPE', ''),
+        request_body=body,
+        request_headers=headers,
+        user=user if user is not None and user.is_authenticated else None,
+        session_key=(session.session_key or '') if session is not None else '',
+        owner=identity(request),
+    )
+    url = reverse('async-job', args=[job.pk])
+    response = JsonResponse({'job_id': str(job.pk), 'status': job.status, 'result_url': url}, status=202)
+    response['Location'] = url
+    return response
+
+
+class AsyncJobMiddleware:
+    """
+    async=true 的请求存为异步任务，不执行视图；放在 RateLimitMiddleware 之后（提交时照常限流）
+    settings.ASYNC_JOBS['ENABLED'] 为 False 时不加载
+    """
+
+    def __init__(self, get_response):
+        if not options()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match is None or request.method != 'POST':
+            return None
+        opts = options()
+        endpoints = opts['ENDPOINTS'] if opts['ENDPOINTS'] is not None else MODEL_ENDPOINTS
+        if match.view_name not in endpoints:
+            return None
+        if wanted(request):
+            return submit(request, match.view_name, opts)
+        if _multipart_async(request):
+            return _error('上传文件的请求请用查询参数 ?async=true 或请求头 X-Async: 1 提交异步任务', 400)
+        return None
+
+
+# =============== 领取 ===============
+def claim(worker, opts=None):
+    """领取最早的排队任务，或租约已到期（执行它的 worker 退出了）的任务；没有返回None"""
+    from .models import AsyncJob
+
+    opts = opts or options()
+    while True:
+        now = timezone.now()
+        candidate = (AsyncJob.objects
+                     .filter(Q(status=AsyncJob.QUEUED) | Q(status=AsyncJob.RUNNING, lease_expires__lt=now))
+                     .order_by('created_at')
+                     .values('pk', 'status', 'lease_expires', 'attempts')
+                     .first())
+        if candidate is None:
+            return None
+        current = AsyncJob.objects.filter(pk=candidate['pk'], status=candidate['status'],
+                                          lease_expires=candidate['lease_expires'])
+        if candidate['attempts'] >= opts['MAX_ATTEMPTS']:
+            # 已经执行过 MAX_ATTEMPTS 次都中途退出，不再重试
+            current.update(status=AsyncJob.FAILED, finished_at=now, lease_expires=None,
+                           error=f'worker 执行中退出 {candidate["attempts"]} 次，不再重试')
+            continue
+        # 状态和租约都没变才算领到，别的 worker 抢先领取时 update 返回0
+        if current.update(status=AsyncJob.RUNNING, worker=worker, attempts=candidate['attempts'] + 1,
+                          started_at=now, lease_expires=now + timedelta(seconds=opts['LEASE_SECONDS'])):
+            return AsyncJob.objects.select_related('user').get(pk=candidate['pk'])
+
+
+class _Heartbeat(threading.Thread):
+    """执行期间定时续租约"""
+
+    def __init__(self, job_id, worker, opts):
+        super().__init__(name=f'job-heartbeat-{job_id}', daemon=True)
+        self.job_id = job_id
+        self.worker = worker
+        self.opts = opts
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        from .models import AsyncJob
+
+        try:
+            while not self.stopped.wait(self.opts['HEARTBEAT_SECONDS']):
+                expires = timezone.now() + timedelta(seconds=self.opts['LEASE_SECONDS'])
+                if not AsyncJob.objects.filter(pk=self.job_id, worker=self.worker,
+                                               status=AsyncJob.RUNNING).update(lease_expires=expires):
+                    # 续期太晚，任务已被别的 worker 领走，这次的结果不再保存
+                    self.lost = True
+                    return
+        finally:
+            connections.close_all()
+
+    def stop(self):
+        self.stopped.set()
+
+
+# =============== 执行 ===============
+def build_request(job, opts):
+    """按保存的原始请求重建 Django 请求"""
+    body = bytes(job.request_body or b'')
+    environ = {
+        'REQUEST_METHOD': job.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': job.path,
+        'QUERY_STRING': job.query_string,
+        'CONTENT_TYPE': job.content_type,
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        **job.request_headers,
+    }
+    # 异步任务的截止时间比同步请求长，客户端指定了的按客户端的（不超过 UPSTREAM_DEADLINES['MAX_SECONDS']）
+    environ.setdefault(TIMEOUT_HEADER, str(opts['TIMEOUT']))
+    request = WSGIRequest(environ)
+    # CSRF 已在提交时检查
+    request._dont_enforce_csrf_checks = True
+    request.user = job.user or AnonymousUser()
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore(job.session_key or None)
+    return request
+
+
+def _response_body(response):
+    if response.streaming:
+        try:
+            return b''.join(response.streaming_content)
+        finally:
+            response.close()
+    if callable(getattr(response, 'render', None)):
+        # DRF 的 Response 要先渲染
+        response.render()
+    return response.content
+
+
+def execute(job, worker, opts=None):
+    """执行一个已领取的任务，保存结果"""
+    from .models import AsyncJob
+
+    opts = opts or options()
+    heartbeat = _Heartbeat(job.pk, worker, opts)
+    heartbeat.start()
+    result = {}
+    started = time.monotonic()
+    try:
+        request = build_request(job, opts)
+        match = resolve(job.path)
+        request.resolver_match = match
+        with background_trace(job.method, job.path) as trace, \
+                scheduler.bind(scheduler.Job(scheduler.BATCH, job.owner)):
+            response = match.func(request, *match.args, **match.kwargs)
+            body = _response_body(response)
+        if request.session.modified and job.session_key:
+            request.session.save()
+        result = {
+            'status': AsyncJob.DONE,
+            'status_code': response.status_code,
+            'response_content_type': response.get('Content-Type', ''),
+            'response_body': body,
+        }
+        _charge_tokens(job, trace.meta.get('tokens'))
+    except Exception as e:
+        logger.exception('异步任务执行出错', extra={'job': str(job.pk), 'endpoint': job.endpoint})
+        result = {'status': AsyncJob.FAILED, 'status_code': 500, 'error': f'{type(e).__name__}: {e}'}
+    finally:
+        heartbeat.stop()
+        heartbeat.join()
+
+    saved = AsyncJob.objects.filter(pk=job.pk, worker=worker, status=AsyncJob.RUNNING).update(
+        finished_at=timezone.now(), lease_expires=None, **result)
+    if not saved or heartbeat.lost:
+        logger.warning('异步任务租约已过期，结果未保存', extra={'job': str(job.pk), 'endpoint': job.endpoint})
+    logger.info('异步任务结束', extra={'job': str(job.pk), 'endpoint': job.endpoint, 'status': result.get('status'),
+                                   'duration_ms': round((time.monotonic() - started) * 1000, 1)})
+
+
+def _charge_tokens(job, tokens):
+    """按上游用量扣提交者的 token 预算（同步请求由 RateLimitMiddleware 在响应后扣）"""
+    opts = rate_options()
+    limits = get_limits(job.endpoint, opts) if opts['ENABLED'] else None
+    if limits:
+        charge_tokens(job.endpoint, job.owner, limits, opts['PERIOD'], tokens)
+
+
+def purge_finished(opts=None):
+    from .models import AsyncJob
+
+    opts = opts or options()
+    cutoff = timezone.now() - timedelta(seconds=opts['RETENTION_SECONDS'])
+    deleted, _ = AsyncJob.objects.filter(status__in=(AsyncJob.DONE, AsyncJob.FAILED), finished_at__lt=cutoff).delete()
+    return deleted
+
+
+# =============== worker 进程 ===============
+PURGE_SECONDS = 600
+
+
+def work(should_stop=None, once=False):
+    """
+    一个 worker 进程：循环领取任务执行，每次执行一个；should_stop() 返回 True 时执行完当前任务后退出
+    once=True 时没有可领取的任务就返回（测试、cron 用）
+    """
+    opts = options()
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    last_purge = 0
+    while should_stop is None or not should_stop():
+        if time.monotonic() - last_purge > PURGE_SECONDS:
+            last_purge = time.monotonic()
+            purge_finished(opts)
+        job = claim(worker, opts)
+        if job is None:
+            if once:
+                return
+            time.sleep(opts['POLL_SECONDS'])
+            continue
+        # 和请求一样，执行前后关掉过期或出错的数据库连接
+        close_old_connections()
+        try:
+            execute(job, worker, opts)
+        finally:
+            close_old_connections()
+
+
+def _child(parent):
+    signals = []
+    # Ctrl+C 由父进程处理后转发 SIGTERM；收到 SIGTERM 时执行完当前任务再退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: signals.append(signum))
+    # 父进程被强制杀掉时子进程也退出，不留孤儿进程
+    work(lambda: bool(signals) or os.getppid() != parent)
+
+
+def serve(processes):
+    """启动 processes 个 worker 进程，退出的自动重启；收到 SIGTERM / Ctrl+C 后等正在执行的任务结束再退出"""
+    # fork 前关掉数据库连接，子进程各自重新连接
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    signals = []
+    # 不用 multiprocessing.Event 通知子进程：子进程被 kill -9 时 Event.set() 会一直等它应答
+    signal.signal(signal.SIGTERM, lambda signum, frame: signals.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: signals.append(signum))
+    children = {}
+    while not signals:
+        for index in range(processes):
+            child = children.get(index)
+            if child is not None and child.is_alive():
+                continue
+            if child is not None:
+                # 执行中的任务租约到期后由其他 worker 重新领取
+                logger.warning('异步任务 worker 进程退出（%s），重新启动', child.exitcode)
+            child = context.Process(target=_child, args=(os.getpid(),), name=f'job-worker-{index}')
+            child.start()
+            children[index] = child
+        time.sleep(1)
+    for child in children.values():
+        if child.is_alive():
+            child.terminate()
+    for child in children.values():
+        child.join()
+
+
+# =============== 查询 ===============
+def job_result(request, job_id):
+    """GET /jobs/<任务ID>/?wait=秒数：完成时返回视图原来的响应，未完成返回 202 和任务状态"""
+    from .models import AsyncJob
+
+    if request.method != 'GET':
+        return _error('只支持 GET', 405)
+    opts = options()
+    try:
+        wait = min(max(float(request.GET.get('wait') or 0), 0), opts['LONG_POLL_SECONDS'])
+    except ValueError:
+        return _error('wait 必须是秒数', 400)
+
+    user = getattr(request, 'user', None)
+    jobs = AsyncJob.objects.filter(pk=job_id)
+    if user is None or not user.is_staff:
+        jobs = jobs.filter(owner=identity(request))
+    finished = (AsyncJob.DONE, AsyncJob.FAILED)
+    ends = time.monotonic() + wait
+    state = jobs.values('status', 'attempts', 'created_at', 'started_at').first()
+    while state is not None and state['status'] not in finished and time.monotonic() < ends:
+        # 长轮询：只查状态，完成后再读结果
+        time.sleep(min(0.5, max(0, ends - time.monotonic())))
+        state = jobs.values('status', 'attempts', 'created_at', 'started_at').first()
+    if state is None:
+        return _error('任务不存在或已过期', 404)
+
+    if state['status'] == AsyncJob.DONE:
+        job = jobs.only('status_code', 'response_content_type', 'response_body').get()
+        response = HttpResponse(bytes(job.response_body or b''), status=job.status_code,
+                                content_type=job.response_content_type or None)
+    elif state['status'] == AsyncJob.FAILED:
+        job = jobs.only('error').get()
+        response = JsonResponse({'job_id': str(job_id), 'status': AsyncJob.FAILED, 'error': job.error}, status=500,
+                                json_dumps_params={'ensure_ascii': False})
+    else:
+        response = JsonResponse({
+            'job_id': str(job_id),
+            'status': state['status'],
+            'attempts': state['attempts'],
+            'created_at': state['created_at'],
+            'started_at': state['started_at'],
+        }, status=202)
+        response['Retry-After'] = str(opts['POLL_SECONDS'])
+    response['X-Job-Status'] = state['status']
+    return response
@@ -0,0 +1,321 @@
+# ai_app/keypool.py
+"""
+上游API密钥池：每个服务商（glm / dashscope / coze）可以在后台“API密钥”里配置多个密钥，吞吐量随密钥数增加
+- 选择：默认挑进行中请求最少的密钥（least_in_flight），也可以按本分钟剩余配额最多的挑（remaining_quota，需要填每分钟请求上限）
+- 冷却：返回429的密钥按 Retry-After（没有时 RATE_LIMIT_COOLDOWN 秒）暂停使用，401/403 暂停 AUTH_COOLDOWN 秒；
+  同一次调用里 call_with_retry 换另一个密钥立即重试；所有密钥都在冷却时用最早恢复的那个
+- 用量：每个密钥的请求数、出错数、被限流次数先在进程内累加，每 FLUSH_SECONDS 秒在后台线程写一次数据库
+- 没有配置密钥时用后台配置里原来的单个密钥（GLM_API_KEY / QWEN_API_KEY / COZE_API_TOKEN）
+- 排队：acquire 先按 scheduler 等上游空位（加权公平排队），release 时归还
+冷却状态、每分钟请求数和上游对象所属的密钥记在多进程共用的缓存（settings.CACHES['shared']）里，各 worker 一致；进行中请求数按进程统计
+"""
+import logging
+import random
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from constance import config
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+
+from . import scheduler
+from .retry import shared_cache
+from .workers import get_executor
+
+logger = logging.getLogger(__name__)
+
+STRATEGY_LEAST_IN_FLIGHT = 'least_in_flight'
+STRATEGY_REMAINING_QUOTA = 'remaining_quota'
+
+# 没有配置密钥池时使用的后台配置项
+FALLBACK_CONFIG = {
+    'glm': 'GLM_API_KEY',
+    'dashscope': 'QWEN_API_KEY',
+    'coze': 'COZE_API_TOKEN',
+}
+
+POOL_CACHE_KEY = 'ai_app:api_keys'
+POOL_CACHE_SECONDS = 60
+
+Credential = namedtuple('Credential', 'id provider name secret rpm_limit')
+
+_lock = threading.Lock()
+_in_flight = defaultdict(int)
+# 待写入数据库的用量增量 {密钥id: {字段: 增量}}
+_pending = defaultdict(lambda: defaultdict(int))
+_last_flush = time.monotonic()
+_clients = {}
+
+
+def options():
+    result = {
+        'STRATEGY': STRATEGY_LEAST_IN_FLIGHT,
+        'RATE_LIMIT_COOLDOWN': 20,
+        'AUTH_COOLDOWN': 300,
+        'FLUSH_SECONDS': 10,
+    }
+    result.update(getattr(settings, 'API_KEY_POOL', {}))
+    return result
+
+
+# =============== 密钥列表 ===============
+def credentials(provider):
+    """服务商启用的密钥，缓存 POOL_CACHE_SECONDS 秒，后台修改密钥后清除"""
+    pool = cache.get(POOL_CACHE_KEY)
+    if pool is None:
+        from .models import ApiCredential
+
+        pool = defaultdict(list)
+        for row in ApiCredential.objects.filter(enabled=True).order_by('id'):
+            pool[row.provider].append(Credential(row.id, row.provider, row.name, row.key, row.rpm_limit))
+        pool = dict(pool)
+        cache.set(POOL_CACHE_KEY, pool, POOL_CACHE_SECONDS)
+    return pool.get(provider, [])
+
+
+def clear_credentials():
+    cache.delete(POOL_CACHE_KEY)
+
+
+def _fallback(provider):
+    return Credential(None, provider, 'default', getattr(config, FALLBACK_CONFIG[provider]), None)
+
+
+def _cooldown_key(credential):
+    return f'ai_app:api_key_cooldown:{credential.id}'
+
+
+def _minute_key(credential, minute):
+    return f'ai_app:api_key_rpm:{credential.id}:{minute}'
+
+
+def cooldown_until(credential):
+    """密钥冷却结束的时间戳，没在冷却返回None"""
+    until = shared_cache().get(_cooldown_key(credential))
+    return until if until and until > time.time() else None
+
+
+def clear_cooldown(credential):
+    shared_cache().delete(_cooldown_key(credential))
+
+
+# =============== 选择 ===============
+def _shared_state(pool, exclude=()):
+    """候选密钥的冷却结束时间和本分钟已用请求数，一次从共享缓存读出；在 _lock 外调用，不让数据库查询挡住其他线程"""
+    minute = int(time.time() // 60)
+    candidates = [c for c in pool if c.id not in exclude]
+    keys = [_cooldown_key(c) for c in candidates] + [_minute_key(c, minute) for c in candidates if c.rpm_limit]
+    return minute, shared_cache().get_many(keys)
+
+
+def _pick(pool, state, exclude=()):
+    """按策略挑一个密钥，state 为 _shared_state 的结果，exclude 为本次调用已经用过的密钥id；调用方持有 _lock"""
+    candidates = [c for c in pool if c.id not in exclude]
+    if not candidates:
+        return None
+    now = time.time()
+    minute, shared = state
+    quota_first = options()['STRATEGY'] == STRATEGY_REMAINING_QUOTA
+
+    def rank(credential):
+        until = shared.get(_cooldown_key(credential)) or 0
+        remaining = 1.0
+        if credential.rpm_limit:
+            remaining = max(0, credential.rpm_limit - shared.get(_minute_key(credential, minute), 0)) / credential.rpm_limit
+        in_flight = _in_flight[credential.id]
+        load = (-remaining, in_flight) if quota_first else (in_flight, -remaining)
+        # 先排除冷却中的，再排除本分钟配额用完的，同分时随机，避免多个进程都挑第一个
+        return (until if until > now else 0, remaining <= 0) + load + (random.random(),)
+
+    return min(candidates, key=rank)
+
+
+def _count_minute(credential):
+    if not credential.rpm_limit:
+        return
+    key = _minute_key(credential, int(time.time() // 60))
+    cache = shared_cache()
+    cache.add(key, 0, 120)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # 刚好过期
+        cache.add(key, 1, 120)
+
+
+class Lease:
+    """
+    一次上游调用占用的密钥，必须用 with（或调用 release）：
+        with keypool.acquire('glm') as lease:
+            call_with_retry(lambda timeout: ...lease.secret..., 'glm', deadline, lease=lease)
+    """
+
+    def __init__(self, provider, credential, pool, pinned=False, slot=None):
+        self.provider = provider
+        self.credential = credential
+        self.pool = pool
+        # scheduler 分到的上游空位，释放密钥时一起归还
+        self.slot = slot
+        # 固定的密钥不换（会话、任务属于创建它的账号）
+        self.pinned = pinned
+        self.tried = {credential.id}
+        self.released = False
+
+    @property
+    def secret(self):
+        return self.credential.secret
+
+    def client(self, factory, **kwargs):
+        """按密钥缓存的 SDK 客户端（OpenAI / ZhipuAI），复用连接池，也省掉每次新建客户端加载 CA 证书的约 20ms CPU"""
+        key = (factory, self.secret, tuple(sorted(kwargs.items())))
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = factory(api_key=self.secret, **kwargs)
+        return client
+
+    def failed(self, error_class, retry_after=None):
+        """上游返回限流或认证错误：当前密钥冷却一段时间，不再分给其他请求"""
+        from .retry import AUTH, RATE_LIMIT
+
+        _record(self.credential, errors=1, rate_limited=1 if error_class == RATE_LIMIT else 0)
+        if self.credential.id is None or error_class not in (AUTH, RATE_LIMIT):
+            return
+        opts = options()
+        seconds = opts['AUTH_COOLDOWN'] if error_class == AUTH else max(retry_after or 0, opts['RATE_LIMIT_COOLDOWN'])
+        shared_cache().set(_cooldown_key(self.credential), time.time() + seconds, seconds)
+        logger.warning('API密钥 %s 暂停使用 %s 秒（%s）', self.credential.name, seconds, error_class,
+                       extra={'provider': self.provider})
+
+    def rotate(self):
+        """换一个这次调用还没用过、不在冷却中的密钥，没有可换的返回False"""
+        if self.pinned:
+            return False
+        state = _shared_state(self.pool, self.tried)
+        with _lock:
+            credential = _pick(self.pool, state, self.tried)
+            until = state[1].get(_cooldown_key(credential)) if credential is not None else None
+            if credential is None or (until and until > time.time()):
+                return False
+            _in_flight[self.credential.id] -= 1
+            _in_flight[credential.id] += 1
+            self.credential = credential
+            self.tried.add(credential.id)
+        _count_minute(credential)
+        _record(credential, requests=1)
+        return True
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        with _lock:
+            _in_flight[self.credential.id] -= 1
+        if self.slot is not None:
+            self.slot.release()
+        _maybe_flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+def acquire(provider, credential_id=None):
+    """
+    先按 scheduler 排队等到上游空位，再从服务商的密钥池里挑一个密钥
+    credential_id: 固定用这个密钥（上游的会话、任务属于创建它的账号）；已删除或停用时重新挑
+    """
+    slot = scheduler.admit(provider)
+    counted = None
+    try:
+        pool = credentials(provider)
+        if not pool:
+            credential = _fallback(provider)
+            with _lock:
+                _in_flight[None] += 1
+            return Lease(provider, credential, [], slot=slot)
+        credential = next((c for c in pool if c.id == credential_id), None) if credential_id else None
+        pinned = credential is not None
+        state = None if pinned else _shared_state(pool)
+        with _lock:
+            if credential is None:
+                credential = _pick(pool, state)
+            _in_flight[credential.id] += 1
+        counted = credential
+        _count_minute(credential)
+        _record(credential, requests=1)
+    except Exception:
+        # 读密钥或共用缓存出错时，空位和进行中计数不能一直占着
+        if counted is not None:
+            with _lock:
+                _in_flight[counted.id] -= 1
+        slot.release()
+        raise
+    return Lease(provider, credential, pool, pinned, slot)
+
+
+def in_flight(credential_id):
+    return _in_flight.get(credential_id, 0)
+
+
+# =============== 用量 ===============
+def _record(credential, **counts):
+    if credential.id is None:
+        return
+    with _lock:
+        pending = _pending[credential.id]
+        for field, value in counts.items():
+            pending[field] += value
+        if counts.get('requests'):
+            pending['last_used'] = 1
+
+
+def _maybe_flush():
+    global _last_flush
+    now = time.monotonic()
+    with _lock:
+        if not _pending or now - _last_flush < options()['FLUSH_SECONDS']:
+            return
+        _last_flush = now
+        pending = {key: dict(value) for key, value in _pending.items()}
+        _pending.clear()
+    get_executor('api_keys').submit(flush_usage, pending)
+
+
+def flush_usage(pending=None):
+    """把累计的用量写入数据库；不传参数时写入当前进程里还没写的部分"""
+    from .models import ApiCredential
+
+    if pending is None:
+        with _lock:
+            pending = {key: dict(value) for key, value in _pending.items()}
+            _pending.clear()
+    now = timezone.now()
+    for credential_id, counts in pending.items():
+        updates = {
+            'request_count': F('request_count') + counts.get('requests', 0),
+            'error_count': F('error_count') + counts.get('errors', 0),
+            'rate_limited_count': F('rate_limited_count') + counts.get('rate_limited', 0),
+        }
+        if counts.get('last_used'):
+            updates['last_used_at'] = now
+        ApiCredential.objects.filter(pk=credential_id).update(**updates)
+
+
+# =============== 上游对象所属的密钥 ===============
+OWNER_SECONDS = 7 * 24 * 3600
+
+
+def remember_owner(kind, object_id, lease):
+    """记录上游对象（如视频生成任务）是哪个密钥创建的，之后查询时固定用这个密钥（对象属于创建它的账号）"""
+    if lease.credential.id is not None:
+        shared_cache().set(f'ai_app:api_key_owner:{kind}:{object_id}', lease.credential.id, OWNER_SECONDS)
+
+
+def owner(kind, object_id):
+    return shared_cache().get(f'ai_app:api_key_owner:{kind}:{object_id}')
@@ -0,0 +1,154 @@
+# ai_app/log.py
+"""
+日志工具
+- BackgroundQueueHandler：请求线程只把日志记录放进队列，格式化和写出都在后台线程完成
+- JsonFormatter：输出一行一条的JSON日志，超长字段按 max_length 截断
+- SamplingFilter：对高频的INFO日志按比例采样，WARNING及以上全部保留
+- LazyJson：调试用的大对象，只有真正输出时才序列化
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from ai_app.tracing import current_trace
+
+# LogRecord 自带的属性，JsonFormatter 只把 extra 传入的其他属性当作附加字段输出
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_path'}
+
+
+def truncate(value, max_length):
+    """截断字符串，保留长度提示"""
+    if max_length and isinstance(value, str) and len(value) > max_length:
+        return f'{value[:max_length]}...<截断，共{len(value)}字符>'
+    return value
+
+
+class LazyJson:
+    """延迟序列化：logger.debug('响应: %s', LazyJson(response))，日志级别不够时不会执行 json.dumps"""
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        try:
+            return json.dumps(self.obj, ensure_ascii=False, default=lambda o: getattr(o, '__dict__', str(o)))
+        except (TypeError, ValueError):
+            return repr(self.obj)
+
+
+class JsonFormatter(logging.Formatter):
+    """结构化JSON日志"""
+
+    def __init__(self, max_length=2000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_length = max_length
+
+    def format(self, record):
+        payload = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': truncate(record.getMessage(), self.max_length),
+        }
+        if getattr(record, 'request_path', None):
+            payload['path'] = record.request_path
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                payload[key] = truncate(value if isinstance(value, (int, float, bool, type(None))) else str(value),
+                                        self.max_length)
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # BackgroundQueueHandler 入队前已格式化好
+            payload['exc_info'] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """按比例保留 level 及以下的日志，loggers 为空时对所有logger生效"""
+
+    def __init__(self, rate=1.0, level='INFO', loggers=None):
+        super().__init__()
+        self.rate = float(rate)
+        self.levelno = logging.getLevelName(level) if isinstance(level, str) else level
+        self.loggers = tuple(loggers or ())
+
+    def filter(self, record):
+        if record.levelno > self.levelno or self.rate >= 1:
+            return True
+        if self.loggers and not record.name.startswith(self.loggers):
+            return True
+        return random.random() < self.rate
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    异步日志：emit 只做 put_nowait，队列满时丢弃并计数，不阻塞请求线程
+    在 LOGGING 里给它配的 formatter 会转交给后台的 StreamHandler
+    丢弃的条数记在下一条成功入队的日志的 dropped_logs 字段里
+    """
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.target = logging.StreamHandler(stream)
+        self.dropped = 0
+        self._pid = None
+        self.listener = None
+        self._start_listener()
+        atexit.register(self._stop_listener)
+
+    def _start_listener(self):
+        self._pid = os.getpid()
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+
+    def _stop_listener(self):
+        if self.listener is not None and self.listener._thread is not None:
+            self.listener.stop()
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # 补上请求路径（后台线程拿不到请求上下文）
+        trace = current_trace()
+        if trace is not None:
+            record.request_path = trace.path
+        # 异常堆栈和参数在入队前转成字符串，队列里的记录不再引用请求、上传文件、SDK响应等对象，
+        # 也不会在后台线程格式化时读到已被请求线程改掉的参数；LazyJson 留到后台线程再序列化
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = (self.target.formatter or logging.Formatter()).formatException(record.exc_info)
+            record.exc_info = None
+        if record.args:
+            values = record.args.values() if isinstance(record.args, dict) else record.args
+            if not any(isinstance(value, LazyJson) for value in values):
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            # gunicorn --preload 时 fork 出来的 worker 没有后台线程，重新启动
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._start_listener()
+        # Handler.handle 已加锁，dropped 的读写不用再加锁
+        dropped = self.dropped
+        if dropped:
+            record.dropped_logs = dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.dropped -= dropped
+
+    def close(self):
+        self._stop_listener()
+        self.target.close()
+        super().close()
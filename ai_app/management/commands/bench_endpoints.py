@@ -0,0 +1,84 @@
+# ai_app/management/commands/bench_endpoints.py
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from ai_app.bench.runner import build_scenarios, compare, missing_baseline, run_all, slowdowns, uncovered_routes
+
+DEFAULT_BASELINE = Path(__file__).resolve().parents[2] / 'bench' / 'baseline.json'
+
+
+class Command(BaseCommand):
+    help = '离线基准测试：上游全部替换为假实现，统计每个接口的CPU时间、内存分配和数据库查询次数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='每个场景的测量次数')
+        parser.add_argument('--only', nargs='*', help='只跑指定场景')
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE), help='基线文件路径')
+        parser.add_argument('--save', action='store_true', help='把本次结果写入基线文件')
+        parser.add_argument('--tolerance', type=float, default=0.5, help='CPU/内存允许超出基线的比例（CPU超出只提示）')
+        parser.add_argument('--fail-on-regression', action='store_true', help='有回归、路由没有场景或场景没有基线时以非0状态退出')
+        parser.add_argument('--keepdb', action='store_true', help='保留测试数据库')
+
+    def handle(self, *args, **options):
+        uncovered = uncovered_routes(build_scenarios())
+        if uncovered:
+            self.stderr.write(self.style.WARNING(f'以下路由没有基准场景: {", ".join(uncovered)}'))
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            results = run_all(iterations=options['iterations'], only=options['only'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        self._print_table(results)
+
+        baseline_path = Path(options['baseline'])
+        if options['save']:
+            baseline_path.write_text(json.dumps(results, indent=2, ensure_ascii=False, sort_keys=True) + '\n',
+                                     encoding='utf-8')
+            self.stdout.write(self.style.SUCCESS(f'基线已写入 {baseline_path}'))
+            return
+
+        if not baseline_path.exists():
+            if options['fail_on_regression']:
+                raise CommandError(f'没有找到基线文件 {baseline_path}，用 --save 生成')
+            self.stdout.write(f'没有找到基线文件 {baseline_path}，用 --save 生成')
+            return
+        baseline = json.loads(baseline_path.read_text(encoding='utf-8'))
+        regressions = compare(results, baseline, options['tolerance'])
+        for name, metric, before, after in regressions:
+            self.stdout.write(self.style.ERROR(f'回归 {name}.{metric}: {before} -> {after}'))
+        for name, metric, before, after in slowdowns(results, baseline, options['tolerance']):
+            # CPU时间和机器有关，不作为失败条件，本机前后两次对比时再看
+            self.stdout.write(self.style.WARNING(f'变慢（仅供参考） {name}.{metric}: {before} -> {after}'))
+        unbased = missing_baseline(results, baseline)
+        if unbased:
+            self.stdout.write(self.style.WARNING(f'以下场景没有基线，未做对比: {", ".join(unbased)}'))
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS('与基线相比没有回归'))
+
+        if options['fail_on_regression']:
+            problems = []
+            if regressions:
+                problems.append(f'{len(regressions)} 项指标超出基线')
+            if unbased:
+                problems.append(f'{len(unbased)} 个场景没有基线')
+            if uncovered:
+                problems.append(f'{len(uncovered)} 个路由没有场景')
+            if problems:
+                raise CommandError('，'.join(problems))
+
+    def _print_table(self, results):
+        header = f'{"场景":<22}{"状态":>6}{"CPU ms":>10}{"墙钟 ms":>10}{"峰值分配":>12}{"查询":>6}'
+        self.stdout.write(header)
+        for name, item in results.items():
+            self.stdout.write(
+                f'{name:<22}{item["status"]:>6}{item["cpu_ms"]:>10.2f}{item["wall_ms"]:>10.2f}'
+                f'{item["peak_alloc_bytes"] / 1024:>10.0f}KB{item["queries"]:>6}'
+            )
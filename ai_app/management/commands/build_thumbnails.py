@@ -0,0 +1,29 @@
+# ai_app/management/commands/build_thumbnails.py
+from django.core.management.base import BaseCommand
+
+from ai_app.models import UploadedFile
+from ai_app.thumbnails import THUMBNAIL_TYPES, generate_thumbnail
+
+
+class Command(BaseCommand):
+    help = '补做媒体库缩略图：历史文件、后台队列满时被丢弃的文件'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='已有缩略图的也重新生成')
+        parser.add_argument('--limit', type=int, help='最多处理多少个文件')
+
+    def handle(self, *args, **options):
+        queryset = UploadedFile.objects.filter(file_type__in=THUMBNAIL_TYPES)
+        if not options['force']:
+            queryset = queryset.filter(thumbnail='')
+        file_ids = queryset.order_by('pk').values_list('pk', flat=True)
+        if options['limit']:
+            file_ids = file_ids[:options['limit']]
+
+        done = skipped = 0
+        for file_id in file_ids.iterator():
+            if generate_thumbnail(file_id, force=options['force']):
+                done += 1
+            else:
+                skipped += 1
+        self.stdout.write(self.style.SUCCESS(f'生成 {done} 个缩略图，跳过 {skipped} 个'))
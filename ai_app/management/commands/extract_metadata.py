@@ -0,0 +1,27 @@
+# ai_app/management/commands/extract_metadata.py
+from django.core.management.base import BaseCommand
+
+from ai_app.metadata import extract_metadata
+from ai_app.models import UploadedFile
+
+
+class Command(BaseCommand):
+    help = '补做媒体元数据提取：历史文件、后台队列满时被丢弃的文件'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='已经提取过的也重新提取')
+        parser.add_argument('--limit', type=int, help='最多处理多少个文件')
+
+    def handle(self, *args, **options):
+        queryset = UploadedFile.objects.all()
+        if not options['force']:
+            queryset = queryset.filter(metadata_extracted_at__isnull=True)
+        file_ids = queryset.order_by('pk').values_list('pk', flat=True)
+        if options['limit']:
+            file_ids = file_ids[:options['limit']]
+
+        done = 0
+        for file_id in file_ids.iterator():
+            if extract_metadata(file_id) is not None:
+                done += 1
+        self.stdout.write(self.style.SUCCESS(f'提取 {done} 个文件的元数据'))
@@ -0,0 +1,52 @@
+# ai_app/management/commands/loadgen.py
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_app.bench.loadgen import DEFAULT_MIX, LoadGenerator, load_mix
+
+
+class Command(BaseCommand):
+    help = '按目标RPS回放请求组合压测运行中的网关，输出 p50/p95/p99、吞吐量和错误率'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', default='http://127.0.0.1:8000', help='网关地址')
+        parser.add_argument('--mix', default=str(DEFAULT_MIX), help='请求组合文件（JSONL）')
+        parser.add_argument('--rps', type=float, default=20)
+        parser.add_argument('--duration', type=float, default=60, help='持续秒数')
+        parser.add_argument('--concurrency', type=int, default=256, help='最大并发连接数')
+        parser.add_argument('--timeout', type=float, default=120, help='单个请求超时秒数')
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--label', default='', help='结果标签，例如 gunicorn-sync-4w / uvicorn-2w')
+        parser.add_argument('--output', help='把结果追加写入该JSONL文件，方便对比不同部署')
+
+    def handle(self, *args, **options):
+        if options['rps'] <= 0 or options['duration'] <= 0:
+            raise CommandError('--rps 和 --duration 必须大于0')
+        mix = load_mix(options['mix'])
+        if not mix:
+            raise CommandError('请求组合为空')
+
+        generator = LoadGenerator(options['target'], mix, options['rps'], options['duration'],
+                                  concurrency=options['concurrency'], timeout=options['timeout'],
+                                  seed=options['seed'])
+        self.stdout.write(f'压测 {options["target"]}：{options["rps"]} rps × {options["duration"]} 秒')
+        report = generator.run(progress=lambda done, total: self.stdout.write(f'  已发送 {done}/{total}'))
+        report['label'] = options['label']
+
+        overall = report['overall']
+        self.stdout.write(self.style.SUCCESS(
+            f'请求 {overall["requests"]}，吞吐 {overall["throughput_rps"]} rps（成功 {overall["ok_throughput_rps"]}），'
+            f'错误率 {overall["error_rate"]:.2%}'
+        ))
+        self.stdout.write(f'延迟 p50={overall["p50_ms"]} p95={overall["p95_ms"]} p99={overall["p99_ms"]} '
+                          f'max={overall["max_ms"]} ms，首包 p50={overall["ttfb_p50_ms"]} p99={overall["ttfb_p99_ms"]} ms')
+        self.stdout.write(f'{"接口":<18}{"请求":>6}{"错误率":>8}{"p50":>9}{"p95":>9}{"p99":>9}')
+        for name, item in report['by_name'].items():
+            self.stdout.write(f'{name:<18}{item["requests"]:>6}{item["error_rate"]:>8.2%}'
+                              f'{item["p50_ms"]:>9}{item["p95_ms"]:>9}{item["p99_ms"]:>9}')
+
+        if options['output']:
+            with Path(options['output']).open('a', encoding='utf-8') as fh:
+                fh.write(json.dumps(report, ensure_ascii=False) + '\n')
@@ -0,0 +1,32 @@
+# ai_app/management/commands/purge_media.py
+from django.core.management.base import BaseCommand
+
+from ai_app.retention import Report, delete_uploaded_files, expired_queryset, format_bytes, purge_orphans, \
+    purge_temp_files
+
+
+class Command(BaseCommand):
+    help = '按 settings.RETENTION 清理过期上传记录、存储里的孤儿文件和 temp_files 临时文件'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expired', action='store_true', help='只清理过期记录')
+        parser.add_argument('--orphans', action='store_true', help='只清理孤儿文件')
+        parser.add_argument('--temp', action='store_true', help='只清理临时文件')
+        parser.add_argument('--dry-run', action='store_true', help='只统计，不删除')
+
+    def handle(self, *args, **options):
+        # 不指定时三类都清理
+        selected = [name for name in ('expired', 'orphans', 'temp') if options[name]] or ['expired', 'orphans', 'temp']
+        dry_run = options['dry_run']
+        report = Report()
+        if 'expired' in selected:
+            delete_uploaded_files(expired_queryset(), dry_run=dry_run, report=report)
+        if 'orphans' in selected:
+            purge_orphans(dry_run=dry_run, report=report)
+        if 'temp' in selected:
+            purge_temp_files(dry_run=dry_run, report=report)
+
+        for line in report.lines():
+            self.stdout.write(line)
+        prefix = '可释放' if dry_run else '共释放'
+        self.stdout.write(self.style.SUCCESS(f'{prefix} {format_bytes(report.total_bytes)}'))
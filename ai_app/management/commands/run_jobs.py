@@ -0,0 +1,21 @@
+# ai_app/management/commands/run_jobs.py
+from django.core.management.base import BaseCommand
+
+from ai_app import jobs
+
+
+class Command(BaseCommand):
+    help = '执行 async=true 提交的异步任务：启动多个 worker 进程从数据库领取任务，Ctrl+C 后等正在执行的任务结束再退出'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None,
+                            help='worker 进程数，默认 settings.ASYNC_JOBS["PROCESSES"]')
+        parser.add_argument('--once', action='store_true', help='在当前进程里执行完排队的任务就退出（用于 cron 或排查问题）')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            jobs.work(once=True)
+            return
+        processes = options['processes'] or jobs.options()['PROCESSES']
+        self.stdout.write(f'启动 {processes} 个异步任务 worker 进程')
+        jobs.serve(processes)
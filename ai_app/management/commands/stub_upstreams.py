@@ -0,0 +1,67 @@
+# ai_app/management/commands/stub_upstreams.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_app.bench.stub_servers import Behaviour, start_stub_servers
+
+
+def parse_statuses(value):
+    """'429:0.5,500:0.3,503:0.2' -> {429: 0.5, 500: 0.3, 503: 0.2}"""
+    result = {}
+    for item in value.split(','):
+        code, _, weight = item.partition(':')
+        result[int(code)] = float(weight or 1)
+    return result
+
+
+class Command(BaseCommand):
+    help = '启动本地假上游（GLM / DashScope / Coze），延迟和错误分布可配置，用于压测网关'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--glm-port', type=int, default=18001)
+        parser.add_argument('--dashscope-port', type=int, default=18002)
+        parser.add_argument('--coze-port', type=int, default=18003)
+        parser.add_argument('--latency-ms', type=float, default=300, help='首包延迟均值')
+        parser.add_argument('--jitter-ms', type=float, default=100, help='首包延迟的离散程度')
+        parser.add_argument('--dist', default='lognormal',
+                            choices=['fixed', 'uniform', 'normal', 'lognormal', 'exponential'])
+        parser.add_argument('--error-rate', type=float, default=0.0, help='返回错误的比例')
+        parser.add_argument('--error-statuses', default='429:0.5,500:0.25,503:0.25', help='错误状态码及权重')
+        parser.add_argument('--stall-rate', type=float, default=0.0, help='额外卡顿的请求比例（模拟长尾）')
+        parser.add_argument('--stall-ms', type=float, default=20000)
+        parser.add_argument('--chunks', type=int, default=20, help='流式接口的分块数')
+        parser.add_argument('--chunk-interval-ms', type=float, default=20)
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--verbose', action='store_true', help='打印每个请求')
+
+    def handle(self, *args, **options):
+        try:
+            statuses = parse_statuses(options['error_statuses'])
+        except ValueError:
+            raise CommandError('--error-statuses 格式应为 429:0.5,500:0.5')
+        behaviour = Behaviour(
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            dist=options['dist'],
+            error_rate=options['error_rate'],
+            error_statuses=statuses,
+            stall_rate=options['stall_rate'],
+            stall_ms=options['stall_ms'],
+            chunk_count=options['chunks'],
+            chunk_interval_ms=options['chunk_interval_ms'],
+            seed=options['seed'],
+        )
+        ports = {'glm': options['glm_port'], 'dashscope': options['dashscope_port'], 'coze': options['coze_port']}
+        servers, env = start_stub_servers(options['host'], ports, behaviour, verbose=options['verbose'])
+
+        self.stdout.write(self.style.SUCCESS('假上游已启动，启动网关前设置以下环境变量：'))
+        for key, value in env.items():
+            self.stdout.write(f'export {key}={value}')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            for server in servers.values():
+                server.shutdown()
@@ -0,0 +1,192 @@
+# ai_app/media.py
+"""
+媒体文件下载
+按固定大小分块流式输出，支持 Range（视频拖动进度条）、ETag / If-Modified-Since 协商缓存，
+可选把传输交给前端代理（nginx 的 X-Accel-Redirect 或 Apache 的 X-Sendfile）
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _chunk_size():
+    return getattr(settings, 'MEDIA_STREAM_CHUNK_SIZE', 64 * 1024)
+
+
+def _etag(stat):
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def _not_modified(request, etag, mtime):
+    """按 If-None-Match 优先、If-Modified-Since 其次判断是否可以返回304"""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        candidates = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in candidates or etag in candidates or f'W/{etag}' in candidates
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and int(mtime) <= since
+
+
+def _parse_range(request, etag, mtime, size):
+    """
+    解析单段 Range，返回 (start, end)；不需要分段时返回None；无法满足时返回 'invalid'
+    多段 Range 很少见（浏览器拖视频只发单段），直接返回整个文件
+    """
+    header = request.META.get('HTTP_RANGE', '').strip()
+    if not header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+    if if_range:
+        # If-Range 不匹配说明客户端缓存的是旧文件，返回整个新文件
+        if if_range.startswith(('"', 'W/')):
+            if if_range != etag:
+                return None
+        elif parse_http_date_safe(if_range) != int(mtime):
+            return None
+    match = _RANGE_RE.match(header)
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return 'invalid'
+    if not first:
+        # bytes=-500 表示最后500字节
+        length = int(last)
+        if length == 0:
+            return 'invalid'
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return 'invalid'
+    return start, end
+
+
+def _iter_range(path, start, length, chunk_size):
+    with open(path, 'rb') as fh:
+        fh.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = fh.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def _accel_response(path, content_type):
+    """交给前端代理发送文件，Django 只返回头；代理自己处理 Range 和缓存"""
+    accel = getattr(settings, 'MEDIA_ACCEL_REDIRECT', None) or {}
+    mode = accel.get('MODE')
+    if not mode:
+        return None
+    response = HttpResponse(content_type=content_type)
+    if mode == 'nginx':
+        # nginx 里配置 location /protected-media/ { internal; alias <MEDIA_ROOT>/; }
+        relative = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+        response['X-Accel-Redirect'] = quote(accel.get('PREFIX', '/protected-media/') + relative)
+    elif mode == 'sendfile':
+        response['X-Sendfile'] = path
+    else:
+        return None
+    return response
+
+
+def file_response(request, path, content_type=None, filename=None, as_attachment=False):
+    """
+    返回文件响应：304 / 206 分段 / 200 全量，或者交给前端代理
+    path 是磁盘上的绝对路径，调用方负责权限检查
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404('文件不存在')
+
+    content_type = content_type or 'application/octet-stream'
+    etag = _etag(stat)
+    last_modified = http_date(stat.st_mtime)
+    common_headers = {
+        'ETag': etag,
+        'Last-Modified': last_modified,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': getattr(settings, 'MEDIA_CACHE_CONTROL', 'private, max-age=3600'),
+    }
+    if filename is not None or as_attachment:
+        common_headers['Content-Disposition'] = content_disposition_header(
+            as_attachment, filename or os.path.basename(path))
+
+    if _not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        for key in ('ETag', 'Last-Modified', 'Cache-Control'):
+            response[key] = common_headers[key]
+        return response
+
+    response = _accel_response(path, content_type)
+    if response is None:
+        byte_range = _parse_range(request, etag, stat.st_mtime, stat.st_size)
+        if byte_range == 'invalid':
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            content = _iter_range(path, start, length, _chunk_size()) if request.method != 'HEAD' else []
+            response = StreamingHttpResponse(content, status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            response['Content-Length'] = str(length)
+        elif request.method == 'HEAD':
+            response = HttpResponse(content_type=content_type)
+            response['Content-Length'] = str(stat.st_size)
+        else:
+            # FileResponse 在 WSGI 服务器支持时会走 wsgi.file_wrapper（sendfile）
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+            response.block_size = _chunk_size()
+
+    for key, value in common_headers.items():
+        response[key] = value
+    return response
+
+
+def _can_read(request, relative):
+    """登录用户只能读自己上传的文件和缩略图，管理员可以读全部"""
+    from django.db.models import Q
+
+    from .models import UploadedFile
+
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return False
+    if user.is_staff:
+        return True
+    return UploadedFile.objects.filter(Q(file=relative) | Q(thumbnail=relative), uploader=user).exists()
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    MEDIA_URL 下的文件，替代 django.conf.urls.static（那个只适合开发环境，且不支持 Range）
+    需要登录，普通用户只能下载自己上传的文件；没有权限和文件不存在一样返回404
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('文件不存在')
+    relative = os.path.relpath(full_path, settings.MEDIA_ROOT).replace(os.sep, '/')
+    if not _can_read(request, relative) or not os.path.isfile(full_path):
+        raise Http404('文件不存在')
+    content_type, encoding = mimetypes.guess_type(full_path)
+    response = file_response(request, full_path, content_type=content_type)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,248 @@
+# ai_app/metadata.py
+"""
+媒体元数据提取
+上传后在后台线程（ai_app/workers.py 的 media 池）读取文件头：按魔数判断真实类型，
+图片读宽高和EXIF方向，WAV/MP3 从文件头算时长，PDF 读页数，结果写回 UploadedFile 的索引列
+"""
+import hashlib
+import logging
+import re
+import struct
+
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+
+from .workers import run_after_commit
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # 可选依赖，没装时用正则从 /Pages 字典里找页数
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+HEAD_SIZE = 64
+# 不装 pypdf 时正则扫描的PDF大小上限，太大的文件不值得整个读进内存
+PDF_SCAN_LIMIT = 32 * 1024 * 1024
+
+
+# =============== 魔数 ===============
+# BMP 的 DIB 头长度：BITMAPCOREHEADER / INFOHEADER / V4HEADER / V5HEADER
+_BMP_DIB_SIZES = (12, 40, 108, 124)
+
+
+def _is_bmp(head, size):
+    """"BM" 太短，文本文件也可能以它开头；再核对文件头里的文件大小和 DIB 头长度"""
+    if not head.startswith(b'BM') or len(head) < 18:
+        return False
+    file_size, dib_size = struct.unpack_from('<I', head, 2)[0], struct.unpack_from('<I', head, 14)[0]
+    if dib_size not in _BMP_DIB_SIZES:
+        return False
+    return file_size == size if size is not None else file_size > 14 + dib_size
+
+
+def sniff_type(head, ext='', size=None):
+    """按文件头判断 (MIME, file_type)，认不出返回None；size 为文件实际大小，用于核对 BMP 文件头"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg', 'image'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png', 'image'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif', 'image'
+    if _is_bmp(head, size):
+        return 'image/bmp', 'image'
+    if head.startswith(b'RIFF') and len(head) >= 12:
+        form = head[8:12]
+        if form == b'WEBP':
+            return 'image/webp', 'image'
+        if form == b'WAVE':
+            return 'audio/wav', 'audio'
+        if form == b'AVI ':
+            return 'video/x-msvideo', 'video'
+    if head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return 'audio/mpeg', 'audio'
+    if head.startswith(b'OggS'):
+        return 'audio/ogg', 'audio'
+    if head.startswith(b'fLaC'):
+        return 'audio/flac', 'audio'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'M4A ', b'M4B '):
+            return 'audio/mp4', 'audio'
+        if brand == b'qt  ':
+            return 'video/quicktime', 'video'
+        return 'video/mp4', 'video'
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return ('video/webm', 'video') if b'webm' in head else ('video/x-matroska', 'video')
+    if head.startswith(b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'):
+        return 'video/x-ms-wmv', 'video'
+    if head.startswith(b'%PDF-'):
+        return 'application/pdf', 'document'
+    if head.startswith(b'\xd0\xcf\x11\xe0'):
+        return 'application/msword', 'document'
+    if head.startswith(b'PK\x03\x04'):
+        # docx 也是 zip，靠扩展名区分
+        if ext == '.docx':
+            return 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'document'
+        return 'application/zip', 'other'
+    return None
+
+
+# =============== 图片 ===============
+def image_info(fh):
+    """返回 (宽, 高, EXIF方向)，宽高是存储的像素尺寸，方向为5-8时显示时需要对调"""
+    with Image.open(fh) as image:
+        orientation = image.getexif().get(0x0112)
+        return image.width, image.height, orientation
+
+
+# =============== 音频 ===============
+def wav_duration(fh):
+    """按 RIFF 块计算：data块长度 / fmt块里的每秒字节数，不依赖 wave 模块（它不支持非PCM格式）"""
+    header = fh.read(12)
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    byte_rate = None
+    while True:
+        chunk = fh.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+        if chunk_id == b'fmt ':
+            fmt = fh.read(size)
+            byte_rate = struct.unpack('<I', fmt[8:12])[0]
+            if size % 2:
+                fh.read(1)
+        elif chunk_id == b'data':
+            return size / byte_rate if byte_rate else None
+        else:
+            # 块按2字节对齐
+            fh.seek(size + size % 2, 1)
+
+
+# MPEG 音频帧头的码率（kbps）和采样率表，只处理 Layer III
+_MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+
+def mp3_duration(fh, file_size):
+    """
+    跳过 ID3v2 标签找到第一帧：有 Xing/Info/VBRI 头（VBR）时用总帧数计算，
+    否则按固定码率估算 (文件大小 - 标签) * 8 / 码率
+    """
+    head = fh.read(10)
+    offset = 0
+    if head[:3] == b'ID3' and len(head) == 10:
+        tag_size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        offset = 10 + tag_size + (10 if head[5] & 0x10 else 0)
+    fh.seek(offset)
+    data = fh.read(64 * 1024)
+    for index in range(len(data) - 4):
+        if data[index] != 0xFF or data[index + 1] & 0xE0 != 0xE0:
+            continue
+        b1, b2, b3 = data[index + 1], data[index + 2], data[index + 3]
+        version = {3: 1, 2: 2, 0: 2.5}.get((b1 >> 3) & 0x03)
+        layer = (b1 >> 1) & 0x03
+        bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 0x03
+        if version is None or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+            continue
+        bitrate = _MP3_BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+        sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+        samples_per_frame = 1152 if version == 1 else 576
+        mono = (b3 >> 6) == 3
+        frame = data[index:]
+
+        side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+        xing = frame[4 + side_info:4 + side_info + 12]
+        if xing[:4] in (b'Xing', b'Info') and struct.unpack('>I', xing[4:8])[0] & 0x01:
+            frames = struct.unpack('>I', xing[8:12])[0]
+            return frames * samples_per_frame / sample_rate
+        vbri = frame[36:36 + 18]
+        if vbri[:4] == b'VBRI':
+            frames = struct.unpack('>I', vbri[14:18])[0]
+            return frames * samples_per_frame / sample_rate
+        return (file_size - offset - index) * 8 / bitrate
+    return None
+
+
+# =============== PDF ===============
+_PDF_COUNT_RE = re.compile(rb'/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b')
+
+
+def pdf_page_count(fh, file_size):
+    if PdfReader is not None:
+        return len(PdfReader(fh).pages)
+    if file_size > PDF_SCAN_LIMIT:
+        return None
+    # 根 Pages 节点的 /Count 是总页数，也就是所有 Pages 字典里最大的那个；对象流压缩过的PDF找不到，返回None
+    counts = [int(a or b) for a, b in _PDF_COUNT_RE.findall(fh.read())]
+    return max(counts) if counts else None
+
+
+# =============== 提取入口 ===============
+def extract_metadata(file_id):
+    """读取文件并把结果写回数据库，返回写入的字段"""
+    from .models import UploadedFile
+    from .thumbnails import THUMBNAIL_TYPES, generate_thumbnail
+
+    uploaded = UploadedFile.objects.filter(pk=file_id).first()
+    if uploaded is None:
+        return None
+    name = uploaded.file.name
+    ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    fields = {'metadata_extracted_at': timezone.now()}
+    try:
+        with default_storage.open(name, 'rb') as fh:
+            head = fh.read(HEAD_SIZE)
+            sniffed = sniff_type(head, f'.{ext}', uploaded.file_size)
+            if sniffed:
+                fields['mime_type'], fields['file_type'] = sniffed
+            file_type = fields.get('file_type', uploaded.file_type)
+            mime_type = fields.get('mime_type', uploaded.mime_type)
+
+            fh.seek(0)
+            if file_type == 'image':
+                fields['width'], fields['height'], fields['orientation'] = image_info(fh)
+            elif mime_type in ('audio/wav', 'audio/x-wav'):
+                fields['duration'] = wav_duration(fh)
+            elif mime_type == 'audio/mpeg':
+                fields['duration'] = mp3_duration(fh, uploaded.file_size)
+            elif mime_type == 'application/pdf':
+                fields['page_count'] = pdf_page_count(fh, uploaded.file_size)
+
+            if not uploaded.file_hash:
+                # 单文件上传没有在请求里算哈希，这里补上
+                fh.seek(0)
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                    digest.update(chunk)
+                fields['file_hash'] = digest.hexdigest()
+    except FileNotFoundError:
+        logger.warning('元数据提取失败，文件不存在 file_id=%s', file_id)
+        return None
+    except (UnidentifiedImageError, Image.DecompressionBombError, struct.error, ValueError, OSError) as e:
+        # 文件头损坏时只记录类型，其他字段留空；下次不再重试
+        logger.warning('元数据提取失败 file_id=%s: %s', file_id, e)
+    except Exception as e:
+        # pypdf 对损坏文件会抛各种异常
+        logger.warning('元数据提取失败 file_id=%s: %s', file_id, e, exc_info=True)
+
+    UploadedFile.objects.filter(pk=file_id).update(**fields)
+    # 扩展名不对导致上传时没有排缩略图的，按真实类型补做
+    if fields.get('file_type') in THUMBNAIL_TYPES and uploaded.file_type not in THUMBNAIL_TYPES \
+            and not uploaded.thumbnail:
+        generate_thumbnail(file_id)
+    return fields
+
+
+def schedule_metadata(uploaded_file):
+    """上传记录保存后调用，事务提交后放到后台线程提取"""
+    run_after_commit('media', extract_metadata, uploaded_file.pk)
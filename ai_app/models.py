@@ -1,10 +1,21 @@
 # ai
 from django.contrib.auth.models import User, AbstractUser
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 import os
 import mimetypes
+import uuid
 from django.contrib.auth import get_user_model
+from constance.signals import config_updated
+from .cancellation import clear_default_timeout
+from .imaging import clear_profile
+from .keypool import clear_credentials
+from .routing import clear_candidates
+from .metadata import schedule_metadata
+from .thumbnails import schedule_thumbnail
 
 # 模型信息表
 class ModelInfo(models.Model):
@@ -34,15 +45,67 @@ class ModelInfo(models.Model):
         verbose_name="接口路径",
         default='/api/vision/'
     )
+    # 视觉/OCR接口的图片预处理（ai_app/imaging.py），留空使用 settings.IMAGE_PROFILES 的默认值
+    image_max_pixels = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="图片最大像素数",
+        help_text="上传前把图片缩小到这个像素数以内，应与模型自身的像素上限一致，如 qwen-vl-ocr 为 28*28*1280=1003520"
+    )
+    image_format = models.CharField(
+        max_length=10,
+        blank=True,
+        choices=(('JPEG', 'JPEG'), ('WEBP', 'WebP'), ('PNG', 'PNG')),
+        verbose_name="图片编码格式"
+    )
+    image_quality = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="图片编码质量",
+        help_text="1-100，文字识别建议90以上"
+    )
+    # 对冲请求（ai_app/hedging.py）的第二次调用发给这个模型，留空发给同一个模型
+    hedge_model = models.ForeignKey(
+        'self',
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='+',
+        verbose_name="对冲备用模型",
+        help_text="同类型、同接口的等价模型；调用超过平时耗时的90分位还没返回时，对冲请求发给它"
+    )
     
     def __str__(self):
         return f"{self.name} - {self.model} - {self.type} - {self.context} - {self.cost}"
+
+    def clean(self):
+        if self.hedge_model_id and self.hedge_model_id == self.pk:
+            raise ValidationError({'hedge_model': '不能选择自己'})
+        if self.hedge_model and self.hedge_model.type != self.type:
+            raise ValidationError({'hedge_model': '对冲备用模型必须与本模型类型相同'})
     
     class Meta:
         db_table = "ai_model_info"
         verbose_name = "所有接口配置"
         verbose_name_plural = verbose_name
 
+# 按扩展名判断文件类型
+FILE_TYPE_EXTENSIONS = {
+    'image': ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'),
+    'audio': ('.mp3', '.wav', '.ogg', '.m4a', '.flac'),
+    'video': ('.mp4', '.avi', '.mov', '.wmv', '.mkv', '.webm'),
+    'document': ('.pdf', '.doc', '.docx', '.txt', '.md', '.markdown'),
+}
+
+
+def guess_file_type(name):
+    ext = os.path.splitext(name)[1].lower()
+    for file_type, extensions in FILE_TYPE_EXTENSIONS.items():
+        if ext in extensions:
+            return file_type
+    return 'other'
+
+
 # 媒体资料列表
 class UploadedFile(models.Model):
     """上传文件模型"""
@@ -56,6 +119,7 @@ class UploadedFile(models.Model):
 
     file = models.FileField(
         upload_to='uploads/%Y/%m/%d/',
+        db_index=True,  # 孤儿文件扫描按文件名批量查询
         verbose_name="文件"
     )
     file_name = models.CharField(
@@ -87,8 +151,30 @@ class UploadedFile(models.Model):
         related_name='uploaded_files',
         default=1  # 设置默认用户ID
     )
+    file_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        db_index=True,
+        editable=False,
+        verbose_name="SHA-256"
+    )
+    thumbnail = models.FileField(
+        max_length=255,
+        blank=True,
+        editable=False,
+        db_index=True,
+        verbose_name="缩略图"
+    )
+    # 以下由后台元数据提取（ai_app/metadata.py）填写
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name="宽度")
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name="高度")
+    orientation = models.PositiveSmallIntegerField(null=True, blank=True, editable=False, verbose_name="EXIF方向")
+    duration = models.FloatField(null=True, blank=True, editable=False, db_index=True, verbose_name="时长(秒)")
+    page_count = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="页数")
+    metadata_extracted_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="元数据提取时间")
     
-    def save(self, *args, **kwargs):
+    def fill_file_fields(self):
+        """补全文件名、类型、大小和MIME类型；save 和批量上传（bulk_create 不调用 save）共用"""
         if not self.file_name:
             self.file_name = os.path.basename(self.file.name)
         else:
@@ -97,18 +183,9 @@ class UploadedFile(models.Model):
             new_name = os.path.splitext(self.file_name)[0]
             self.file_name = f"{new_name}{original_ext}"
         
-        # 自动判断文件类型
-        ext = os.path.splitext(self.file.name)[1].lower()
-        if ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-            self.file_type = 'image'
-        elif ext in ['.mp3', '.wav', '.ogg', '.m4a', '.flac']:
-            self.file_type = 'audio'
-        elif ext in ['.mp4', '.avi', '.mov', '.wmv', '.mkv', '.webm']:
-            self.file_type = 'video'
-        elif ext in ['.pdf', '.doc', '.docx', '.txt', '.md', '.markdown']:
-            self.file_type = 'document'
-        else:
-            self.file_type = 'other'
+        # 自动判断文件类型；已经按文件头识别过的不再用扩展名覆盖
+        if not self.file_type or self.metadata_extracted_at is None:
+            self.file_type = guess_file_type(self.file.name)
             
         # 设置文件大小
         if not self.file_size:
@@ -118,8 +195,18 @@ class UploadedFile(models.Model):
         if not self.mime_type:
             mime_type, _ = mimetypes.guess_type(self.file.name)
             self.mime_type = mime_type or 'application/octet-stream'
-            
+
+    def save(self, *args, **kwargs):
+        self.fill_file_fields()
         super().save(*args, **kwargs)
+        self.schedule_processing()
+
+    def schedule_processing(self):
+        """缩略图和元数据在事务提交后由后台线程处理，已经处理过的跳过"""
+        if not self.thumbnail:
+            schedule_thumbnail(self)
+        if self.metadata_extracted_at is None:
+            schedule_metadata(self)
 
     def __str__(self):
         return self.file_name
@@ -129,5 +216,220 @@ class UploadedFile(models.Model):
         verbose_name = "多媒体资料"
         verbose_name_plural = verbose_name
         ordering = ['-upload_time']
+        indexes = [
+            # 列表接口的游标分页和时间范围过滤
+            models.Index(fields=['-upload_time', '-id'], name='upload_time_idx'),
+            # 按类型 / 上传者过滤后再按时间翻页；后台列表按 file_type, -upload_time 排序也走第一个
+            models.Index(fields=['file_type', '-upload_time', '-id'], name='upload_type_time_idx'),
+            models.Index(fields=['uploader', '-upload_time', '-id'], name='upload_uploader_time_idx'),
+        ]
+
+
+
+
+@receiver(post_save, sender=ModelInfo)
+def clear_model_image_profile(sender, instance, **kwargs):
+    """后台修改了图片预处理参数、类型、接口路径、费用后立即生效"""
+    clear_profile(instance.model)
+    clear_candidates()
+
+
+@receiver(post_delete, sender=ModelInfo)
+def clear_model_candidates(sender, instance, **kwargs):
+    """后台删除模型后自动选模型立即不再选它"""
+    clear_candidates()
+
+
+@receiver(config_updated)
+def clear_api_timeout(sender, key, **kwargs):
+    """后台修改 API_TIMEOUT 后立即生效"""
+    if key == 'API_TIMEOUT':
+        clear_default_timeout()
+
+
+@receiver(post_delete, sender=UploadedFile)
+def delete_uploaded_blobs(sender, instance, **kwargs):
+    """通过ORM删除记录（单条、批量、级联）后删除存储里的原文件和缩略图，事务回滚时不删"""
+    blobs = [(field_file.storage, field_file.name) for field_file in (instance.file, instance.thumbnail) if field_file]
+
+    def remove():
+        for storage, name in blobs:
+            storage.delete(name)
+
+    transaction.on_commit(remove)
+
+
+# 内存分析采样
+class MemoryProfileSample(models.Model):
+    """内存分析采样记录，由 ai_app.profiling.MemoryProfilingMiddleware 写入"""
+    endpoint = models.CharField(max_length=100, db_index=True, verbose_name="接口")
+    method = models.CharField(max_length=10, verbose_name="请求方法")
+    status_code = models.PositiveSmallIntegerField(verbose_name="状态码")
+    request_bytes = models.BigIntegerField(default=0, verbose_name="请求体大小(字节)")
+    peak_bytes = models.BigIntegerField(verbose_name="峰值分配(字节)")
+    allocated_bytes = models.BigIntegerField(verbose_name="最高点已分配(字节)")
+    rss_bytes = models.BigIntegerField(null=True, blank=True, verbose_name="结束时RSS(字节)")
+    rss_growth_bytes = models.BigIntegerField(null=True, blank=True, verbose_name="RSS增长(字节)")
+    peak_rss_bytes = models.BigIntegerField(null=True, blank=True, verbose_name="进程峰值RSS(字节)")
+    top_sites = models.TextField(default='[]', verbose_name="分配最多的位置(JSON)")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="采样时间")
 
+    def __str__(self):
+        return f"{self.endpoint} - {self.created_at:%Y-%m-%d %H:%M:%S}"
+
+    class Meta:
+        db_table = 'ai_memory_profile'
+        verbose_name = "内存分析"
+        verbose_name_plural = verbose_name
+        ordering = ['-created_at']
+
+
+# 流式上游调用的用量
+class UpstreamUsage(models.Model):
+    """流式上游调用的用量记录，由 ai_app.cancellation.UpstreamStream 写入；客户端中途断开时记录已生成的部分"""
+    STATUS_CHOICES = (
+        ('completed', '正常结束'),
+        ('disconnected', '客户端断开'),
+        ('cancelled', '客户端取消'),
+        ('deadline', '超过截止时间'),
+        ('error', '上游出错'),
+    )
+    endpoint = models.CharField(max_length=100, db_index=True, verbose_name="接口")
+    model = models.CharField(max_length=100, verbose_name="模型")
+    user = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name="用户",
+        related_name='upstream_usages'
+    )
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, db_index=True, verbose_name="结束方式")
+    prompt_tokens = models.PositiveIntegerField(null=True, blank=True, verbose_name="输入token")
+    completion_tokens = models.PositiveIntegerField(null=True, blank=True, verbose_name="输出token",
+                                                    help_text="上游只在正常结束时返回，中途结束的为空")
+    total_tokens = models.PositiveIntegerField(null=True, blank=True, verbose_name="总token")
+    chunks = models.PositiveIntegerField(default=0, verbose_name="已接收块数")
+    text_chars = models.PositiveIntegerField(default=0, verbose_name="已输出字数")
+    audio_bytes = models.BigIntegerField(default=0, verbose_name="已输出音频(字节)")
+    duration_ms = models.PositiveIntegerField(default=0, verbose_name="耗时(毫秒)")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="记录时间")
+
+    def __str__(self):
+        return f"{self.endpoint} - {self.get_status_display()}"
+
+    class Meta:
+        db_table = 'ai_upstream_usage'
+        verbose_name = "上游用量"
+        verbose_name_plural = verbose_name
+        ordering = ['-created_at']
+
+
+# 上游API密钥池
+class ApiCredential(models.Model):
+    """上游服务商的API密钥，同一服务商可以配置多个，由 ai_app.keypool 分配给请求"""
+    PROVIDER_CHOICES = (
+        ('glm', '智谱GLM'),
+        ('dashscope', '通义千问（DashScope）'),
+        ('coze', 'Coze'),
+    )
+    provider = models.CharField(max_length=20, choices=PROVIDER_CHOICES, db_index=True, verbose_name="服务商")
+    name = models.CharField(max_length=100, verbose_name="名称", help_text="用于区分密钥，如账号名")
+    key = models.CharField(max_length=255, verbose_name="密钥")
+    enabled = models.BooleanField(default=True, verbose_name="启用")
+    rpm_limit = models.PositiveIntegerField(null=True, blank=True, verbose_name="每分钟请求上限",
+                                            help_text="账号的RPM限额，按剩余配额分配时使用；不填表示不限")
+    request_count = models.BigIntegerField(default=0, verbose_name="请求数")
+    error_count = models.BigIntegerField(default=0, verbose_name="出错数")
+    rate_limited_count = models.BigIntegerField(default=0, verbose_name="被限流次数")
+    last_used_at = models.DateTimeField(null=True, blank=True, verbose_name="最后使用时间")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+
+    def __str__(self):
+        return f"{self.get_provider_display()} - {self.name}"
 
+    class Meta:
+        db_table = 'ai_api_credential'
+        verbose_name = "API密钥"
+        verbose_name_plural = verbose_name
+        ordering = ['provider', 'id']
+
+
+@receiver(post_save, sender=ApiCredential)
+@receiver(post_delete, sender=ApiCredential)
+def clear_api_credentials(sender, **kwargs):
+    """后台增删改密钥后立即生效"""
+    clear_credentials()
+
+
+# 限流令牌桶（ai_app.ratelimit）
+class RateLimitBucket(models.Model):
+    """一个 (接口, 身份, 预算类型) 的令牌桶，多个 worker 进程用条件 UPDATE 原子地扣减"""
+    key = models.CharField(max_length=255, unique=True, verbose_name="桶")
+    level = models.FloatField(verbose_name="余量")
+    updated = models.FloatField(verbose_name="更新时间戳")
+
+    class Meta:
+        db_table = 'ai_rate_limit_bucket'
+        verbose_name = "限流令牌桶"
+        verbose_name_plural = verbose_name
+
+
+# 异步任务（ai_app.jobs）
+class AsyncJob(models.Model):
+    """客户端 async=true 提交的请求：保存原始请求，由 run_jobs 命令的 worker 进程领取执行，结果按任务ID查询"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, '排队中'),
+        (RUNNING, '执行中'),
+        (DONE, '已完成'),
+        (FAILED, '失败'),
+    )
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, verbose_name="任务ID")
+    endpoint = models.CharField(max_length=100, db_index=True, verbose_name="接口")
+    method = models.CharField(max_length=10, verbose_name="请求方法")
+    path = models.CharField(max_length=255, verbose_name="请求路径")
+    query_string = models.TextField(blank=True, verbose_name="查询参数")
+    content_type = models.CharField(max_length=255, blank=True, verbose_name="请求体类型")
+    request_body = models.BinaryField(verbose_name="请求体")
+    request_headers = models.JSONField(default=dict, verbose_name="请求头", help_text="不含 Cookie 和 Authorization")
+    user = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name="用户",
+        related_name='async_jobs'
+    )
+    session_key = models.CharField(max_length=40, blank=True, verbose_name="会话")
+    owner = models.CharField(max_length=150, db_index=True, verbose_name="提交者", help_text="登录用户或客户端IP，只有提交者能查询结果")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED, verbose_name="状态")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="执行次数")
+    worker = models.CharField(max_length=100, blank=True, verbose_name="执行进程")
+    lease_expires = models.DateTimeField(null=True, blank=True, verbose_name="租约到期时间",
+                                         help_text="worker 执行期间定时续期，进程退出后到期，任务由其他 worker 重新领取")
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name="响应状态码")
+    response_content_type = models.CharField(max_length=255, blank=True, verbose_name="响应类型")
+    response_body = models.BinaryField(null=True, blank=True, verbose_name="响应内容")
+    error = models.TextField(blank=True, verbose_name="错误信息")
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="提交时间")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="开始时间")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="结束时间")
+
+    def __str__(self):
+        return f"{self.endpoint} - {self.get_status_display()}"
+
+    class Meta:
+        db_table = 'ai_async_job'
+        verbose_name = "异步任务"
+        verbose_name_plural = verbose_name
+        ordering = ['-created_at']
+        indexes = [
+            # worker 按状态领取最早的任务
+            models.Index(fields=['status', 'created_at'], name='async_job_status_idx'),
+            # worker 定时删除完成超过保留时间的任务
+            models.Index(fields=['finished_at'], name='async_job_finished_idx'),
+        ]
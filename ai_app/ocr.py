@@ -0,0 +1,136 @@
+# ai_app/ocr.py
+"""
+文档OCR：多张图片或长图切块后并发识别，再按阅读顺序拼接
+- 每张图片先经 imaging.split_tall_image 切块（普通图片就是一块）
+- 所有块放进同一个线程池并发调用 qwen-vl-ocr，并发数有上限，总耗时接近识别一块的时间
+- 同一张图相邻块有重叠区域，拼接时按行对齐去掉重复的行
+"""
+import base64
+import re
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from openai import NOT_GIVEN
+
+from . import keypool
+from .imaging import split_tall_image
+from .retry import call_with_retry
+from .workers import with_request_context
+
+OCR_MODEL = 'qwen-vl-ocr'
+# 切口处最多有几行被截断（识别成半行或乱码）
+EDGE_LINES = 2
+
+
+def options():
+    result = {
+        'MAX_IMAGES': 20,
+        'MAX_TILES': 40,
+        'WORKERS': 4,
+        'TALL_RATIO': 2.0,
+        'TILE_OVERLAP': 0.1,
+    }
+    result.update(getattr(settings, 'OCR_DOCUMENT', {}))
+    return result
+
+
+def recognize(client, image, mime, question, max_pixels, timeout=NOT_GIVEN):
+    """识别一张图片（字节），返回文字；timeout 为上游超时秒数"""
+    completion = client.chat.completions.create(
+        model=OCR_MODEL,
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:{mime};base64,{base64.b64encode(image).decode('utf-8')}"},
+                        "min_pixels": 28 * 28 * 4,
+                        "max_pixels": max_pixels
+                    },
+                    {"type": "text", "text": question},
+                ],
+            }
+        ],
+        timeout=timeout
+    )
+    return completion.choices[0].message.content or ''
+
+
+def _normalize(line):
+    return re.sub(r'\s+', '', line)
+
+
+def stitch(texts):
+    """
+    把同一张图从上到下各块的识别结果拼成一段
+    前一块的末尾和后一块的开头是同一片重叠区域：在两块的相同行序列里找紧贴切口的那一段
+    （前一块之后、后一块之前最多 EDGE_LINES 行被切口截断的半行），前一块保留到这段为止，后一块从这段之后接上；
+    半行两边都丢掉，完整的那一行在另一块里。找不到重叠时直接接上
+    """
+    lines, previous = [], []
+    for text in texts:
+        current = [line.rstrip() for line in text.splitlines() if line.strip()]
+        overlap = _find_overlap(previous, current) if previous else None
+        if overlap:
+            dropped, start = overlap
+            del lines[len(lines) - dropped:]
+            lines.extend(current[start:])
+        else:
+            lines.extend(current)
+        previous = current
+    return '\n'.join(lines)
+
+
+def _find_overlap(previous, current):
+    """返回 (前一块末尾要丢掉的行数, 后一块从第几行接上)，没有重叠返回None"""
+    matcher = SequenceMatcher(None, [_normalize(line) for line in previous],
+                              [_normalize(line) for line in current], autojunk=False)
+    best = None
+    for a, b, size in matcher.get_matching_blocks():
+        trailing = len(previous) - a - size
+        if size and trailing <= EDGE_LINES and b <= EDGE_LINES and (best is None or size > best[2]):
+            best = (trailing, b, size)
+    if best is None:
+        return None
+    trailing, b, size = best
+    return trailing, b + size
+
+
+def split_images(images, profile):
+    """images: [(图片字节, 原MIME)]，返回每张图的块列表 [[(图片字节, MIME), ...], ...]"""
+    opts = options()
+    result = []
+    for data, original_mime in images:
+        tiles = split_tall_image(data, profile, opts['TALL_RATIO'], opts['TILE_OVERLAP'])
+        result.append([(tile, mime or original_mime or 'image/jpeg') for tile, mime in tiles])
+    return result
+
+
+def recognize_document(make_client, pages, question, max_pixels, deadline=None):
+    """
+    make_client(lease): 按密钥池分到的密钥返回 OpenAI 兼容客户端，每块单独分密钥
+    pages: split_images 的结果；所有块一起并发识别，返回每张图拼接后的文字
+    deadline: 请求的截止时间（cancellation.Deadline），排队的块开始识别时按剩余时间设超时，已超时的不再调用；
+              每块单独按重试策略重试，一块失败不用整份文档重来
+    """
+    jobs = [(index, tile, mime) for index, tiles in enumerate(pages) for tile, mime in tiles]
+    workers = max(1, min(options()['WORKERS'], len(jobs)))
+    # 线程池里沿用请求的追踪、排队通道和用户
+    @with_request_context
+    def run(job):
+        with keypool.acquire('dashscope') as lease:
+            if deadline is None:
+                return recognize(make_client(lease), job[1], job[2], question, max_pixels)
+            return call_with_retry(
+                lambda timeout: recognize(make_client(lease), job[1], job[2], question, max_pixels, timeout),
+                'dashscope', deadline, lease=lease)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        texts = list(pool.map(run, jobs))
+
+    per_page = [[] for _ in pages]
+    for (index, _, _), text in zip(jobs, texts):
+        per_page[index].append(text)
+    return [stitch(page_texts) for page_texts in per_page]
@@ -0,0 +1,99 @@
+# ai_app/omni.py
+"""
+Qwenomni 流式输出的解析和两种输出格式
+- text（默认，兼容旧客户端）：每个增量一行 audio:<base64> 或 text:<文字>
+- binary：分帧的二进制流，音频帧直接是解码后的 PCM，比 base64 少约 1/4 流量，客户端收到第一帧就能播放
+  每帧 = 1字节类型 + 4字节大端长度 + 数据
+    0 META   JSON，第一帧，音频参数 {"format": "pcm_s16le", "sample_rate": 24000, "channels": 1}
+    1 AUDIO  PCM 数据
+    2 TEXT   UTF-8 文字（语音的转写或文本回复）
+    3 ERROR  UTF-8 JSON {"error": ...}，之后流结束
+    4 END    空，正常结束
+"""
+import base64
+import binascii
+import json
+import struct
+
+FRAME_META = 0
+FRAME_AUDIO = 1
+FRAME_TEXT = 2
+FRAME_ERROR = 3
+FRAME_END = 4
+
+_FRAME_HEADER = struct.Struct('>BI')
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+# qwen-omni 的输出音频：24kHz 单声道 16bit PCM
+AUDIO_META = {'format': 'pcm_s16le', 'sample_rate': 24000, 'channels': 1}
+
+
+def _get(obj, name):
+    """SDK 版本不同，delta.audio 可能是字典也可能是对象"""
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def iter_deltas(completion):
+    """逐个产出 ('audio', base64字符串) 或 ('text', 文字)"""
+    for chunk in completion:
+        if not chunk.choices:
+            # 最后的 usage 块没有 choices
+            continue
+        delta = chunk.choices[0].delta
+        audio = getattr(delta, 'audio', None)
+        if audio:
+            transcript = _get(audio, 'transcript')
+            if transcript:
+                yield 'text', transcript
+            data = _get(audio, 'data')
+            if data:
+                yield 'audio', data
+            continue
+        content = getattr(delta, 'content', None)
+        if content:
+            yield 'text', content
+
+
+def encode_frame(kind, payload=b''):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return _FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+def meta_frame():
+    return encode_frame(FRAME_META, json.dumps(AUDIO_META))
+
+
+def error_frame(message):
+    return encode_frame(FRAME_ERROR, json.dumps({'error': message}, ensure_ascii=False))
+
+
+def end_frame():
+    return encode_frame(FRAME_END)
+
+
+def delta_frame(kind, value):
+    """把 iter_deltas 的一项编码成一帧，音频在这里解码一次"""
+    if kind == 'audio':
+        try:
+            return encode_frame(FRAME_AUDIO, base64.b64decode(value))
+        except (binascii.Error, ValueError):
+            return b''
+    return encode_frame(FRAME_TEXT, value)
+
+
+def delta_line(kind, value):
+    return f"{kind}:{value}\n"
+
+
+def parse_frames(data):
+    """解析二进制流，返回 [(类型, 数据)]；给测试和 Python 客户端用"""
+    frames = []
+    offset = 0
+    while offset + _FRAME_HEADER.size <= len(data):
+        kind, length = _FRAME_HEADER.unpack_from(data, offset)
+        offset += _FRAME_HEADER.size
+        frames.append((kind, data[offset:offset + length]))
+        offset += length
+    return frames
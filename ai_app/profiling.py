@@ -0,0 +1,207 @@
+# ai_app/profiling.py
+"""
+媒体类接口的内存分析（默认关闭，仅在 settings.MEMORY_PROFILING['ENABLED'] 打开时生效）
+按采样率对指定接口开启 tracemalloc，记录峰值分配、RSS 和分配最多的代码位置，
+结果写入 MemoryProfileSample，在后台“内存分析”页面查看
+tracemalloc 的峰值是进程级的，同一时间只采样一个请求；其他线程同时分配的内存也会计入
+"""
+import json
+import logging
+import random
+import sys
+import threading
+import tracemalloc
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from ai_app.tracing import current_trace
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.1,
+    # 按 URL name 匹配，后台自定义路由要带 admin: 前缀
+    'ENDPOINTS': [
+        'qwen-ocr-api',
+        'qwen-ocr-document-api',
+        'qwen-omni-api',
+        'qwen-audio-api',
+        'admin:uploaded-file-download',
+    ],
+    'TOP_N': 15,
+    'TRACE_FRAMES': 5,
+    # 后台用户在请求头带 X-Memory-Profile: 1 时强制采样
+    'FORCE_HEADER': 'HTTP_X_MEMORY_PROFILE',
+}
+
+# 流式响应每个分块检查一次已分配内存，比最高点多出这么多才重新拍快照
+STREAM_SNAPSHOT_STEP = 256 * 1024
+
+_lock = threading.Lock()
+_active = False  # 是否有请求正在采样，结束时关闭 tracemalloc
+_started_by_us = False
+
+
+def get_profiling_settings():
+    return {**DEFAULTS, **getattr(settings, 'MEMORY_PROFILING', {})}
+
+
+def current_rss():
+    """当前进程常驻内存（字节），拿不到时返回None"""
+    try:
+        with open('/proc/self/statm') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * resource.getpagesize() if resource else None
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss():
+    """进程生命周期内的峰值常驻内存（字节）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是KB，macOS 是字节
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _start_tracing(frames):
+    """开始采样；已有请求在采样时返回False（reset_peak 会打乱它的峰值）"""
+    global _active, _started_by_us
+    with _lock:
+        if _active:
+            return False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            _started_by_us = True
+        _active = True
+        tracemalloc.reset_peak()
+    return True
+
+
+def _stop_tracing():
+    global _active, _started_by_us
+    with _lock:
+        _active = False
+        if _started_by_us:
+            tracemalloc.stop()
+            _started_by_us = False
+
+
+class _RequestProfile:
+    """单次采样：在每个 trace 阶段结束时检查已分配内存，保留最高点的快照"""
+
+    def __init__(self, options, trace=None):
+        self.options = options
+        self.trace = trace
+        self.rss_before = current_rss()
+        self.baseline, _ = tracemalloc.get_traced_memory()
+        self.best_current = -1
+        self.best_snapshot = None
+
+    def checkpoint(self, stage_name=None, step=0):
+        traced_now, _ = tracemalloc.get_traced_memory()
+        if traced_now > self.best_current + step:
+            self.best_current = traced_now
+            self.best_snapshot = tracemalloc.take_snapshot()
+
+    def top_sites(self):
+        if self.best_snapshot is None:
+            return []
+        snapshot = self.best_snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        sites = []
+        for stat in snapshot.statistics('traceback')[:self.options['TOP_N']]:
+            sites.append({
+                'site': [f'{frame.filename}:{frame.lineno}' for frame in reversed(stat.traceback)],
+                'size': stat.size,
+                'count': stat.count,
+            })
+        return sites
+
+
+class MemoryProfilingMiddleware:
+    """按采样率对指定接口做内存分析，需放在 AuthenticationMiddleware 之后"""
+
+    def __init__(self, get_response):
+        self.options = get_profiling_settings()
+        if not self.options['ENABLED']:
+            raise MiddlewareNotUsed
+        self.endpoints = set(self.options['ENDPOINTS'])
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        profile = getattr(request, '_memory_profile', None)
+        if profile is None:
+            return response
+        if response.streaming:
+            # 流式接口（如 Qwenomni）的上游迭代和解码在发送响应时才发生，发送完再保存
+            response.streaming_content = self._finish_stream(request, response, profile, response.streaming_content)
+            return response
+        self._finish(request, response, profile)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not self._should_sample(request) or not _start_tracing(self.options['TRACE_FRAMES']):
+            return None
+        trace = current_trace()
+        profile = _RequestProfile(self.options, trace)
+        request._memory_profile = profile
+        if trace is not None:
+            trace.stage_listeners.append(profile.checkpoint)
+        return None
+
+    def _finish_stream(self, request, response, profile, content):
+        try:
+            for chunk in content:
+                profile.checkpoint('stream', STREAM_SNAPSHOT_STEP)
+                yield chunk
+        finally:
+            self._finish(request, response, profile)
+
+    def _finish(self, request, response, profile):
+        try:
+            profile.checkpoint('response')
+            _, peak = tracemalloc.get_traced_memory()
+            self._save(request, response, profile, peak)
+        except Exception:
+            logger.exception('保存内存分析结果失败')
+        finally:
+            if profile.trace is not None:
+                profile.trace.stage_listeners.remove(profile.checkpoint)
+            _stop_tracing()
+
+    def _should_sample(self, request):
+        match = request.resolver_match
+        if match is None or match.view_name not in self.endpoints:
+            return False
+        if request.META.get(self.options['FORCE_HEADER']) == '1' and request.user.is_staff:
+            return True
+        return random.random() < self.options['SAMPLE_RATE']
+
+    def _save(self, request, response, profile, peak):
+        from ai_app.models import MemoryProfileSample
+
+        rss_after = current_rss()
+        MemoryProfileSample.objects.create(
+            endpoint=request.resolver_match.view_name,
+            method=request.method,
+            status_code=response.status_code,
+            request_bytes=int(request.META.get('CONTENT_LENGTH') or 0),
+            peak_bytes=max(peak - profile.baseline, 0),
+            allocated_bytes=max(profile.best_current - profile.baseline, 0),
+            rss_bytes=rss_after,
+            rss_growth_bytes=(rss_after - profile.rss_before) if rss_after and profile.rss_before else None,
+            peak_rss_bytes=peak_rss(),
+            top_sites=json.dumps(profile.top_sites(), ensure_ascii=False),
+        )
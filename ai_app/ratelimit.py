@@ -0,0 +1,311 @@
+# ai_app/ratelimit.py
+"""
+按 (身份, 接口) 的令牌桶限流，防止单个客户端用光上游配额、拖慢其他人
+- 身份：登录用户按用户ID（直接读会话，不查用户表），未登录按客户端IP
+- 每个接口两个桶：请求数桶每次请求扣 1；token 桶在响应后按上游返回的用量扣（可以扣成负数，补回正数前拒绝）
+  桶容量为每 PERIOD 秒的预算，按匀速补充，允许短时突发到容量
+- 超限在视图执行前直接返回 429（不解析请求体、不读后台配置），带 Retry-After；所有响应都带 X-RateLimit-* 头
+桶存在数据库表 ai_rate_limit_bucket 里，多个 gunicorn worker 共用同一份预算：扣请求数用带条件的 UPDATE
+（补充后的余量够扣才扣），由数据库保证原子性，并发请求不会一起越过上限；每个受限请求一次查询加一次更新
+"""
+import math
+import time
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import IntegrityError, transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Greatest, Least
+from django.db.models.lookups import GreaterThanOrEqual
+from django.http import JsonResponse
+
+from .tracing import annotate, current_trace
+
+REQUESTS = 'requests'
+TOKENS = 'tokens'
+
+# 调用上游模型的接口（URL name），默认按 DEFAULT 限流
+ENDPOINTS = (
+    'glm-4-api',
+    'glm-4v-api',
+    'glm-cog-api',
+    'glm-cogvideo-api',
+    'glm-4-voice-api',
+    'coze-chat-api',
+    'qwen-chat-api',
+    'qwen-chat-file-api',
+    'qwen-chat-toke-api',
+    'qwen-ocr-api',
+    'qwen-ocr-document-api',
+    'qwen-omni-api',
+    'qwen-audio-api',
+    'qwen-vl-api',
+    'qwen-deeskeep-api',
+)
+
+# 闲置桶的清理间隔（秒，按进程）
+PURGE_SECONDS = 300
+_last_purge = 0
+
+
+def options():
+    result = {
+        'ENABLED': True,
+        'PERIOD': 60,
+        'DEFAULT': {'REQUESTS': 60, 'TOKENS': None},
+        'ENDPOINTS': {},
+        'CLIENT_IP_HEADER': None,
+    }
+    result.update(getattr(settings, 'RATE_LIMITS', {}))
+    return result
+
+
+def get_limits(endpoint, opts=None):
+    """接口的预算 {'requests': 次数, 'tokens': token数}，不限流返回None；ENDPOINTS 里设为 None 表示不限"""
+    opts = opts or options()
+    override = opts['ENDPOINTS'].get(endpoint, {})
+    if override is None or (endpoint not in ENDPOINTS and endpoint not in opts['ENDPOINTS']):
+        return None
+    merged = {**opts['DEFAULT'], **override}
+    limits = {kind: merged.get(kind.upper()) for kind in (REQUESTS, TOKENS)}
+    return limits if any(limits.values()) else None
+
+
+# =============== 身份 ===============
+def client_ip(request, header=None):
+    """反向代理后面部署时设置 CLIENT_IP_HEADER（如 HTTP_X_FORWARDED_FOR），取第一个地址"""
+    if header and request.META.get(header):
+        return request.META[header].split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def identity(request, opts=None):
+    session = getattr(request, 'session', None)
+    user_id = session.get(SESSION_KEY) if session is not None else None
+    if user_id:
+        return f'user:{user_id}'
+    return f'ip:{client_ip(request, (opts or options())["CLIENT_IP_HEADER"])}'
+
+
+# =============== 令牌桶 ===============
+def _key(endpoint, who, kind):
+    return f'ai_app:ratelimit:{endpoint}:{who}:{kind}'
+
+
+class Bucket:
+    """容量 capacity，每 period 秒补满；level 为当前余量，token 桶可以为负"""
+
+    def __init__(self, capacity, period, level=None, updated=None):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.level = capacity if level is None else level
+        self.updated = updated or time.time()
+
+    def refill(self, now):
+        # 多个进程的时钟可能有细微差别，不往回扣
+        self.level = min(self.capacity, self.level + max(0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, cost):
+        """余量不够扣 cost 时还要等的秒数；token 桶 cost 为 0，要求余量为正"""
+        if self.level >= cost and (cost or self.level > 0):
+            return 0
+        return max(1, math.ceil((cost - self.level) / self.rate))
+
+    @property
+    def reset(self):
+        """补满还要的秒数"""
+        return math.ceil(max(0, self.capacity - self.level) / self.rate)
+
+    def state(self):
+        return (self.level, self.updated)
+
+
+def _refilled(bucket, now):
+    """数据库里按时间补充后的余量表达式，和 Bucket.refill 的算法一致"""
+    elapsed = Greatest(Value(now) - F('updated'), Value(0.0), output_field=FloatField())
+    return Least(F('level') + elapsed * Value(bucket.rate), Value(float(bucket.capacity)), output_field=FloatField())
+
+
+def _load(keys, limits, period, now):
+    from .models import RateLimitBucket
+
+    stored = {key: (level, updated) for key, level, updated in
+              RateLimitBucket.objects.filter(key__in=list(keys.values())).values_list('key', 'level', 'updated')}
+    buckets = {}
+    for kind, key in keys.items():
+        level, updated = stored.get(key) or (None, None)
+        bucket = Bucket(limits[kind], period, level, updated or now)
+        bucket.refill(now)
+        buckets[kind] = bucket
+    return buckets, stored
+
+
+def _create(key, level, now):
+    """第一次使用时建桶，另一个进程刚好先建了返回False"""
+    from .models import RateLimitBucket
+
+    try:
+        with transaction.atomic():
+            RateLimitBucket.objects.create(key=key, level=level, updated=now)
+        return True
+    except IntegrityError:
+        return False
+
+
+def _take(key, bucket, now, exists):
+    """原子地扣 1，补充后的余量不够时不扣，返回是否扣成功"""
+    from .models import RateLimitBucket
+
+    if not exists and _create(key, bucket.capacity - 1, now):
+        return True
+    refilled = _refilled(bucket, now)
+    # level 写在 updated 前面：MySQL 按顺序赋值，后面的表达式会看到前面刚写的值
+    return RateLimitBucket.objects.filter(GreaterThanOrEqual(refilled, 1.0), key=key).update(
+        level=refilled - Value(1.0), updated=now) == 1
+
+
+def _maybe_purge(now, period):
+    """闲置两个周期的桶已经补满（token 桶最多欠一个周期），删掉和满桶等价"""
+    global _last_purge
+    if now - _last_purge < PURGE_SECONDS:
+        return
+    _last_purge = now
+    from .models import RateLimitBucket
+
+    RateLimitBucket.objects.filter(updated__lt=now - 2 * period).delete()
+
+
+def acquire(endpoint, who, limits, period):
+    """请求数桶扣 1，token 桶只检查余量；返回 (是否放行, 需要等待的秒数, 各桶)"""
+    keys = {kind: _key(endpoint, who, kind) for kind, limit in limits.items() if limit}
+    now = time.time()
+    _maybe_purge(now, period)
+    buckets, stored = _load(keys, limits, period, now)
+    costs = {REQUESTS: 1, TOKENS: 0}
+    wait = max(bucket.wait(costs[kind]) for kind, bucket in buckets.items())
+    if wait:
+        return False, wait, buckets
+    if REQUESTS in buckets:
+        bucket = buckets[REQUESTS]
+        if not _take(keys[REQUESTS], bucket, now, keys[REQUESTS] in stored):
+            # 读出来够扣，扣的时候被其他进程的并发请求用完了
+            return False, max(1, bucket.wait(1)), buckets
+        bucket.level -= 1
+    return True, 0, buckets
+
+
+def charge_tokens(endpoint, who, limits, period, tokens, bucket=None):
+    """
+    响应后按实际用量扣 token 桶，最多欠一个周期的预算
+    bucket 为放行时读出的 token 桶，按它算出扣后的余量返回（用于响应头，不再查一次）；不传时从数据库读
+    """
+    from .models import RateLimitBucket
+
+    if not limits.get(TOKENS) or not tokens:
+        return None
+    key = _key(endpoint, who, TOKENS)
+    now = time.time()
+    full = Bucket(limits[TOKENS], period)
+    charged = RateLimitBucket.objects.filter(key=key).update(
+        level=Greatest(_refilled(full, now) - Value(float(tokens)), Value(float(-full.capacity)),
+                       output_field=FloatField()),
+        updated=now)
+    if not charged and not _create(key, max(-full.capacity, full.capacity - tokens), now):
+        # 另一个进程刚建了桶
+        return charge_tokens(endpoint, who, limits, period, tokens, bucket)
+    if bucket is None:
+        return _load({TOKENS: key}, limits, period, now)[0][TOKENS]
+    bucket.refill(now)
+    bucket.level = max(-bucket.capacity, bucket.level - tokens)
+    return bucket
+
+
+def usage_tokens(usage):
+    """从上游返回的 usage（对象或字典，OpenAI / 智谱 / DashScope 格式）取总 token 数"""
+    if not usage:
+        return None
+
+    def get(name):
+        value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+        return value if isinstance(value, (int, float)) else None
+
+    total = get('total_tokens')
+    if total is None:
+        parts = [get(name) for name in ('prompt_tokens', 'completion_tokens', 'input_tokens', 'output_tokens')]
+        total = sum(part for part in parts if part) or None
+    return total
+
+
+def record_usage(usage):
+    """视图拿到上游用量后调用，记在请求追踪里，响应后由中间件扣 token 桶"""
+    annotate(tokens=usage_tokens(usage))
+
+
+# =============== 中间件 ===============
+def _headers(response, buckets):
+    for kind, bucket in buckets.items():
+        suffix = '' if kind == REQUESTS else '-Tokens'
+        response[f'X-RateLimit-Limit{suffix}'] = str(bucket.capacity)
+        response[f'X-RateLimit-Remaining{suffix}'] = str(max(0, math.floor(bucket.level)))
+        response[f'X-RateLimit-Reset{suffix}'] = str(bucket.reset)
+
+
+class RateLimitMiddleware:
+    """按接口限流，需放在 SessionMiddleware 之后；settings.RATE_LIMITS['ENABLED'] 为 False 时不加载"""
+
+    def __init__(self, get_response):
+        if not options()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        state = getattr(request, '_rate_limit', None)
+        if state is None:
+            return response
+        if response.streaming:
+            # 流式响应的用量在输出结束后才知道，头里是扣费前的余量
+            _headers(response, state['buckets'])
+            response.streaming_content = self._charge_after(request, state, response.streaming_content)
+            return response
+        bucket = self._charge(request, state)
+        if bucket is not None:
+            state['buckets'][TOKENS] = bucket
+        _headers(response, state['buckets'])
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match is None:
+            return None
+        opts = options()
+        limits = get_limits(match.view_name, opts)
+        if limits is None:
+            return None
+        who = identity(request, opts)
+        allowed, wait, buckets = acquire(match.view_name, who, limits, opts['PERIOD'])
+        if not allowed:
+            annotate(rate_limited=who)
+            response = JsonResponse({'error': f'请求过于频繁，请 {wait} 秒后重试'}, status=429,
+                                    json_dumps_params={'ensure_ascii': False})
+            response['Retry-After'] = str(wait)
+            _headers(response, buckets)
+            return response
+        request._rate_limit = {'endpoint': match.view_name, 'who': who, 'limits': limits,
+                               'period': opts['PERIOD'], 'buckets': buckets}
+        return None
+
+    @staticmethod
+    def _charge(request, state):
+        trace = getattr(request, 'trace', None) or current_trace()
+        tokens = trace.meta.get('tokens') if trace is not None else None
+        return charge_tokens(state['endpoint'], state['who'], state['limits'], state['period'], tokens,
+                             state['buckets'].get(TOKENS))
+
+    def _charge_after(self, request, state, content):
+        try:
+            yield from content
+        finally:
+            self._charge(request, state)
@@ -0,0 +1,190 @@
+# ai_app/retention.py
+"""
+上传文件保留策略和垃圾回收
+- 过期记录：按 settings.RETENTION['TTL_DAYS'] 每种文件类型的保留天数，按主键分批删除（原文件由 post_delete 信号删除）
+- 孤儿文件：遍历存储，每批文件名用一次 IN 查询对照数据库，存储里有、数据库里没有的删掉
+- 临时文件：temp_files/ 下超过保留时间的文件（接口异常退出时留下的）
+全程按批处理，文件数量上百万也不会全部读进内存
+"""
+import logging
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 会被扫描孤儿文件的存储目录（相对 MEDIA_ROOT）
+SCAN_DIRS = ('uploads', 'thumbnails')
+
+
+def policy():
+    options = {
+        'TTL_DAYS': {},
+        'BATCH_SIZE': 500,
+        'ORPHAN_MIN_AGE_HOURS': 24,
+        'TEMP_FILES_TTL_HOURS': 6,
+    }
+    options.update(getattr(settings, 'RETENTION', {}))
+    return options
+
+
+class Report:
+    """每一类清理的文件数和释放的字节数"""
+
+    def __init__(self):
+        self.items = {}
+
+    def add(self, category, count, size):
+        files, total = self.items.get(category, (0, 0))
+        self.items[category] = (files + count, total + size)
+
+    @property
+    def total_bytes(self):
+        return sum(size for _, size in self.items.values())
+
+    def lines(self):
+        return [f"{category}: {files} 个文件，{format_bytes(size)}" for category, (files, size) in self.items.items()]
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.2f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+    return f"{size:.2f} TB"
+
+
+# =============== 过期记录 ===============
+def expired_queryset(now=None):
+    """所有超过保留期的记录；没有配置或配置为None的类型永久保留"""
+    from .models import UploadedFile
+
+    now = now or timezone.now()
+    condition = Q()
+    for file_type, days in policy()['TTL_DAYS'].items():
+        if days is not None:
+            condition |= Q(file_type=file_type, upload_time__lt=now - timedelta(days=days))
+    if not condition:
+        return UploadedFile.objects.none()
+    return UploadedFile.objects.filter(condition)
+
+
+def delete_uploaded_files(queryset, batch_size=None, dry_run=False, report=None, category='过期记录'):
+    """
+    按主键分批删除，每批一个事务；原文件和缩略图由 post_delete 信号在事务提交后删除
+    用主键游标而不是 OFFSET 分页，删除过程中后面的批次不会错位
+    """
+    from .models import UploadedFile
+
+    batch_size = batch_size or policy()['BATCH_SIZE']
+    report = report or Report()
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'file_size')[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        if not dry_run:
+            with transaction.atomic():
+                UploadedFile.objects.filter(pk__in=[pk for pk, _ in batch]).delete()
+        report.add(category, len(batch), sum(size or 0 for _, size in batch))
+    return report
+
+
+# =============== 孤儿文件 ===============
+def iter_storage_files(storage, path):
+    """逐个目录列出存储里的文件，按需生成，不会一次性列出全部"""
+    try:
+        directories, files = storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for name in files:
+        yield f"{path}/{name}" if path else name
+    for directory in directories:
+        yield from iter_storage_files(storage, f"{path}/{directory}" if path else directory)
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def find_orphans(storage=None, batch_size=None, min_age_hours=None):
+    """
+    生成 (文件名, 大小)：存储里有但没有任何记录引用（原文件或缩略图）的文件
+    刚写入的文件可能是还没插入记录的批量上传，不到 min_age_hours 的跳过
+    """
+    from .models import UploadedFile
+
+    storage = storage or default_storage
+    options = policy()
+    batch_size = batch_size or options['BATCH_SIZE']
+    min_age_hours = options['ORPHAN_MIN_AGE_HOURS'] if min_age_hours is None else min_age_hours
+    cutoff = timezone.now() - timedelta(hours=min_age_hours)
+
+    for directory in SCAN_DIRS:
+        for names in _chunks(iter_storage_files(storage, directory), batch_size):
+            referenced = set(UploadedFile.objects.filter(file__in=names).values_list('file', flat=True))
+            referenced.update(UploadedFile.objects.filter(thumbnail__in=names).values_list('thumbnail', flat=True))
+            for name in names:
+                if name in referenced:
+                    continue
+                try:
+                    if storage.get_modified_time(name) > cutoff:
+                        continue
+                    size = storage.size(name)
+                except FileNotFoundError:
+                    continue
+                yield name, size
+
+
+def purge_orphans(storage=None, dry_run=False, report=None):
+    storage = storage or default_storage
+    report = report or Report()
+    for name, size in find_orphans(storage):
+        if not dry_run:
+            storage.delete(name)
+        report.add('孤儿文件', 1, size)
+    return report
+
+
+# =============== 临时文件 ===============
+def purge_temp_files(root=None, dry_run=False, report=None):
+    """删除 temp_files/ 下超时的文件和空目录"""
+    root = root or settings.TEMP_FILES_ROOT
+    report = report or Report()
+    if not os.path.isdir(root):
+        return report
+    cutoff = time.time() - policy()['TEMP_FILES_TTL_HOURS'] * 3600
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime > cutoff:
+                    continue
+                if not dry_run:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
+            report.add('临时文件', 1, stat.st_size)
+        if dirpath != root and not dry_run:
+            try:
+                # 只删超时的空目录（刚建好还没写入文件的目录不能删），还有文件时 rmdir 会失败
+                if os.stat(dirpath).st_mtime <= cutoff:
+                    os.rmdir(dirpath)
+            except OSError:
+                pass
+    return report
@@ -0,0 +1,274 @@
+# ai_app/retry.py
+"""
+上游调用的重试策略
+- 按错误类别决定最多调用几次（settings.UPSTREAM_RETRY['ATTEMPTS']，可按服务商覆盖）：
+    rate_limit  429 限流，上游没有处理这次请求
+    connect     连接没建立（连不上、连接超时），请求没发出去
+    connection  连接中途断开，上游可能已经处理
+    server      500/502/503/504
+    timeout     读超时，截止时间基本已用完，默认不重试
+    auth        401/403 密钥无效或没有权限，只在密钥池里还有别的密钥时换一个重试
+- 两次调用之间按指数退避加全抖动（0 ~ BASE_DELAY*2^n 之间随机，不超过 MAX_DELAY）等待，上游返回 Retry-After 时至少等这么久
+- 重试的总时间不超过后台配置 API_TIMEOUT，也不超过请求的截止时间，等不起的直接放弃，返回最后一次的错误
+- 会产生新任务的调用（如 CogVideoX 生成视频）传 idempotent=False，只重试上游肯定没处理的 rate_limit 和 connect；
+  同时带上幂等键（客户端 Idempotency-Key 请求头，没有时每个请求生成一个），客户端拿同一个键重发时直接返回第一次的结果；
+  幂等键存在多进程共用的缓存（settings.CACHES['shared']）里，重发的请求落到别的 worker 也能查到
+- 传入密钥池的 lease 时，限流和认证错误让当前密钥冷却，换另一个密钥立即重试（不等待，最多把池里的密钥试一遍）
+SDK 自带的重试都关掉了（max_retries=0），避免和这里叠加成几倍的调用次数
+"""
+import email.utils
+import logging
+import random
+import re
+import time
+import uuid
+
+import httpx
+import openai
+import requests
+import zhipuai
+from cozepy import CozeAPIError
+from django.conf import settings
+from django.core.cache import caches
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from .cancellation import TIMEOUT_ERRORS, default_timeout, options as deadline_options
+from .tracing import annotate
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT = 'rate_limit'
+CONNECT = 'connect'
+CONNECTION = 'connection'
+SERVER = 'server'
+TIMEOUT = 'timeout'
+AUTH = 'auth'
+# 上游肯定没有处理的错误，不幂等的调用也可以重试
+SAFE_CLASSES = (RATE_LIMIT, CONNECT, AUTH)
+SERVER_STATUS = (500, 502, 503, 504)
+AUTH_STATUS = (401, 403)
+# Coze 的业务错误码：4013 请求频率超限，4100 令牌无效，4101 令牌没有权限
+COZE_CODES = {4013: RATE_LIMIT, 4100: AUTH, 4101: AUTH}
+
+SHARED_CACHE = 'shared'
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+_IDEMPOTENCY_KEY_RE = re.compile(r'^[A-Za-z0-9_.:-]{1,64}$')
+_PENDING = '__pending__'
+
+
+def options():
+    result = {
+        'BASE_DELAY': 0.5,
+        'MAX_DELAY': 8,
+        'ATTEMPTS': {RATE_LIMIT: 4, CONNECT: 3, CONNECTION: 2, SERVER: 2, TIMEOUT: 1, AUTH: 1},
+        'PROVIDERS': {},
+        'IDEMPOTENCY_SECONDS': 24 * 3600,
+    }
+    result.update(getattr(settings, 'UPSTREAM_RETRY', {}))
+    return result
+
+
+def get_policy(provider):
+    """服务商的重试参数：PROVIDERS[provider] 覆盖默认值，ATTEMPTS 按类别合并"""
+    opts = options()
+    override = opts['PROVIDERS'].get(provider, {})
+    return {
+        'BASE_DELAY': override.get('BASE_DELAY', opts['BASE_DELAY']),
+        'MAX_DELAY': override.get('MAX_DELAY', opts['MAX_DELAY']),
+        'ATTEMPTS': {**opts['ATTEMPTS'], **override.get('ATTEMPTS', {})},
+    }
+
+
+# =============== 错误分类 ===============
+def _is_connect_error(exc):
+    """连接是否根本没建立（请求没发出去）"""
+    if isinstance(exc, (requests.exceptions.ConnectTimeout, httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    if isinstance(exc, (openai.APIConnectionError, zhipuai.APIConnectionError)):
+        return isinstance(exc.__cause__, (httpx.ConnectError, httpx.ConnectTimeout))
+    return False
+
+
+def _status_code(exc):
+    response = getattr(exc, 'response', None)
+    code = getattr(response, 'status_code', None) or getattr(exc, 'status_code', None)
+    if code is None and isinstance(exc, CozeAPIError):
+        # 响应不是JSON时 cozepy 把 HTTP 状态码放在 code 里，其余情况 code 是业务错误码
+        code = exc.code
+    return int(code) if code else None
+
+
+def parse_retry_after(headers):
+    """Retry-After 可以是秒数或HTTP日期，返回秒数，没有或解析不了返回None"""
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(exc):
+    """返回 (错误类别, Retry-After秒数)，不值得重试的类别为None"""
+    if _is_connect_error(exc):
+        return CONNECT, None
+    if isinstance(exc, TIMEOUT_ERRORS):
+        return TIMEOUT, None
+    if isinstance(exc, (requests.exceptions.ConnectionError, httpx.TransportError,
+                        openai.APIConnectionError, zhipuai.APIConnectionError)):
+        return CONNECTION, None
+    code = _status_code(exc)
+    retry_after = parse_retry_after(getattr(getattr(exc, 'response', None), 'headers', None))
+    if code == 429:
+        return RATE_LIMIT, retry_after
+    if code in SERVER_STATUS:
+        return SERVER, retry_after
+    if code in AUTH_STATUS:
+        return AUTH, None
+    if isinstance(exc, CozeAPIError) and code in COZE_CODES:
+        return COZE_CODES[code], None
+    return None, None
+
+
+def classify_dashscope(response):
+    """dashscope 原生SDK出错时不抛异常，返回带 status_code 的响应"""
+    code = getattr(response, 'status_code', 200)
+    if code == 429:
+        return RATE_LIMIT
+    if code in SERVER_STATUS:
+        return SERVER
+    if code in AUTH_STATUS:
+        return AUTH
+    return None
+
+
+# =============== 重试 ===============
+class _RetryableResult(Exception):
+    """check 认为需要重试的返回结果，重试次数用完时把结果原样返回"""
+
+    def __init__(self, result, error_class):
+        super().__init__(error_class)
+        self.result = result
+        self.error_class = error_class
+
+
+def backoff(attempt, policy):
+    """第 attempt 次重试前等待的秒数（全抖动）"""
+    return random.uniform(0, min(policy['MAX_DELAY'], policy['BASE_DELAY'] * 2 ** (attempt - 1)))
+
+
+def call_with_retry(fn, provider, deadline, idempotent=True, check=None, lease=None):
+    """
+    fn(timeout) 调用一次上游并返回结果，timeout 为本次调用可用的秒数
+    provider: 'glm' / 'dashscope' / 'coze'，取对应的重试策略
+    idempotent: 重复调用是否无害，False 时只重试 rate_limit、connect 和 auth
+    check(result): 返回错误类别表示这个结果需要重试（dashscope 原生SDK出错时不抛异常）
+    lease: keypool.acquire 的结果，fn 每次调用时从 lease 取密钥，限流和认证错误时换密钥
+    """
+    policy = get_policy(provider)
+    # 重试的总时间不超过 API_TIMEOUT
+    budget_ends = time.monotonic() + default_timeout()
+    attempt = 0
+    rotated = 0
+    while True:
+        attempt += 1
+        try:
+            result = fn(deadline.timeout())
+            error_class = check(result) if check is not None else None
+            if error_class is None:
+                if attempt + rotated > 1:
+                    annotate(retries=attempt + rotated - 1)
+                return result
+            raise _RetryableResult(result, error_class)
+        except _RetryableResult as e:
+            error_class, retry_after, error = e.error_class, None, e
+        except Exception as e:
+            error_class, retry_after = classify(e)
+            error = e
+            if error_class is None:
+                raise
+
+        if lease is not None and error_class in (RATE_LIMIT, AUTH):
+            lease.failed(error_class, retry_after)
+            if lease.rotate():
+                # 换了密钥，不用等待，也不计入这类错误的次数
+                logger.warning('上游调用失败（%s），换密钥 %s 重试', error_class, lease.credential.name,
+                               extra={'provider': provider})
+                attempt -= 1
+                rotated += 1
+                continue
+
+        delay = max(backoff(attempt, policy), retry_after or 0)
+        allowed = policy['ATTEMPTS'].get(error_class, 1)
+        give_up = (attempt >= allowed
+                   or (not idempotent and error_class not in SAFE_CLASSES)
+                   or time.monotonic() + delay >= min(budget_ends, deadline.expires))
+        if give_up:
+            annotate(retries=attempt + rotated - 1)
+            if isinstance(error, _RetryableResult):
+                return error.result
+            raise error
+        logger.warning('上游调用失败（%s），%.2f秒后第%s次重试: %s', error_class, delay, attempt, error,
+                       extra={'provider': provider})
+        time.sleep(delay)
+
+
+# =============== 幂等键 ===============
+def shared_cache():
+    """多个 worker 进程共用的缓存 settings.CACHES['shared']；没有配置时退回默认缓存，只在本进程内有效"""
+    return caches[SHARED_CACHE if SHARED_CACHE in settings.CACHES else 'default']
+
+
+class IdempotencyConflict(Exception):
+    """同一个幂等键的请求还在处理中"""
+
+
+def idempotency_key(request):
+    """客户端的 Idempotency-Key 请求头，没有时生成一个（只用于本次请求内的重试）；返回 (键, 是否客户端提供)"""
+    key = request.META.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return uuid.uuid4().hex, False
+    if not _IDEMPOTENCY_KEY_RE.match(key):
+        raise ValueError('Idempotency-Key 只能包含字母、数字和 _.:-，最长64个字符')
+    return key, True
+
+
+def _cache_key(scope, key):
+    return f'ai_app:idempotency:{scope}:{key}'
+
+
+def claim(scope, key):
+    """
+    占用幂等键：第一次使用返回None，之前成功过返回当时保存的结果
+    同一个键的请求还在处理中时抛 IdempotencyConflict
+    """
+    cache_key = _cache_key(scope, key)
+    # 处理中的标记最多保留一个请求的最长截止时间，进程中途退出也不会一直占着
+    seconds = deadline_options()['MAX_SECONDS']
+    cache = shared_cache()
+    if cache.add(cache_key, _PENDING, seconds):
+        return None
+    stored = cache.get(cache_key)
+    if stored is None and cache.add(cache_key, _PENDING, seconds):
+        # 刚好过期或被释放
+        return None
+    if stored is None or stored == _PENDING:
+        raise IdempotencyConflict(key)
+    return stored
+
+
+def remember(scope, key, result):
+    shared_cache().set(_cache_key(scope, key), result, options()['IDEMPOTENCY_SECONDS'])
+
+
+def release(scope, key):
+    """调用失败时释放幂等键，客户端可以用同一个键重试"""
+    shared_cache().delete(_cache_key(scope, key))
@@ -0,0 +1,318 @@
+# ai_app/routing.py
+"""
+按实际表现自动选模型：客户端传 model=auto:<类型>（如 auto:chat）时，从后台“所有接口配置”里同类型、
+接口路径是当前接口的模型中挑一个
+- 候选：类型相同，且模型标识以该接口对应的前缀开头（ENDPOINT_MODELS，如 GLM-4 接口为 glm-），
+  或者“接口路径”填的就是当前接口（用来加入其他前缀的模型）；已有的配置不用逐条修改
+- 每个 (接口, 模型) 记录最近调用的耗时、出错率、吞吐量（token/秒）的指数移动平均（EWMA），指定模型的普通调用也计入
+- 得分 = 平均耗时 × (1 + ERROR_PENALTY × 出错率)，挑得分最低的；得分相同时吞吐量高的优先
+- 样本不到 MIN_SAMPLES 的模型先轮流试；另有 EXPLORE 的比例改选最久没有样本的其他模型，变快的模型能被重新发现
+- 范围：客户端可以用 models=a,b 缩小候选；费用上限取 max_cost 参数或 settings.MODEL_ROUTING['MAX_COST']，
+  按 ModelInfo.cost 里的第一个数字比较（“免费”为0，填不出数字的模型在有上限时不参与）
+- 可见性：响应头 X-Model-Route（如 “auto:chat qwen-turbo best”），请求日志里的 route 字段，
+  每 STATS_SECONDS 秒一条“模型路由统计”日志（各模型的平均值和被选中次数）
+统计按进程记录，多个 worker 各自学习
+"""
+import contextvars
+import logging
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .cancellation import TIMEOUT_ERRORS
+from .tracing import annotate, current_trace
+
+logger = logging.getLogger(__name__)
+
+AUTO_PREFIX = 'auto:'
+ROUTE_HEADER = 'X-Model-Route'
+
+# 选中原因
+BEST = 'best'
+WARMUP = 'warmup'
+EXPLORE = 'explore'
+
+_NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+_FREE_WORDS = ('免费', 'free')
+_current = contextvars.ContextVar('ai_app_model_route', default=None)
+
+
+def options():
+    result = {
+        'ENABLED': True,
+        'ALPHA': 0.2,
+        'ERROR_PENALTY': 4,
+        'MIN_SAMPLES': 3,
+        'EXPLORE': 0.05,
+        'MAX_COST': None,
+        'CANDIDATES_SECONDS': 60,
+        'STATS_SECONDS': 60,
+        # 接口（URL name）能调用的模型标识前缀
+        'ENDPOINT_MODELS': {
+            'glm-4-api': ('glm-',),
+            'glm-4v-api': ('glm-',),
+            'qwen-chat-api': ('qwen',),
+        },
+    }
+    result.update(getattr(settings, 'MODEL_ROUTING', {}))
+    return result
+
+
+class NoCandidate(ValueError):
+    """auto:<类型> 没有可选的模型"""
+
+
+def is_auto(model):
+    return isinstance(model, str) and model.startswith(AUTO_PREFIX)
+
+
+def parse_cost(text):
+    """ModelInfo.cost 是给人看的费用说明，取第一个数字；写了“免费”为0，取不出返回None"""
+    text = (text or '').strip()
+    if not text:
+        return None
+    if any(word in text.lower() for word in _FREE_WORDS):
+        return 0.0
+    match = _NUMBER_RE.search(text)
+    return float(match.group()) if match else None
+
+
+# =============== 统计 ===============
+class ModelStats:
+    """一个 (接口, 模型) 的 EWMA；出错率按 0/1 平均，吞吐量只在拿到 token 数时更新"""
+
+    def __init__(self):
+        self.samples = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.throughput = None
+        self.picked = defaultdict(int)
+        self.updated = None
+
+    def observe(self, seconds, error, tokens, alpha):
+        self.samples += 1
+        self.updated = time.time()
+        self.error_rate += alpha * ((1.0 if error else 0.0) - self.error_rate)
+        if error:
+            # 出错的调用耗时不代表模型的速度（可能是立即被拒），只计入出错率
+            return
+        self.latency = seconds if self.latency is None else self.latency + alpha * (seconds - self.latency)
+        if tokens and seconds > 0:
+            rate = tokens / seconds
+            self.throughput = rate if self.throughput is None else self.throughput + alpha * (rate - self.throughput)
+
+    def score(self, penalty):
+        if self.latency is None:
+            return None
+        return self.latency * (1 + penalty * self.error_rate)
+
+    def as_dict(self, penalty):
+        score = self.score(penalty)
+        return {
+            'samples': self.samples,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'error_rate': round(self.error_rate, 3),
+            'tokens_per_second': round(self.throughput, 1) if self.throughput is not None else None,
+            'score': round(score, 3) if score is not None else None,
+            'picked': dict(self.picked),
+        }
+
+
+_lock = threading.Lock()
+_stats = defaultdict(ModelStats)
+_last_stats = time.monotonic()
+
+
+def observe(key, seconds, error=False, tokens=None):
+    """记录一次上游调用，key 为 (接口, 模型)"""
+    opts = options()
+    with _lock:
+        _stats[key].observe(seconds, error, tokens, opts['ALPHA'])
+    _maybe_log_stats(opts)
+
+
+def is_upstream_error(exc):
+    """超时、连接失败、限流、5xx 算模型出错；参数错误之类的 4xx 是请求本身的问题，不算"""
+    from .retry import classify
+
+    return isinstance(exc, TIMEOUT_ERRORS) or classify(exc)[0] is not None
+
+
+class measure:
+    """
+    统计一次上游调用：
+        with routing.measure('glm-4-api', model) as call:
+            ...
+            call.error = True  # 没抛异常但上游返回了错误（如 dashscope 原生SDK）
+    token 数取请求追踪里 record_usage 记的 tokens
+    """
+
+    def __init__(self, endpoint, model):
+        self.key = (endpoint, model)
+        self.error = False
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        error = self.error or (exc is not None and is_upstream_error(exc))
+        if exc is not None and not error:
+            # 请求本身有问题，这次调用不说明模型好坏
+            return False
+        trace = current_trace()
+        tokens = trace.meta.get('tokens') if trace is not None else None
+        observe(self.key, time.monotonic() - self.started, error, tokens)
+        return False
+
+
+def stats():
+    """本进程各 (接口, 模型) 的统计"""
+    penalty = options()['ERROR_PENALTY']
+    with _lock:
+        return {f'{endpoint}:{model}': item.as_dict(penalty) for (endpoint, model), item in _stats.items()}
+
+
+def _maybe_log_stats(opts):
+    global _last_stats
+    now = time.monotonic()
+    with _lock:
+        if now - _last_stats < opts['STATS_SECONDS']:
+            return
+        _last_stats = now
+    logger.info('模型路由统计', extra={'routing': stats()})
+
+
+# =============== 候选模型 ===============
+_candidates = {}
+
+
+def _normalize_path(path):
+    return (path or '').strip().strip('/').lower()
+
+
+def candidates(model_type, endpoint, path, opts=None):
+    """
+    接口 endpoint（URL name，请求路径为 path）可以调用的、类型为 model_type 的模型 [(模型标识, 费用)]，缓存 CANDIDATES_SECONDS 秒
+    模型标识以 ENDPOINT_MODELS[endpoint] 里的前缀开头，或者接口路径填的是 path
+    """
+    opts = opts or options()
+    prefixes = tuple(prefix.lower() for prefix in opts['ENDPOINT_MODELS'].get(endpoint, ()))
+    key = (model_type, endpoint, _normalize_path(path))
+    cached = _candidates.get(key)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < opts['CANDIDATES_SECONDS']:
+        return cached[1]
+    from .models import ModelInfo
+
+    rows = ModelInfo.objects.filter(type=model_type).values_list('model', 'api_endpoint', 'cost').order_by('id')
+    result = [(model, parse_cost(cost)) for model, api_endpoint, cost in rows
+              if model.strip().lower().startswith(prefixes) or _normalize_path(api_endpoint) == key[2]]
+    _candidates[key] = (now, result)
+    return result
+
+
+def clear_candidates():
+    _candidates.clear()
+
+
+# =============== 选择 ===============
+class Route:
+    def __init__(self, requested, model, reason, endpoint):
+        self.requested = requested
+        self.model = model
+        self.reason = reason
+        self.endpoint = endpoint
+
+    def __str__(self):
+        return f'{self.requested} {self.model} {self.reason}'
+
+
+def _max_cost(request, opts):
+    value = request.data.get('max_cost')
+    if value in (None, ''):
+        return opts['MAX_COST']
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise NoCandidate('max_cost 必须是数字')
+
+
+def _score(item, opts):
+    score = item.score(opts['ERROR_PENALTY'])
+    return float('inf') if score is None else score
+
+
+def resolve(request, requested, endpoint):
+    """
+    requested 为 auto:<类型> 时按统计挑一个模型返回，其余原样返回
+    endpoint 为接口的 URL name，和 measure 的一致；没有符合条件的模型时抛 NoCandidate
+    """
+    if not is_auto(requested):
+        return requested
+    opts = options()
+    if not opts['ENABLED']:
+        raise NoCandidate('未启用自动选模型，请指定模型')
+    model_type = requested[len(AUTO_PREFIX):]
+    pool = candidates(model_type, endpoint, request.path, opts)
+    allowed = request.data.get('models')
+    if allowed:
+        names = {name.strip() for name in str(allowed).split(',') if name.strip()}
+        pool = [item for item in pool if item[0] in names]
+    ceiling = _max_cost(request, opts)
+    if ceiling is not None:
+        pool = [item for item in pool if item[1] is not None and item[1] <= ceiling]
+    if not pool:
+        raise NoCandidate(f'没有可用于 {requested} 的模型（后台“所有接口配置”里类型为 {model_type}、'
+                          f'模型标识符合本接口或接口路径为 {request.path} 的模型）')
+
+    models = [model for model, _ in pool]
+    with _lock:
+        current = {model: _stats.get((endpoint, model)) for model in models}
+        untried = [model for model in models if current[model] is None or current[model].samples < opts['MIN_SAMPLES']]
+        if untried:
+            # 样本少的先试，按样本数轮流
+            model = min(untried, key=lambda name: (current[name].samples if current[name] else 0, random.random()))
+            reason = WARMUP
+        else:
+            # 一直出错、没有成功耗时的模型排最后，只在探索时试
+            ranked = sorted(models, key=lambda name: (_score(current[name], opts), -(current[name].throughput or 0)))
+            model, reason = ranked[0], BEST
+            if len(ranked) > 1 and random.random() < opts['EXPLORE']:
+                # 试最久没有样本的那个，各模型轮流刷新
+                model, reason = min(ranked[1:], key=lambda name: current[name].updated or 0), EXPLORE
+        _stats[(endpoint, model)].picked[reason] += 1
+
+    route = Route(requested, model, reason, endpoint)
+    annotate(route=str(route))
+    holder = _current.get()
+    if holder is not None:
+        holder.append(route)
+    return model
+
+
+# =============== 中间件 ===============
+class ModelRoutingMiddleware:
+    """把本次请求的路由结果写到响应头 X-Model-Route；settings.MODEL_ROUTING['ENABLED'] 为 False 时不加载"""
+
+    def __init__(self, get_response):
+        if not options()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # 放一个列表进上下文，视图在线程池里运行（ASGI）时也能把结果带回来
+        holder = []
+        token = _current.set(holder)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        if holder:
+            response[ROUTE_HEADER] = str(holder[-1])
+        return response
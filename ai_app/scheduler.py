@@ -0,0 +1,339 @@
+# ai_app/scheduler.py
+"""
+上游调用的排队调度：每个服务商在本进程里最多同时 SLOTS 个调用，满了按加权公平排队
+- 通道：interactive（流式对话、实时语音）、standard、batch（长文档、文档OCR、生成视频），按接口划分，
+  客户端可以用请求头 X-Priority 把自己的请求降到更低的通道，不能升
+- 公平：先按通道权重分（占用上游的时间按权重折算，权重高的通道排在前面），同一通道里按用户轮流，
+  一个用户排了很多长任务也只占自己那一份；batch 最多占 MAX_SHARE 比例的槽位，给其他通道留出空位
+- 防饿死：排队超过通道 MAX_WAIT 秒的请求不看权重，下一个空位直接给它
+- 排队超过 QUEUE_TIMEOUT 秒放弃，视图返回 504
+- 统计：每个通道最近的排队时间（p50 / p95 / 最大），每 STATS_SECONDS 秒写一条日志；请求的排队时间记在 Server-Timing 的 queue 阶段
+keypool.acquire 里申请槽位，Lease.release 时归还，所以所有经过密钥池的上游调用都会排队
+槽位按进程计算，同步 worker（每进程一个线程）不会排队，需要用 gthread worker 或 ASGI 部署
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .cancellation import DeadlineExceeded
+from .tracing import annotate, trace_stage
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+STANDARD = 'standard'
+BATCH = 'batch'
+LANES = (INTERACTIVE, STANDARD, BATCH)
+
+PRIORITY_HEADER = 'HTTP_X_PRIORITY'
+
+# 当前请求的 (通道, 用户)，中间件按接口设置；线程池、流式生成器里要用 bind 带过去
+_current = contextvars.ContextVar('ai_app_scheduler_job', default=None)
+
+
+def options():
+    result = {
+        'ENABLED': True,
+        'SLOTS': {'glm': 16, 'dashscope': 16, 'coze': 16},
+        'LANES': {
+            INTERACTIVE: {'WEIGHT': 8, 'MAX_WAIT': 2},
+            STANDARD: {'WEIGHT': 4, 'MAX_WAIT': 10},
+            BATCH: {'WEIGHT': 1, 'MAX_WAIT': 30, 'MAX_SHARE': 0.5},
+        },
+        'ENDPOINT_LANES': {
+            'qwen-omni-api': INTERACTIVE,
+            'coze-chat-api': INTERACTIVE,
+            'qwen-chat-file-api': BATCH,
+            'qwen-ocr-document-api': BATCH,
+            'glm-cogvideo-api': BATCH,
+        },
+        'QUEUE_TIMEOUT': 30,
+        'STATS_SECONDS': 60,
+    }
+    result.update(getattr(settings, 'UPSTREAM_SCHEDULER', {}))
+    return result
+
+
+class QueueTimeout(DeadlineExceeded):
+    """排队等上游空位超时"""
+
+
+class Job:
+    def __init__(self, lane=STANDARD, tenant='anonymous'):
+        self.lane = lane
+        self.tenant = tenant
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def bind(job):
+    """在线程池或流式生成器里沿用请求的通道和用户"""
+    token = _current.set(job)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def lane_for(endpoint, requested=None, opts=None):
+    """接口默认的通道；请求头要求的通道优先级更低时用请求头的"""
+    lane = (opts or options())['ENDPOINT_LANES'].get(endpoint, STANDARD)
+    if requested in LANES and LANES.index(requested) > LANES.index(lane):
+        return requested
+    return lane
+
+
+# =============== 排队 ===============
+class _Waiter:
+    __slots__ = ('lane', 'tenant', 'enqueued', 'granted', 'event')
+
+    def __init__(self, lane, tenant):
+        self.lane = lane
+        self.tenant = tenant
+        self.enqueued = time.monotonic()
+        self.granted = None
+        self.event = threading.Event()
+
+
+class Slot:
+    """占用的一个上游空位，release 后交给下一个排队的请求"""
+
+    def __init__(self, queue, lane, tenant, charged):
+        self.queue = queue
+        self.lane = lane
+        self.tenant = tenant
+        self.charged = charged
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.queue.release(self)
+
+
+class _NullSlot:
+    def release(self):
+        pass
+
+
+class FairQueue:
+    """
+    一个服务商的空位和等待队列
+    调度用步进（stride）方式的加权公平排队：每个通道、每个用户有一个“已用量”，
+    分到空位时按预计占用时间除以权重累加，归还时按实际占用时间修正，每次挑已用量最少的
+    """
+
+    def __init__(self, provider, slots):
+        self.provider = provider
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.active = 0
+        self.lane_active = defaultdict(int)
+        # 通道 -> 用户 -> 排队的请求（同一用户按先后顺序）
+        self.waiting = {lane: {} for lane in LANES}
+        self.lane_pass = defaultdict(float)
+        self.tenant_pass = {lane: {} for lane in LANES}
+        self.lane_vtime = defaultdict(float)
+        self.vtime = 0.0
+        # 各通道一次调用平均占用的秒数，分空位时按它预扣
+        self.cost = defaultdict(lambda: 1.0)
+        self.waits = {lane: deque(maxlen=1000) for lane in LANES}
+
+    def _weight(self, lane, opts):
+        return opts['LANES'].get(lane, {}).get('WEIGHT', 1)
+
+    def _cap(self, lane, opts):
+        share = opts['LANES'].get(lane, {}).get('MAX_SHARE')
+        return max(1, int(self.slots * share)) if share else self.slots
+
+    def _has_waiting(self, lane):
+        return any(self.waiting[lane].values())
+
+    def admit(self, lane, tenant, timeout, opts):
+        with self.lock:
+            waiter = _Waiter(lane, tenant)
+            if not self._has_waiting(lane):
+                # 闲置的通道不能攒下额度，回来时从当前进度开始
+                self.lane_pass[lane] = max(self.lane_pass[lane], self.vtime)
+            tenants = self.waiting[lane]
+            if not tenants.get(tenant):
+                passes = self.tenant_pass[lane]
+                passes[tenant] = max(passes.get(tenant, 0.0), self.lane_vtime[lane])
+            tenants.setdefault(tenant, deque()).append(waiter)
+            self._dispatch(opts)
+        if not waiter.event.is_set():
+            with trace_stage('queue'):
+                waiter.event.wait(timeout)
+            with self.lock:
+                if waiter.granted is None:
+                    self._remove(waiter)
+                    raise QueueTimeout(f'等待上游空位超过 {timeout:g} 秒（{self.provider}）')
+        return waiter.granted
+
+    def _remove(self, waiter):
+        queue = self.waiting[waiter.lane].get(waiter.tenant)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+        if not queue:
+            self.waiting[waiter.lane].pop(waiter.tenant, None)
+
+    def _pick(self, opts):
+        """下一个该分到空位的请求，调用方持有锁"""
+        now = time.monotonic()
+        lanes = [lane for lane in LANES
+                 if self._has_waiting(lane) and self.lane_active[lane] < self._cap(lane, opts)]
+        if not lanes:
+            return None
+        # 防饿死：等太久的请求优先
+        starving = []
+        for lane in lanes:
+            max_wait = opts['LANES'].get(lane, {}).get('MAX_WAIT')
+            for queue in self.waiting[lane].values():
+                if queue and max_wait is not None and now - queue[0].enqueued >= max_wait:
+                    starving.append(queue[0])
+        if starving:
+            return min(starving, key=lambda w: w.enqueued)
+        lane = min(lanes, key=lambda name: (self.lane_pass[name], LANES.index(name)))
+        passes = self.tenant_pass[lane]
+        tenant = min((t for t, queue in self.waiting[lane].items() if queue),
+                     key=lambda t: (passes.get(t, 0.0), self.waiting[lane][t][0].enqueued))
+        return self.waiting[lane][tenant][0]
+
+    def _dispatch(self, opts):
+        while self.active < self.slots:
+            waiter = self._pick(opts)
+            if waiter is None:
+                return
+            lane, tenant = waiter.lane, waiter.tenant
+            self._remove(waiter)
+            charged = self.cost[lane]
+            # 当前进度取正在分配的这一个的起点，闲置后回来的通道和用户从这里开始
+            self.vtime = self.lane_pass[lane]
+            self.lane_pass[lane] += charged / self._weight(lane, opts)
+            passes = self.tenant_pass[lane]
+            self.lane_vtime[lane] = passes.get(tenant, 0.0)
+            passes[tenant] = passes.get(tenant, 0.0) + charged
+            self.active += 1
+            self.lane_active[lane] += 1
+            self.waits[lane].append(time.monotonic() - waiter.enqueued)
+            waiter.granted = Slot(self, lane, tenant, charged)
+            waiter.event.set()
+
+    def release(self, slot):
+        opts = options()
+        held = time.monotonic() - slot.started
+        with self.lock:
+            self.active -= 1
+            self.lane_active[slot.lane] -= 1
+            # 按实际占用时间修正预扣的量，并更新这个通道的平均占用时间
+            self.lane_pass[slot.lane] += (held - slot.charged) / self._weight(slot.lane, opts)
+            passes = self.tenant_pass[slot.lane]
+            if slot.tenant in passes:
+                passes[slot.tenant] += held - slot.charged
+                if slot.tenant not in self.waiting[slot.lane] and passes[slot.tenant] <= self.lane_vtime[slot.lane]:
+                    # 没在排队的用户回来时本来就从当前进度开始，不用留着
+                    del passes[slot.tenant]
+            self.cost[slot.lane] = 0.8 * self.cost[slot.lane] + 0.2 * max(held, 0.01)
+            self._dispatch(opts)
+        _maybe_log_stats(opts)
+
+    def stats(self):
+        with self.lock:
+            lanes = {}
+            for lane in LANES:
+                waits = sorted(self.waits[lane])
+                lanes[lane] = {
+                    'active': self.lane_active[lane],
+                    'queued': sum(len(queue) for queue in self.waiting[lane].values()),
+                    'samples': len(waits),
+                    'p50_ms': _percentile_ms(waits, 0.5),
+                    'p95_ms': _percentile_ms(waits, 0.95),
+                    'max_ms': _percentile_ms(waits, 1.0),
+                }
+            return {'slots': self.slots, 'active': self.active, 'lanes': lanes}
+
+
+def _percentile_ms(values, fraction):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 1)
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+_last_stats = time.monotonic()
+
+
+def get_queue(provider, opts=None):
+    queue = _queues.get(provider)
+    if queue is None:
+        with _queues_lock:
+            queue = _queues.get(provider)
+            if queue is None:
+                slots = (opts or options())['SLOTS'].get(provider, 16)
+                queue = _queues[provider] = FairQueue(provider, slots)
+    return queue
+
+
+def admit(provider):
+    """申请服务商的一个空位，排队时阻塞；返回的 Slot 用完必须 release（keypool 的 Lease 负责）"""
+    opts = options()
+    if not opts['ENABLED']:
+        return _NullSlot()
+    job = current() or Job()
+    slot = get_queue(provider, opts).admit(job.lane, job.tenant, opts['QUEUE_TIMEOUT'], opts)
+    annotate(lane=job.lane)
+    return slot
+
+
+def stats():
+    """本进程各服务商、各通道的排队情况"""
+    return {provider: queue.stats() for provider, queue in list(_queues.items())}
+
+
+def _maybe_log_stats(opts):
+    global _last_stats
+    now = time.monotonic()
+    with _queues_lock:
+        if now - _last_stats < opts['STATS_SECONDS']:
+            return
+        _last_stats = now
+    logger.info('上游排队统计', extra={'scheduler': stats()})
+
+
+# =============== 中间件 ===============
+class SchedulerMiddleware:
+    """按接口给请求分通道，用户按登录用户或IP区分；需放在 SessionMiddleware 之后"""
+
+    def __init__(self, get_response):
+        if not options()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = _current.set(None)
+        try:
+            return self.get_response(request)
+        finally:
+            _current.reset(token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        from .ratelimit import identity
+
+        match = request.resolver_match
+        if match is None:
+            return None
+        requested = (request.META.get(PRIORITY_HEADER) or '').strip().lower()
+        _current.set(Job(lane_for(match.view_name, requested), identity(request)))
+        return None
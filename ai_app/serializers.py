@@ -0,0 +1,35 @@
+# ai_app/serializers.py
+from rest_framework import serializers
+from rest_framework.pagination import CursorPagination
+
+from ai_app.models import UploadedFile
+
+
+class UploadedFileSerializer(serializers.ModelSerializer):
+    """媒体资料列表，字段与上传接口的返回保持一致"""
+    file_url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+    uploader_name = serializers.CharField(source='uploader.username', read_only=True)
+
+    class Meta:
+        model = UploadedFile
+        fields = ('id', 'file_name', 'file_type', 'file_size', 'mime_type', 'upload_time',
+                  'file_url', 'thumbnail_url', 'uploader_id', 'uploader_name',
+                  'width', 'height', 'orientation', 'duration', 'page_count')
+
+    def get_file_url(self, obj):
+        return obj.file.url
+
+    def get_thumbnail_url(self, obj):
+        return obj.thumbnail.url if obj.thumbnail else None
+
+
+class UploadedFilePagination(CursorPagination):
+    """
+    游标分页：按 (upload_time, id) 定位下一页，不用 OFFSET，翻到第1000页和第1页一样快
+    排序与 UploadedFile.Meta.indexes 里的索引一致
+    """
+    ordering = ('-upload_time', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
@@ -0,0 +1,125 @@
+# ai_app/thumbnails.py
+"""
+媒体库缩略图
+上传后在后台线程生成小尺寸 WebP（Pillow 不支持 WebP 时用 JPEG），存到 thumbnails/ 下，目录结构与原文件相同
+图片直接缩放；视频在装了 ffmpeg 时截取一帧做封面，没有 ffmpeg 时后台只显示占位图
+"""
+import io
+import logging
+import os
+import shutil
+import subprocess
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from .workers import run_after_commit
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_TYPES = ('image', 'video')
+
+
+def _options():
+    options = {'ENABLED': True, 'SIZE': (320, 320), 'FORMAT': 'WEBP', 'QUALITY': 80, 'VIDEO_FRAME_AT': 1}
+    options.update(getattr(settings, 'THUMBNAILS', {}))
+    return options
+
+
+def _output_format(options):
+    fmt = options['FORMAT'].upper()
+    if fmt == 'WEBP' and not features.check('webp'):
+        return 'JPEG'
+    return fmt
+
+
+def thumbnail_name(file_name, fmt):
+    """uploads/2025/01/01/a.png -> thumbnails/uploads/2025/01/01/a.webp"""
+    ext = '.webp' if fmt == 'WEBP' else '.jpg'
+    return f"thumbnails/{os.path.splitext(file_name)[0]}{ext}"
+
+
+def _render(image, options, fmt):
+    # JPEG 按目标尺寸直接解码成缩小的图，大照片省很多内存和CPU；其他格式忽略
+    image.draft('RGB', tuple(options['SIZE']))
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail(tuple(options['SIZE']), Image.Resampling.LANCZOS)
+    has_alpha = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    if fmt == 'JPEG' or not has_alpha:
+        if has_alpha:
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+    elif image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=options['QUALITY'])
+    return buffer.getvalue()
+
+
+def _video_frame(file_name, options):
+    """用 ffmpeg 截一帧 PNG，没有 ffmpeg 或存储不在本地磁盘时返回None"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        return None
+    try:
+        path = default_storage.path(file_name)
+    except NotImplementedError:
+        return None
+    for offset in (options['VIDEO_FRAME_AT'], 0):
+        try:
+            result = subprocess.run(
+                [ffmpeg, '-v', 'error', '-ss', str(offset), '-i', path,
+                 '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'],
+                capture_output=True, timeout=30, check=False,
+            )
+        except subprocess.TimeoutExpired:
+            return None
+        # 视频比截帧时间点还短时没有输出，退回第0秒再试一次
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+    return None
+
+
+def generate_thumbnail(file_id, force=False):
+    """生成缩略图并写回 thumbnail 字段，返回缩略图路径；不支持的类型或生成失败返回None"""
+    from .models import UploadedFile
+
+    uploaded = UploadedFile.objects.filter(pk=file_id).only('file', 'file_type', 'thumbnail').first()
+    if uploaded is None or uploaded.file_type not in THUMBNAIL_TYPES:
+        return None
+    if uploaded.thumbnail and not force:
+        return uploaded.thumbnail.name
+
+    options = _options()
+    fmt = _output_format(options)
+    try:
+        if uploaded.file_type == 'image':
+            with default_storage.open(uploaded.file.name, 'rb') as fh, Image.open(fh) as image:
+                data = _render(image, options, fmt)
+        else:
+            frame = _video_frame(uploaded.file.name, options)
+            if frame is None:
+                return None
+            with Image.open(io.BytesIO(frame)) as image:
+                data = _render(image, options, fmt)
+    except (FileNotFoundError, UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        logger.warning('缩略图生成失败 file_id=%s: %s', file_id, e)
+        return None
+
+    if uploaded.thumbnail:
+        uploaded.thumbnail.delete(save=False)
+    name = default_storage.save(thumbnail_name(uploaded.file.name, fmt), ContentFile(data))
+    UploadedFile.objects.filter(pk=file_id).update(thumbnail=name)
+    return name
+
+
+def schedule_thumbnail(uploaded_file):
+    """上传记录保存后调用，事务提交后放到后台线程生成"""
+    if not _options()['ENABLED'] or uploaded_file.file_type not in THUMBNAIL_TYPES:
+        return
+    run_after_commit('media', generate_thumbnail, uploaded_file.pk)
@@ -0,0 +1,183 @@
+# ai_app/tracing.py
+"""
+请求分阶段计时
+视图里用 trace_stage('upstream') 标记阶段，中间件把耗时写回 Server-Timing 响应头，
+超过阈值的请求写入慢请求日志（包含完整阶段明细、模型和载荷大小）
+"""
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import FileResponse
+
+slow_logger = logging.getLogger('ai_app.slow_requests')
+
+_current_trace = contextvars.ContextVar('ai_app_request_trace', default=None)
+
+
+class RequestTrace:
+    """单个请求的阶段耗时记录"""
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.stages = {}  # 阶段名 -> [总耗时ms, 次数]，保持首次出现的顺序
+        self.meta = {}
+        self.stage_listeners = []  # 每个阶段结束时回调 listener(stage_name)，内存分析用
+
+    def add_stage(self, name, duration_ms):
+        entry = self.stages.setdefault(name, [0.0, 0])
+        entry[0] += duration_ms
+        entry[1] += 1
+        for listener in self.stage_listeners:
+            listener(name)
+
+    def annotate(self, **kwargs):
+        self.meta.update({k: v for k, v in kwargs.items() if v is not None})
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self, total_ms=None):
+        """生成 Server-Timing 头的值"""
+        parts = []
+        for name, (duration, count) in self.stages.items():
+            item = f'{name};dur={duration:.1f}'
+            if count > 1:
+                item += f';desc="x{count}"'
+            parts.append(item)
+        parts.append(f'total;dur={total_ms if total_ms is not None else self.elapsed_ms():.1f}')
+        return ', '.join(parts)
+
+    def as_dict(self, total_ms=None):
+        return {
+            'method': self.method,
+            'path': self.path,
+            'total_ms': round(total_ms if total_ms is not None else self.elapsed_ms(), 1),
+            'stages': {name: round(duration, 1) for name, (duration, _) in self.stages.items()},
+            **self.meta,
+        }
+
+
+def current_trace():
+    """获取当前请求的trace，不在请求上下文中时返回None"""
+    return _current_trace.get()
+
+
+def annotate(**kwargs):
+    """给当前请求附加信息，例如 model、upload_bytes、upstream_bytes"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.annotate(**kwargs)
+
+
+@contextmanager
+def trace_stage(name):
+    """标记一个阶段：with trace_stage('encode'): ..."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, (time.perf_counter() - start) * 1000)
+
+
+@contextmanager
+def background_trace(method, path):
+    """在请求之外执行视图（如异步任务 worker）时建立trace上下文：with background_trace('POST', path) as trace: ..."""
+    trace = RequestTrace(method, path)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+class TracedConfig:
+    """包装constance配置，每次读取都计入 config 阶段（数据库后端每次读取都会查库）"""
+
+    def __init__(self, config):
+        object.__setattr__(self, '_config', config)
+
+    def __getattr__(self, name):
+        with trace_stage('config'):
+            return getattr(self._config, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._config, name, value)
+
+
+def _slow_threshold_ms():
+    return getattr(settings, 'SLOW_REQUEST_THRESHOLD_MS', 3000)
+
+
+def _log_if_slow(trace, total_ms):
+    threshold = _slow_threshold_ms()
+    if threshold is not None and total_ms >= threshold:
+        slow_logger.warning('慢请求: %s', json.dumps(trace.as_dict(total_ms), ensure_ascii=False))
+
+
+class RequestTracingMiddleware:
+    """请求计时中间件：建立trace上下文，写 Server-Timing 头，记录慢请求"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        trace = RequestTrace(request.method, request.path)
+        trace.annotate(request_bytes=int(request.META.get('CONTENT_LENGTH') or 0))
+        request.trace = trace
+        token = _current_trace.set(trace)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_trace.reset(token)
+
+        trace.annotate(status=response.status_code)
+        if isinstance(response, FileResponse):
+            # 不包装文件响应，否则 WSGI 服务器用不了 wsgi.file_wrapper（sendfile）
+            response['Server-Timing'] = trace.server_timing()
+            return response
+        if response.streaming:
+            # 流式响应在中间件返回后才真正发送，头里只能带首包前的耗时
+            response['Server-Timing'] = trace.server_timing()
+            response.streaming_content = self._finish_stream(trace, response.streaming_content)
+            return response
+
+        total_ms = trace.elapsed_ms()
+        trace.annotate(response_bytes=len(response.content))
+        response['Server-Timing'] = trace.server_timing(total_ms)
+        _log_if_slow(trace, total_ms)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF 的 Response 在这个钩子之后才 render，用回调统计渲染耗时
+        trace = getattr(request, 'trace', None)
+        if trace is not None:
+            render_started = time.perf_counter()
+
+            def _rendered(rendered_response):
+                trace.add_stage('render', (time.perf_counter() - render_started) * 1000)
+
+            response.add_post_render_callback(_rendered)
+        return response
+
+    @staticmethod
+    def _finish_stream(trace, content):
+        stream_started = time.perf_counter()
+        sent = 0
+        try:
+            for chunk in content:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            trace.add_stage('stream', (time.perf_counter() - stream_started) * 1000)
+            trace.annotate(response_bytes=sent)
+            _log_if_slow(trace, trace.elapsed_ms())
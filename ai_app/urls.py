@@ -15,14 +15,19 @@ from .views import (
     QwenChatFile,
     QwenChatToke,
     QwenOCR,
+    QwenOCRDocument,
     Qwenomni,
     QwenAudio,
     FileUploadView,
+    BulkFileUploadView,
     Qwenvl,
     deeskeep,
 )
 from django.conf import settings
-from django.conf.urls.static import static
+from django.urls import re_path
+from .jobs import job_result
+from .media import serve_media
+import re
 
 urlpatterns = [
     # path('api/', include(router.urls)),
@@ -38,9 +43,14 @@ urlpatterns = [
     path('QwenChatFile/', QwenChatFile.as_view(), name='qwen-chat-file-api'),
     path('QwenChatToke/', QwenChatToke.as_view(), name='qwen-chat-toke-api'),
     path('QwenOCR/', QwenOCR.as_view(), name='qwen-ocr-api'),
+    path('QwenOCR/document/', QwenOCRDocument.as_view(), name='qwen-ocr-document-api'),
     path('Qwenomni/', Qwenomni.as_view(), name='qwen-omni-api'),
     path('QwenAudio/', QwenAudio.as_view(), name='qwen-audio-api'),
     path('upload/', FileUploadView.as_view(), name='file-upload'),
+    path('upload/bulk/', BulkFileUploadView.as_view(), name='file-bulk-upload'),
     path('Qwenvl/', Qwenvl.as_view(), name='qwen-vl-api'),
     path('deeskeep/', deeskeep.as_view(), name='qwen-deeskeep-api'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)  # 添加媒体文件服务
\ No newline at end of file
+    path('jobs/<uuid:job_id>/', job_result, name='async-job'),  # 异步任务结果，?wait=秒数 长轮询
+    # 媒体文件服务：分块流式输出，支持Range/ETag，生产环境可配置 MEDIA_ACCEL_REDIRECT 交给nginx
+    re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serve_media, name='media'),
+]
\ No newline at end of file
@@ -4,11 +4,12 @@ from rest_framework.views import APIView  # 导入DRF的APIView类，用于创
 from rest_framework.response import Response  # 导入DRF的Response对象，用于构建HTTP响应
 from rest_framework import status  # 导入DRF的状态码模块，便于返回标准HTTP状态码
 import requests  # 导入requests库，用于发送HTTP请求
+import httpx
 import json  # 导入json库，用于处理JSON数据
 import base64  # 导入base64库，用于处理Base64编码
 from zhipuai import ZhipuAI  # 导入ZhipuAI库，用于调用智谱AI的API
-from cozepy import Coze, TokenAuth, Message, ChatEventType
-from dashscope import Generation 
+from cozepy import Coze, TokenAuth, Message, ChatEventType, COZE_CN_BASE_URL, SyncHTTPClient
+from dashscope import Generation, Application
 from django.http  import StreamingHttpResponse, JsonResponse 
 from openai import OpenAI
 from pathlib import Path
@@ -17,14 +18,46 @@ import os
 import logging
 from rest_framework.decorators import action
 import traceback
-from constance import config
+from constance import config as constance_config
 import mimetypes
 from rest_framework.parsers import MultiPartParser
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime
+import hashlib
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.core.files.storage import default_storage
+from django.db import transaction
 from ai_app.models import ModelInfo, UploadedFile
+from ai_app.serializers import UploadedFilePagination, UploadedFileSerializer
+from ai_app.tracing import TracedConfig, annotate, trace_stage
+from ai_app.imaging import get_profile as get_image_profile, preprocess_base64, preprocess_image, preprocess_messages
+from ai_app import audio, hedging, keypool, ocr, omni, routing, scheduler
+from ai_app.ratelimit import identity, record_usage
+from ai_app.cancellation import STATUS_DEADLINE, TIMEOUT_ERRORS, StreamUsage, UpstreamStream, request_deadline
+from ai_app.retry import (IdempotencyConflict, call_with_retry, claim, classify_dashscope, idempotency_key, release,
+                          remember)
+from ai_app.log import LazyJson, truncate
+from ai_app.workers import with_request_context
 
 
 logger = logging.getLogger(__name__)
 
+# constance读取计入请求的 config 阶段耗时
+config = TracedConfig(constance_config)
+
+# 上游接口地址，默认是各平台线上地址，压测时在 settings 里指向 stub_upstreams 启动的本地假服务
+GLM_BASE_URL = getattr(settings, 'GLM_BASE_URL', 'https://open.bigmodel.cn/api/paas/v4')
+DASHSCOPE_COMPATIBLE_BASE_URL = getattr(settings, 'DASHSCOPE_COMPATIBLE_BASE_URL',
+                                        'https://dashscope.aliyuncs.com/compatible-mode/v1')
+COZE_BASE_URL = getattr(settings, 'COZE_BASE_URL', COZE_CN_BASE_URL)  # 默认Coze国内站
+if getattr(settings, 'DASHSCOPE_HTTP_BASE_URL', None):
+    # Generation / Application / MultiModalConversation 走 dashscope 原生接口
+    dashscope.base_http_api_url = settings.DASHSCOPE_HTTP_BASE_URL
+
 # ===============后台功能类模块===============
 # # 说明文档页面
 def api_docs(request):
@@ -35,11 +68,74 @@ def api_docs(request):
 class FileUploadView(APIView):
     parser_classes = [MultiPartParser]
 
+    def get(self, request, *args, **kwargs):
+        """
+        文件列表，游标分页，参数：
+        type: 文件类型；uploader: 上传者ID（仅管理员可查看他人）；since / until: 上传时间范围（ISO 8601）
+        min_width / min_height / min_duration / max_duration: 按后台提取的元数据过滤
+        cursor / page_size: 分页，下一页直接请求返回的 next 地址
+        """
+        if not request.user.is_authenticated:
+            return Response({'error': '未登录'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        queryset = UploadedFile.objects.select_related('uploader')
+        uploader = request.query_params.get('uploader')
+        if not request.user.is_staff:
+            queryset = queryset.filter(uploader=request.user)
+        elif uploader:
+            if not uploader.isdigit():
+                return Response({'error': 'uploader 必须是用户ID'}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(uploader_id=int(uploader))
+
+        file_type = request.query_params.get('type')
+        if file_type:
+            if file_type not in dict(UploadedFile.FILE_TYPES):
+                return Response({'error': f'不支持的文件类型: {file_type}'}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(file_type=file_type)
+
+        for param, lookup in (('since', 'upload_time__gte'), ('until', 'upload_time__lt')):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                moment = parse_datetime(value)
+                if moment is None and parse_date(value):
+                    moment = datetime.combine(parse_date(value), datetime.min.time())
+            except ValueError:
+                moment = None
+            if moment is None:
+                return Response({'error': f'{param} 不是有效的时间'}, status=status.HTTP_400_BAD_REQUEST)
+            # 与 settings.USE_TZ 保持一致，否则数据库比较会出错
+            if settings.USE_TZ and timezone.is_naive(moment):
+                moment = timezone.make_aware(moment)
+            elif not settings.USE_TZ and timezone.is_aware(moment):
+                moment = timezone.make_naive(moment)
+            queryset = queryset.filter(**{lookup: moment})
+
+        for param, lookup in (('min_width', 'width__gte'), ('min_height', 'height__gte'),
+                              ('min_duration', 'duration__gte'), ('max_duration', 'duration__lte')):
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                queryset = queryset.filter(**{lookup: float(value)})
+            except ValueError:
+                return Response({'error': f'{param} 必须是数字'}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = UploadedFilePagination()
+        with trace_stage('storage'):
+            page = paginator.paginate_queryset(queryset, request, view=self)
+        with trace_stage('encode'):
+            data = UploadedFileSerializer(page, many=True).data
+        return paginator.get_paginated_response(data)
+
     def post(self, request, *args, **kwargs):
         # 获取上传的文件
-        uploaded_file = request.FILES.get('file')
+        with trace_stage('parse'):
+            uploaded_file = request.FILES.get('file')
         if not uploaded_file:
             return Response({'error': '未提供文件'}, status=status.HTTP_400_BAD_REQUEST)
+        annotate(upload_bytes=uploaded_file.size)
 
         try:
             # 获取用户ID或用户名
@@ -69,7 +165,8 @@ class FileUploadView(APIView):
             uploaded_file_instance.mime_type = mime_type or 'application/octet-stream'
             
             # 保存实例，save方法会自动处理文件类型分类
-            uploaded_file_instance.save()
+            with trace_stage('storage'):
+                uploaded_file_instance.save()
             
             # 返回成功响应
             return Response({
@@ -88,8 +185,139 @@ class FileUploadView(APIView):
 
 
 
+def _store_upload(upload):
+    """批量上传的单个文件：计算 SHA-256 后写入存储，在线程池里执行（hashlib 处理大块数据时会释放GIL）"""
+    file_name = os.path.basename(upload.name)
+    try:
+        digest = hashlib.sha256()
+        for chunk in upload.chunks():
+            digest.update(chunk)
+        upload.seek(0)
+        # 与 UploadedFile.file 的 upload_to 规则相同
+        path = UploadedFile._meta.get_field('file').generate_filename(None, upload.name)
+        stored_name = default_storage.save(path, upload)
+        return {'file_name': file_name, 'path': stored_name, 'file_hash': digest.hexdigest(), 'size': upload.size}
+    except Exception as e:
+        logger.warning('批量上传写入失败 %s', file_name, exc_info=True)
+        return {'file_name': file_name, 'error': str(e)}
+
+
+# 批量上传
+class BulkFileUploadView(APIView):
+    """
+    一次请求上传多个文件（表单字段 files 可重复）
+    文件在线程池里计算哈希并写入存储，全部写完后一次 bulk_create 插入，返回每个文件的结果
+    """
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return Response({'error': '未登录'}, status=status.HTTP_401_UNAUTHORIZED)
+        with trace_stage('parse'):
+            uploads = request.FILES.getlist('files') or request.FILES.getlist('file')
+        if not uploads:
+            return Response({'error': '未提供文件'}, status=status.HTTP_400_BAD_REQUEST)
+        annotate(upload_bytes=sum(upload.size for upload in uploads), upload_files=len(uploads))
+
+        workers = min(getattr(settings, 'BULK_UPLOAD_WORKERS', 4), len(uploads))
+        with trace_stage('storage'), ThreadPoolExecutor(max_workers=workers) as pool:
+            stored = list(pool.map(_store_upload, uploads))
+
+        instances = []
+        for item in stored:
+            if 'error' in item:
+                continue
+            instance = UploadedFile(file=item['path'], file_name=item['file_name'], file_size=item['size'],
+                                    file_hash=item['file_hash'], uploader=request.user)
+            instance.fill_file_fields()
+            item['instance'] = instance
+            instances.append(instance)
+
+        try:
+            with trace_stage('storage'), transaction.atomic():
+                UploadedFile.objects.bulk_create(instances, batch_size=200)
+        except Exception as e:
+            # 插入失败时删掉已经写入存储的文件，避免留下没有记录的孤儿文件
+            logger.error('批量上传插入失败: %s', e, exc_info=True)
+            for instance in instances:
+                default_storage.delete(instance.file.name)
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if instances and instances[0].pk is None:
+            # MySQL 的 bulk_create 不返回主键，按存储路径查回来
+            ids = dict(UploadedFile.objects.filter(file__in=[instance.file.name for instance in instances])
+                       .values_list('file', 'id'))
+            for instance in instances:
+                instance.pk = ids.get(instance.file.name)
+        for instance in instances:
+            instance.schedule_processing()
+
+        results = []
+        for item in stored:
+            if 'error' in item:
+                results.append({'file_name': item['file_name'], 'status': 'error', 'error': item['error']})
+                continue
+            instance = item['instance']
+            results.append({
+                'file_name': instance.file_name,
+                'status': 'created',
+                'id': instance.id,
+                'file_type': instance.file_type,
+                'file_size': instance.file_size,
+                'mime_type': instance.mime_type,
+                'file_hash': instance.file_hash,
+                'file_url': instance.file.url,
+            })
+        return Response({
+            'created': len(instances),
+            'failed': len(stored) - len(instances),
+            'results': results,
+        }, status=status.HTTP_201_CREATED if instances else status.HTTP_400_BAD_REQUEST)
+
+
 # ===============模型接口===============
 # GLM模型
+def _glm_post(url, api_key, headers, data, timeout):
+    """调用一次智谱 HTTP 接口，非2xx抛 HTTPError，由 call_with_retry 按状态码决定是否重试"""
+    response = requests.post(url, headers={**headers, "Authorization": f"Bearer {api_key}"}, json=data, timeout=timeout)
+    response.raise_for_status()
+    return response
+
+
+def _zhipu_client(lease):
+    """密钥池分到的密钥对应的智谱客户端，按密钥缓存；SDK 自带的重试关掉，由 call_with_retry 统一重试"""
+    return lease.client(ZhipuAI, base_url=GLM_BASE_URL, max_retries=0)
+
+
+def _idempotent_call(request, scope, fn):
+    """
+    会产生新任务的调用（生成视频、图片）：fn(幂等键) 调用上游并返回响应数据
+    客户端带 Idempotency-Key 时，同一个键成功过的直接返回保存的结果，还在处理中的返回409，失败的可以用同一个键重试
+    """
+    try:
+        key, from_client = idempotency_key(request)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    # 按调用方区分：登录用户按用户ID，未登录按客户端IP，不同的匿名客户端用了相同的键也不会拿到对方的结果
+    scope = f'{scope}:{identity(request)}'
+    if from_client:
+        try:
+            stored = claim(scope, key)
+        except IdempotencyConflict:
+            return Response({"error": "相同 Idempotency-Key 的请求正在处理中"}, status=status.HTTP_409_CONFLICT)
+        if stored is not None:
+            return Response(stored, status=status.HTTP_200_OK, headers={'Idempotent-Replayed': 'true'})
+    try:
+        result = fn(key)
+    except Exception:
+        if from_client:
+            release(scope, key)
+        raise
+    if from_client:
+        remember(scope, key, result)
+    return Response(result, status=status.HTTP_200_OK)
+
+
 # GLM语言模型chat类型，glm-4
 class GLM4View(APIView):
     def post(self, request):
@@ -97,21 +325,29 @@ class GLM4View(APIView):
         处理POST请求，调用GLM（Generative Language Model）服务并返回结果。
         """
         # 定义GLM服务的URL地址
-        glm_url = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
+        glm_url = f"{GLM_BASE_URL}/chat/completions"
+        # 截止时间从这里算起，剩余时间作为上游超时（请求头 X-Request-Timeout，默认后台配置 API_TIMEOUT）
+        deadline = request_deadline(request)
         
         # 从请求的数据中获取用户的问题，默认为空字符串
-        question = request.data.get('question', '')
+        with trace_stage('parse'):
+            question = request.data.get('question', '')
         
         # 从请求的数据中获取要使用的模型名称
         model_name = request.data.get('model')  # 直接使用传入的模型名称
+        try:
+            # model=auto:chat 时按各模型最近的耗时和出错率挑一个
+            model_name = routing.resolve(request, model_name, 'glm-4-api')
+        except routing.NoCandidate as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        annotate(model=model_name)
         
         # 如果问题为空，则返回错误信息并设置HTTP状态码为400 Bad Request
         if not question:
             return Response({"error": "question is required"}, status=status.HTTP_400_BAD_REQUEST)
         
-        # 构造发送到GLM API的头部信息，包括授权和内容类型
+        # 构造发送到GLM API的头部信息；授权头按密钥池分到的密钥在 _glm_post 里添加
         headers = {
-            "Authorization": f"Bearer {config.GLM_API_KEY}",  # 使用API密钥进行身份验证
             "Content-Type": "application/json",     # 指定请求体的内容类型为JSON
         }
         
@@ -142,15 +378,40 @@ class GLM4View(APIView):
 
         try:
             # 尝试通过requests库发起一个POST请求到GLM API服务器
-            response = requests.post(glm_url, headers=headers, json=data)
-            
-            # 检查API响应的状态码是否在成功范围内（如2xx）。如果不是，则引发HTTPError异常
-            response.raise_for_status()
+            # 限流、连接失败、5xx 按重试策略重试，限流和认证错误换密钥池里的另一个密钥；非2xx最终抛出 HTTPError
+            with routing.measure('glm-4-api', model_name):
+                if hedging.wanted(request):
+                    # 对冲模式：超过平时耗时的90分位还没返回就再发一次，先返回的为准
+                    def attempt_call(attempt, model):
+                        with keypool.acquire('glm') as lease, trace_stage('upstream'):
+                            return call_with_retry(
+                                lambda timeout: attempt.post(glm_url, lease.secret, dict(data, model=model), timeout),
+                                'glm', attempt.deadline, lease=lease)
+
+                    response = hedging.run(('glm-4-api', model_name), attempt_call, deadline, model_name)
+                else:
+                    started = time.monotonic()
+                    with keypool.acquire('glm') as lease, trace_stage('upstream'):
+                        response = call_with_retry(lambda timeout: _glm_post(glm_url, lease.secret, headers, data, timeout),
+                                                   'glm', deadline, lease=lease)
+                    # 平时的耗时也计入对冲阈值
+                    hedging.observe(('glm-4-api', model_name), time.monotonic() - started)
+                annotate(upstream_bytes=len(response.content))
+                result = response.json()
+                # 按上游返回的用量扣限流的 token 预算（也用来算模型的吞吐量）
+                record_usage(result.get('usage'))
             
             # 返回API的成功响应数据，并将HTTP状态码设为200 OK
-            return Response(response.json(), status=status.HTTP_200_OK)
+            return Response(result, status=status.HTTP_200_OK)
         
-        except requests.exceptions.RequestException as e:
+        except TIMEOUT_ERRORS as e:
+            # 超过截止时间上游还没有返回
+            return Response(
+                {"error": f"API request timed out: {str(e)}"}, 
+                status=status.HTTP_504_GATEWAY_TIMEOUT
+            )
+        
+        except (requests.exceptions.RequestException, httpx.HTTPError) as e:
             # 如果发生任何与网络请求相关的错误（例如连接失败、超时等），捕获这些异常并返回详细的错误信息，
             # 同时设置HTTP状态码为503 Service Unavailable表示临时不可用的服务端问题。
             return Response(
@@ -168,18 +429,29 @@ class GLM4View(APIView):
 # GLM语言模型多模态识别glm-4v模型
 class GLM4VView(APIView):
     def post(self, request):
-        glm_url = "https://open.bigmodel.cn/api/paas/v4/chat/completions"
+        glm_url = f"{GLM_BASE_URL}/chat/completions"
+        deadline = request_deadline(request)
         
         # 直接获取完整的messages结构
-        messages = request.data.get('messages', [])
+        with trace_stage('parse'):
+            messages = request.data.get('messages', [])
         model_name = request.data.get('model', 'glm-4v-flash')
+        try:
+            model_name = routing.resolve(request, model_name, 'glm-4v-api')
+        except routing.NoCandidate as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        annotate(model=model_name)
 
         # 基本验证
         if not messages:
             return Response({"error": "messages is required"}, status=status.HTTP_400_BAD_REQUEST)
 
+        # base64 图片按模型的像素上限缩小后再转发，图片URL不处理
+        with trace_stage('preprocess'):
+            before, after = preprocess_messages(messages, get_image_profile(model_name))
+        annotate(upload_bytes=before, upstream_image_bytes=after)
+
         headers = {
-            "Authorization": f"Bearer {config.GLM_API_KEY}",
             "Content-Type": "application/json",
         }
         
@@ -189,10 +461,17 @@ class GLM4VView(APIView):
         }
 
         try:
-            response = requests.post(glm_url, headers=headers, json=data)
-            response.raise_for_status()
-            return Response(response.json(), status=status.HTTP_200_OK)
+            with routing.measure('glm-4v-api', model_name):
+                with keypool.acquire('glm') as lease, trace_stage('upstream'):
+                    response = call_with_retry(lambda timeout: _glm_post(glm_url, lease.secret, headers, data, timeout),
+                                               'glm', deadline, lease=lease)
+                annotate(upstream_bytes=len(response.content))
+                result = response.json()
+                record_usage(result.get('usage'))
+            return Response(result, status=status.HTTP_200_OK)
             
+        except TIMEOUT_ERRORS as e:
+            return Response({"error": str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
         except requests.exceptions.RequestException as e:
             return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except json.JSONDecodeError:
@@ -200,10 +479,13 @@ class GLM4VView(APIView):
 # GLM文生图模型glm-CogView
 class GLMCogView(APIView):
     def post(self, request):
-        cog_url = "https://open.bigmodel.cn/api/paas/v4/images/generations"
+        cog_url = f"{GLM_BASE_URL}/images/generations"
+        deadline = request_deadline(request)
         
         # 获取参数
-        model_name = request.data.get('model', 'cogview-3')
+        with trace_stage('parse'):
+            model_name = request.data.get('model', 'cogview-3')
+        annotate(model=model_name)
         prompt = request.data.get('prompt', '')
         size = request.data.get('size', '1024x1024')  # 默认尺寸
         user_id = request.data.get('user_id', '')  # 可选参数
@@ -213,7 +495,6 @@ class GLMCogView(APIView):
             return Response({"error": "prompt is required"}, status=status.HTTP_400_BAD_REQUEST)
             
         headers = {
-            "Authorization": f"Bearer {config.GLM_API_KEY}",
             "Content-Type": "application/json",
         }
         
@@ -228,11 +509,20 @@ class GLMCogView(APIView):
         if user_id:
             data["user_id"] = user_id
 
+        def generate(key):
+            # 每次生成都计费：只重试上游肯定没处理的错误，幂等键作为 request_id 传给上游
+            payload = {**data, "request_id": key}
+            with keypool.acquire('glm') as lease, trace_stage('upstream'):
+                response = call_with_retry(lambda timeout: _glm_post(cog_url, lease.secret, headers, payload, timeout),
+                                           'glm', deadline, idempotent=False, lease=lease)
+            annotate(upstream_bytes=len(response.content))
+            return response.json()
+
         try:
-            response = requests.post(cog_url, headers=headers, json=data)
-            response.raise_for_status()
-            return Response(response.json(), status=status.HTTP_200_OK)
+            return _idempotent_call(request, 'cogview', generate)
             
+        except TIMEOUT_ERRORS as e:
+            return Response({"error": str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
         except requests.exceptions.RequestException as e:
             return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except json.JSONDecodeError:
@@ -241,17 +531,19 @@ class GLMCogView(APIView):
 class CogVideoXView(APIView):
     def post(self, request):
         """生成视频请求"""
+        deadline = request_deadline(request)
         try:
-            # 初始化智谱AI客户端
-            client = ZhipuAI(api_key=config.GLM_API_KEY)
-            
             if request.data.get('action') == 'check_status':
                 # 查询任务状态
                 task_id = request.data.get('task_id')
                 if not task_id:
                     return Response({"error": "task_id is required"}, status=status.HTTP_400_BAD_REQUEST)
                     
-                response = client.videos.retrieve_videos_result(id=task_id)
+                # 任务属于创建它的账号，用创建时的密钥查询
+                with keypool.acquire('glm', keypool.owner('cogvideox', task_id)) as lease, trace_stage('upstream'):
+                    response = call_with_retry(
+                        lambda timeout: _zhipu_client(lease).videos.retrieve_videos_result(id=task_id, timeout=timeout),
+                        'glm', deadline, lease=lease)
                 
                 # 直接返回视频结果对象的所有属性
                 return Response({
@@ -277,32 +569,42 @@ class CogVideoXView(APIView):
                 # 基本验证
                 if not prompt:
                     return Response({"error": "prompt is required"}, status=status.HTTP_400_BAD_REQUEST)
+                annotate(model=model_name)
                 
-                # 生成视频
-                response = client.videos.generations(
-                    model=model_name,
-                    prompt=prompt,
-                    image_url=image_url,
-                    quality=quality,
-                    with_audio=with_audio,
-                    size=size,
-                    fps=fps
-                )
-                return Response({"task_id": response.id}, status=status.HTTP_200_OK)
+                def generate(key):
+                    # 生成视频会创建新任务：只重试上游肯定没处理的错误，幂等键作为 request_id 传给上游
+                    with keypool.acquire('glm') as lease, trace_stage('upstream'):
+                        response = call_with_retry(lambda timeout: _zhipu_client(lease).videos.generations(
+                            model=model_name,
+                            prompt=prompt,
+                            image_url=image_url,
+                            quality=quality,
+                            with_audio=with_audio,
+                            size=size,
+                            fps=fps,
+                            request_id=key,
+                            timeout=timeout
+                        ), 'glm', deadline, idempotent=False, lease=lease)
+                        keypool.remember_owner('cogvideox', response.id, lease)
+                    return {"task_id": response.id}
+
+                return _idempotent_call(request, 'cogvideox', generate)
             
+        except TIMEOUT_ERRORS as e:
+            return Response({"error": str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 # GLM语音对话模型GLM-4-Voice
 class GLM4Voice(APIView):
     def post(self, request):
         """生成语音请求"""
+        deadline = request_deadline(request)
         try:
-            # 初始化智谱AI客户端
-            client = ZhipuAI(api_key=config.GLM_API_KEY)
-            
             # 获取参数
-            model_name = request.data.get('model', 'glm-4-voice')
+            with trace_stage('parse'):
+                model_name = request.data.get('model', 'glm-4-voice')
             messages = request.data.get('messages', [])
+            annotate(model=model_name)
             do_sample = request.data.get('do_sample', True)
             stream = request.data.get('stream', False)
             temperature = request.data.get('temperature', 0.8)
@@ -335,7 +637,11 @@ class GLM4Voice(APIView):
             if request_id:
                 kwargs["request_id"] = request_id
             
-            response = client.chat.completions.create(**kwargs)
+            with keypool.acquire('glm') as lease, trace_stage('upstream'):
+                response = call_with_retry(
+                    lambda timeout: _zhipu_client(lease).chat.completions.create(**kwargs, timeout=timeout),
+                    'glm', deadline, lease=lease)
+            record_usage(response.usage)
             
             # 构造响应
             result = {
@@ -363,17 +669,33 @@ class GLM4Voice(APIView):
             
             return Response(result, status=status.HTTP_200_OK)
             
+        except TIMEOUT_ERRORS as e:
+            return Response({"error": str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 # COZE对话模型
+# 每个请求单独建 httpx 客户端（超时按截止时间、提前结束时关闭），SSL 上下文共用：每次新建都要加载 CA 证书，约 25ms CPU
+_coze_ssl_context = None
+
+
+def _coze_http_client(timeout):
+    global _coze_ssl_context
+    if _coze_ssl_context is None:
+        _coze_ssl_context = httpx.create_ssl_context()
+    return SyncHTTPClient(timeout=timeout, verify=_coze_ssl_context)
+
+
 class CozeChatView(APIView):
     def post(self, request):
         """生成对话请求"""
+        deadline = request_deadline(request)
         try:
             # 获取参数，api_token和bot_id使用默认配置值，但user_id必须由前端提供
-            coze_api_token = request.data.get('api_token', config.COZE_API_TOKEN)
-            bot_id = request.data.get('bot_id', config.COZE_BOT_ID)
+            with trace_stage('parse'):
+                request_data = request.data
+            request_token = request_data.get('api_token')
+            bot_id = request_data.get('bot_id') or config.COZE_BOT_ID
             user_id = request.data.get('user_id')
             question = request.data.get('question')
             
@@ -383,30 +705,55 @@ class CozeChatView(APIView):
             if not user_id:
                 return Response({"error": "user_id is required"}, status=status.HTTP_400_BAD_REQUEST)
             
-            # 初始化Coze客户端
-            coze = Coze(
-                auth=TokenAuth(token=coze_api_token), 
-                base_url=COZE_BASE_URL
-            )
-            
             content = ""
             token_count = 0
+            usage = StreamUsage('coze-chat-api', f'coze:{bot_id}', request.user.id)
+            http_client = None
+            # 前端没有传令牌时用密钥池里的令牌，限流和认证错误换另一个；拿到后立即进入 try，出错也能归还
+            lease = None if request_token else keypool.acquire('coze')
+            try:
+                # 自己创建 http_client 以便设置超时，提前结束时关闭它断开上游的流
+                http_client = _coze_http_client(deadline.timeout())
+
+                def start_chat(timeout):
+                    coze = Coze(
+                        auth=TokenAuth(token=request_token or lease.secret), 
+                        base_url=COZE_BASE_URL,
+                        http_client=http_client
+                    )
+                    return coze.chat.stream(
+                        bot_id=bot_id,
+                        user_id=user_id,
+                        additional_messages=[
+                            Message.build_user_question_text(question),
+                        ]
+                    )
+
+                # 使用stream方式调用API，超过截止时间停止接收
+                with trace_stage('upstream'):
+                    # 建立流式连接时出错按重试策略重试，开始接收后不再重试
+                    events = call_with_retry(start_chat, 'coze', deadline, lease=lease)
+                    with UpstreamStream(events, usage, deadline) as upstream:
+                        for event in upstream:
+                            # 实时处理消息增量
+                            if event.event == ChatEventType.CONVERSATION_MESSAGE_DELTA:
+                                content += event.message.content
+                                usage.add('text', event.message.content)
+                            
+                            # 完成时获取token用量
+                            if event.event == ChatEventType.CONVERSATION_CHAT_COMPLETED:
+                                token_count = event.chat.usage.token_count
+                                usage.prompt_tokens = event.chat.usage.input_count
+                                usage.completion_tokens = event.chat.usage.output_count
+                                usage.total_tokens = token_count
+            finally:
+                if http_client is not None:
+                    http_client.close()
+                if lease is not None:
+                    lease.release()
             
-            # 使用stream方式调用API
-            for event in coze.chat.stream(
-                bot_id=bot_id,
-                user_id=user_id,
-                additional_messages=[
-                    Message.build_user_question_text(question),
-                ]
-            ):
-                # 实时处理消息增量
-                if event.event == ChatEventType.CONVERSATION_MESSAGE_DELTA:
-                    content += event.message.content
-                
-                # 完成时获取token用量
-                if event.event == ChatEventType.CONVERSATION_CHAT_COMPLETED:
-                    token_count = event.chat.usage.token_count
+            if upstream.status == STATUS_DEADLINE:
+                return Response({"error": "上游响应超时", "content": content}, status=status.HTTP_504_GATEWAY_TIMEOUT)
             
             # 构造响应
             result = {
@@ -416,17 +763,32 @@ class CozeChatView(APIView):
             
             return Response(result, status=status.HTTP_200_OK)
             
+        except TIMEOUT_ERRORS as e:
+            return Response({"error": str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 # Qwen模型
+def _dashscope_client(lease):
+    """密钥池分到的密钥对应的 DashScope 兼容模式客户端，按密钥缓存；重试由 call_with_retry 负责"""
+    return lease.client(OpenAI, base_url=DASHSCOPE_COMPATIBLE_BASE_URL, max_retries=0)
+
+
 # 大语言模型-单轮对话
 class QwenChat(APIView):
     def post(self, request):
+        deadline = request_deadline(request)
         # 获取请求参数
-        content = request.POST.get('content',  '')
+        with trace_stage('parse'):
+            content = request.POST.get('content',  '')
         system_role = request.POST.get('system_role',  '用最温柔的语气回复我的问题')
         model = request.POST.get('model',  'qwen2.5-1.5b-instruct')  # 默认模型，可由前端指定
+        try:
+            # model=auto:chat 时按各模型最近的耗时和出错率挑一个
+            model = routing.resolve(request, model, 'qwen-chat-api')
+        except routing.NoCandidate as e:
+            return Response({'error': str(e)}, status=400)
+        annotate(model=model)
         
         # 构造消息列表
         messages = [
@@ -435,14 +797,37 @@ class QwenChat(APIView):
         ]
         
         try:
+            if hedging.wanted(request):
+                # 对冲模式走兼容模式接口（两次调用都要能中途断开），超过平时耗时的90分位还没返回就再发一次
+                def attempt_call(attempt, model):
+                    with keypool.acquire('dashscope') as lease, trace_stage('upstream'):
+                        return call_with_retry(lambda timeout: attempt.post(
+                            f'{DASHSCOPE_COMPATIBLE_BASE_URL}/chat/completions', lease.secret,
+                            {'model': model, 'messages': messages}, timeout
+                        ), 'dashscope', attempt.deadline, lease=lease).json()
+
+                with routing.measure('qwen-chat-api', model):
+                    result = hedging.run(('qwen-chat-api', model), attempt_call, deadline, model)
+                    record_usage(result.get('usage'))
+                full_content = ''.join(choice['message'].get('content') or '' for choice in result.get('choices', []))
+                return Response({'text': full_content})
+
             # 调用 Generation.call  方法，关闭流式输出
-            response = Generation.call( 
-                api_key=config.QWEN_API_KEY,
-                model=model,  # 使用前端传入的模型 
-                messages=messages,
-                result_format="message",
-                stream=False  # 关闭流式输出
-            )
+            # dashscope 出错时返回带 status_code 的响应，由 classify_dashscope 判断是否重试
+            # 原生接口和对冲用的兼容模式接口耗时不同，不计入对冲阈值
+            with routing.measure('qwen-chat-api', model) as measured:
+                with keypool.acquire('dashscope') as lease, trace_stage('upstream'):
+                    response = call_with_retry(lambda timeout: Generation.call( 
+                        api_key=lease.secret,
+                        model=model,  # 使用前端传入的模型 
+                        messages=messages,
+                        result_format="message",
+                        stream=False,  # 关闭流式输出
+                        request_timeout=timeout
+                    ), 'dashscope', deadline, check=classify_dashscope, lease=lease)
+                record_usage(getattr(response, 'usage', None))
+                # 重试用完仍然限流或5xx时 SDK 不抛异常，照样算模型出错
+                measured.error = classify_dashscope(response) is not None
             
             # 提取完整内容 
             full_content = ""
@@ -454,108 +839,121 @@ class QwenChat(APIView):
             # 返回完整结果
             return Response({'text': full_content})
         
+        except TIMEOUT_ERRORS as e:
+            return Response({'error': str(e)}, status=504)
         except Exception as e:
             # 捕获异常并返回错误信息
             return Response({'error': str(e)}, status=500)
 # 视觉理解：
 class Qwenvl(APIView):
     def post(self, request):
+        deadline = request_deadline(request)
         try:
             # 获取请求数据
-            data = request.data
+            with trace_stage('parse'):
+                data = request.data
             text = data.get('text', '')
             file_data = data.get('file')
             
             if not file_data:
                 return Response({'error': '图片数据必填'}, status=400)
-            
-            client = OpenAI(
-                api_key=config.QWEN_API_KEY,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
+            annotate(model="qwen2-vl-2b-instruct", upload_bytes=len(file_data))
+            with trace_stage('preprocess'):
+                image_url = preprocess_base64(file_data, get_image_profile("qwen2-vl-2b-instruct"))
+            annotate(upstream_image_bytes=len(image_url))
             
             # 记录请求信息
-            logger.info(f"Qwenvl请求: text={text}")
-            
-            completion = client.chat.completions.create(
-                model="qwen2-vl-2b-instruct",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": [{"type": "text", "text": "你是一个专业的心理医生,需要结合用户提供的图片和问题,从心理和情绪的角度给出温暖的回应。"}]
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": f"data:image/jpeg;base64,{file_data}"}
-                            },
-                            {"type": "text", "text": text or "请分析这张图片"}
-                        ]
-                    }
-                ]
-            )
+            logger.info("Qwenvl请求: text=%s", text)
+            
+            with keypool.acquire('dashscope') as lease, trace_stage('upstream'):
+                completion = call_with_retry(lambda timeout: _dashscope_client(lease).chat.completions.create(
+                    model="qwen2-vl-2b-instruct",
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": [{"type": "text", "text": "你是一个专业的心理医生,需要结合用户提供的图片和问题,从心理和情绪的角度给出温暖的回应。"}]
+                        },
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "image_url",
+                                    "image_url": {"url": image_url}
+                                },
+                                {"type": "text", "text": text or "请分析这张图片"}
+                            ]
+                        }
+                    ],
+                    timeout=timeout
+                ), 'dashscope', deadline, lease=lease)
             
             # 记录响应信息
             response_text = completion.choices[0].message.content
-            logger.info(f"Qwenvl响应: {response_text}")
+            record_usage(getattr(completion, 'usage', None))
+            logger.info("Qwenvl响应: %s", response_text)
             
             return Response({'text': response_text})
             
+        except TIMEOUT_ERRORS as e:
+            return Response({'error': str(e)}, status=504)
         except Exception as e:
-            logger.error(f"Qwenvl处理错误: {str(e)}\n{traceback.format_exc()}")
+            logger.error("Qwenvl处理错误: %s", e, exc_info=True)
             return Response({'error': str(e)}, status=500)
 
 # 大语言模型-长文本对话
 class QwenChatFile(APIView):
     def post(self, request):
+        deadline = request_deadline(request)
         try:
             # 获取上传的文件
-            file = request.FILES.get('file')
+            with trace_stage('parse'):
+                file = request.FILES.get('file')
             text = request.POST.get('text', '请分析这个文档')
             
             if not file:
                 return Response({'error': '文件不能为空'}, status=400)
+            annotate(model="qwen-long", upload_bytes=file.size)
                 
             # 记录请求信息
-            logger.info(f"文件处理请求: filename={file.name}, text={text}")
+            logger.info("文件处理请求: filename=%s, text=%s", file.name, text)
             
-            # 创建临时目录
-            temp_dir = Path('temp_files')
-            temp_dir.mkdir(exist_ok=True)
+            # 每个请求单独的临时目录，同名文件并发上传不会互相覆盖；异常退出留下的由 purge_media 清理
+            temp_dir = Path(settings.TEMP_FILES_ROOT) / uuid.uuid4().hex
+            temp_dir.mkdir(parents=True)
             
             # 保存文件
-            file_path = temp_dir / file.name
-            with open(file_path, 'wb+') as destination:
-                for chunk in file.chunks():
-                    destination.write(chunk)
+            file_path = temp_dir / os.path.basename(file.name)
+            with trace_stage('storage'):
+                with open(file_path, 'wb+') as destination:
+                    for chunk in file.chunks():
+                        destination.write(chunk)
             
             try:
-                # 初始化客户端
-                client = OpenAI(
-                    api_key=config.QWEN_API_KEY,
-                    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-                )
-                
-                # 上传文件
-                file_object = client.files.create(
-                    file=file_path,
-                    purpose="file-extract"
-                )
-                
-                # 发送问题
-                completion = client.chat.completions.create(
-                    model="qwen-long",
-                    messages=[
-                        {"role": "system", "content": f"fileid://{file_object.id}"},
-                        {"role": "user", "content": text}
-                    ]
-                )
+                with keypool.acquire('dashscope') as lease:
+                    # 上传文件；重复上传会多出一个文件，只重试上游肯定没处理的错误
+                    with trace_stage('upstream_upload'):
+                        file_object = call_with_retry(lambda timeout: _dashscope_client(lease).files.create(
+                            file=file_path,
+                            purpose="file-extract",
+                            timeout=timeout
+                        ), 'dashscope', deadline, idempotent=False, lease=lease)
+                    
+                    # 文件属于上传它的账号，提问时不再换密钥
+                    lease.pinned = True
+                    with trace_stage('upstream'):
+                        completion = call_with_retry(lambda timeout: _dashscope_client(lease).chat.completions.create(
+                            model="qwen-long",
+                            messages=[
+                                {"role": "system", "content": f"fileid://{file_object.id}"},
+                                {"role": "user", "content": text}
+                            ],
+                            timeout=timeout
+                        ), 'dashscope', deadline, lease=lease)
                 
                 response_text = completion.choices[0].message.content
+                record_usage(getattr(completion, 'usage', None))
                 # 记录响应信息
-                logger.info(f"文件处理响应: {response_text}")
+                logger.info("文件处理响应: %s", response_text)
                 
                 return Response({'text': response_text})
                 
@@ -565,30 +963,42 @@ class QwenChatFile(APIView):
                     file_path.unlink()
                 temp_dir.rmdir()
                 
+        except TIMEOUT_ERRORS as e:
+            return Response({'error': str(e)}, status=504)
         except Exception as e:
-            logger.error(f"文件处理错误: {str(e)}\n{traceback.format_exc()}")
+            logger.error("文件处理错误: %s", e, exc_info=True)
             return Response({'error': str(e)}, status=500)
         
 # 带应用Deeskeep版本
 class deeskeep(APIView):
     def post(self, request):
+        deadline = request_deadline(request)
         # 1. 从request.data获取内容更可靠，因为可以处理不同类型的请求
-        content = request.data.get('content', '')
+        with trace_stage('parse'):
+            content = request.data.get('content', '')
         session_id = request.session.get('session_id')
         has_thoughts = request.data.get('has_thoughts', True)  # 默认返回思考过程
+        # 应用会话属于创建它的账号，已有会话固定用创建时的密钥
+        try:
+            lease = keypool.acquire('dashscope', request.session.get('session_credential') if session_id else None)
+        except TIMEOUT_ERRORS as e:
+            # 排队等上游空位超时
+            return Response({'error': str(e)}, status=504)
 
         try:
             if not session_id:
                 # 2. 添加错误处理
-                if not config.QWEN_API_KEY or not config.QWEN_Deeskeep_ID:
+                if not lease.secret or not config.QWEN_Deeskeep_ID:
                     return Response({'error': 'API配置缺失'}, status=500)
                 
                 # 初始化会话
-                init_response = Application.call(
-                    api_key=config.QWEN_API_KEY,
-                    app_id=config.QWEN_Deeskeep_ID,
-                    prompt=' '
-                )
+                with trace_stage('upstream_session'):
+                    init_response = call_with_retry(lambda timeout: Application.call(
+                        api_key=lease.secret,
+                        app_id=config.QWEN_Deeskeep_ID,
+                        prompt=' ',
+                        request_timeout=timeout
+                    ), 'dashscope', deadline, check=classify_dashscope, lease=lease)
                 
                 # 3. 添加响应验证
                 if not hasattr(init_response, 'output') or not hasattr(init_response.output, 'session_id'):
@@ -596,23 +1006,29 @@ class deeskeep(APIView):
                 
                 session_id = init_response.output.session_id
                 request.session['session_id'] = session_id
+                request.session['session_credential'] = lease.credential.id
+            lease.pinned = True
 
             # 4. 添加输入验证
             if not content.strip():
                 return Response({'error': '输入内容不能为空'}, status=400)
 
             # 调用API，使用用户输入和会话ID，添加has_thoughts参数
-            response = Application.call(
-                api_key=config.QWEN_API_KEY,
-                app_id=config.QWEN_Deeskeep_ID,
-                prompt=content,
-                session_id=session_id,
-                has_thoughts=has_thoughts  # 是否返回思考过程
-            )
+            app_id = config.QWEN_Deeskeep_ID
+            # 带会话的调用会追加一轮对话，只重试上游肯定没处理的错误
+            with trace_stage('upstream'):
+                response = call_with_retry(lambda timeout: Application.call(
+                    api_key=lease.secret,
+                    app_id=app_id,
+                    prompt=content,
+                    session_id=session_id,
+                    has_thoughts=has_thoughts,  # 是否返回思考过程
+                    request_timeout=timeout
+                ), 'dashscope', deadline, idempotent=False, check=classify_dashscope, lease=lease)
             
             # 检查状态码
             if response.status_code != 200:
-                logger.error(f"API请求失败: request_id={response.request_id}, code={response.status_code}, message={response.message}")
+                logger.error("API请求失败: request_id=%s, code=%s, message=%s", response.request_id, response.status_code, response.message)
                 return Response({
                     'error': '模型请求失败',
                     'request_id': response.request_id,
@@ -629,30 +1045,44 @@ class deeskeep(APIView):
             
             return Response(result)
             
+        except TIMEOUT_ERRORS as e:
+            return Response({'error': str(e)}, status=504)
         except Exception as e:
             # 6. 添加日志记录
-            logger.error(f"desskeep错误: {str(e)}", exc_info=True)
+            logger.error("desskeep错误: %s", e, exc_info=True)
             return Response({'error': str(e)}, status=500)
+        finally:
+            lease.release()
 
 # 大语言模型-多轮对话
 class QwenChatToke(APIView):
     def post(self, request):
+        deadline = request_deadline(request)
         # 1. 从request.data获取内容更可靠，因为可以处理不同类型的请求
-        content = request.data.get('content', '')
+        with trace_stage('parse'):
+            content = request.data.get('content', '')
         session_id = request.session.get('session_id')
+        # 应用会话属于创建它的账号，已有会话固定用创建时的密钥
+        try:
+            lease = keypool.acquire('dashscope', request.session.get('session_credential') if session_id else None)
+        except TIMEOUT_ERRORS as e:
+            # 排队等上游空位超时
+            return Response({'error': str(e)}, status=504)
 
         try:
             if not session_id:
                 # 2. 添加错误处理
-                if not config.QWEN_API_KEY or not config.QWEN_APP_ID:
+                if not lease.secret or not config.QWEN_APP_ID:
                     return Response({'error': 'API配置缺失'}, status=500)
                 
                 # 初始化会话
-                init_response = Application.call(
-                    api_key=config.QWEN_API_KEY,
-                    app_id=config.QWEN_APP_ID,
-                    prompt=' '
-                )
+                with trace_stage('upstream_session'):
+                    init_response = call_with_retry(lambda timeout: Application.call(
+                        api_key=lease.secret,
+                        app_id=config.QWEN_APP_ID,
+                        prompt=' ',
+                        request_timeout=timeout
+                    ), 'dashscope', deadline, check=classify_dashscope, lease=lease)
                 
                 # 3. 添加响应验证
                 if not hasattr(init_response, 'output') or not hasattr(init_response.output, 'session_id'):
@@ -660,18 +1090,24 @@ class QwenChatToke(APIView):
                 
                 session_id = init_response.output.session_id
                 request.session['session_id'] = session_id
+                request.session['session_credential'] = lease.credential.id
+            lease.pinned = True
 
             # 4. 添加输入验证
             if not content.strip():
                 return Response({'error': '输入内容不能为空'}, status=400)
 
             # 调用API，使用用户输入和会话ID
-            response = Application.call(
-                api_key=config.QWEN_API_KEY,
-                app_id=config.QWEN_APP_ID,
-                prompt=content,
-                session_id=session_id
-            )
+            app_id = config.QWEN_APP_ID
+            # 带会话的调用会追加一轮对话，只重试上游肯定没处理的错误
+            with trace_stage('upstream'):
+                response = call_with_retry(lambda timeout: Application.call(
+                    api_key=lease.secret,
+                    app_id=app_id,
+                    prompt=content,
+                    session_id=session_id,
+                    request_timeout=timeout
+                ), 'dashscope', deadline, idempotent=False, check=classify_dashscope, lease=lease)
             
             # 5. 添加响应验证
             if not hasattr(response, 'output') or not hasattr(response.output, 'text'):
@@ -679,61 +1115,96 @@ class QwenChatToke(APIView):
                 
             return Response({'text': response.output.text})
             
+        except TIMEOUT_ERRORS as e:
+            return Response({'error': str(e)}, status=504)
         except Exception as e:
             # 6. 添加日志记录
-            logger.error(f"QwenChatToke错误: {str(e)}", exc_info=True)
+            logger.error("QwenChatToke错误: %s", e, exc_info=True)
             return Response({'error': str(e)}, status=500)
+        finally:
+            lease.release()
 # 图像识别OCR
 class QwenOCR(APIView):
     def post(self, request):
+        deadline = request_deadline(request)
         try:
-            client = OpenAI(
-                api_key=config.QWEN_API_KEY,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
-            uploaded_file = request.FILES.get('file')
+            with trace_stage('parse'):
+                uploaded_file = request.FILES.get('file')
             question = request.POST.get('question', '提取所有图中文字')
             if not uploaded_file:
                 return JsonResponse({'error': '未上传文件'}, status=400)
+            annotate(model="qwen-vl-ocr", upload_bytes=uploaded_file.size)
+            profile = get_image_profile("qwen-vl-ocr")
             
-            # 读取并编码文件
-            file_data = base64.b64encode(uploaded_file.read()).decode('utf-8')
-            
-            completion = client.chat.completions.create(
-                model="qwen-vl-ocr",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": f"data:image/jpeg;base64,{file_data}"},
-                                "min_pixels": 28 * 28 * 4,
-                                "max_pixels": 28 * 28 * 1280
-                            },
-                            {"type": "text", "text": question},
-                        ],
-                    }
-                ]
-            )
+            # 按模型的像素上限缩小、重新编码后再转base64
+            with trace_stage('preprocess'):
+                image_data, image_mime = preprocess_image(uploaded_file.read(), profile)
+            annotate(upstream_image_bytes=len(image_data))
+            
+            mime = image_mime or uploaded_file.content_type or 'image/jpeg'
+            with keypool.acquire('dashscope') as lease, trace_stage('upstream'):
+                content = call_with_retry(
+                    lambda timeout: ocr.recognize(_dashscope_client(lease), image_data, mime, question,
+                                                  profile['MAX_PIXELS'], timeout),
+                    'dashscope', deadline, lease=lease)
             
             return JsonResponse({
-                'response': completion.choices[0].message.content
+                'response': content
             })
             
+        except TIMEOUT_ERRORS as e:
+            return JsonResponse({'error': str(e)}, status=504)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+
+
+# 文档OCR：一次上传多张图片（files 可重复），或一张长图（长截图、小票）自动切块，并发识别后按顺序拼接
+class QwenOCRDocument(APIView):
+    def post(self, request):
+        deadline = request_deadline(request)
+        try:
+            with trace_stage('parse'):
+                uploads = request.FILES.getlist('files') or request.FILES.getlist('file')
+            question = request.POST.get('question', '提取所有图中文字')
+            if not uploads:
+                return JsonResponse({'error': '未上传文件'}, status=400)
+            options = ocr.options()
+            if len(uploads) > options['MAX_IMAGES']:
+                return JsonResponse({'error': f"一次最多上传 {options['MAX_IMAGES']} 张图片"}, status=400)
+            annotate(model=ocr.OCR_MODEL, upload_bytes=sum(upload.size for upload in uploads), upload_files=len(uploads))
+            profile = get_image_profile(ocr.OCR_MODEL)
+
+            with trace_stage('preprocess'):
+                pages = ocr.split_images([(upload.read(), upload.content_type) for upload in uploads], profile)
+            tiles = sum(len(page) for page in pages)
+            if tiles > options['MAX_TILES']:
+                return JsonResponse({'error': f"图片切块后共 {tiles} 块，超过上限 {options['MAX_TILES']}"}, status=400)
+            annotate(tiles=tiles, upstream_image_bytes=sum(len(tile) for page in pages for tile, _ in page))
+
+            # 每块单独从密钥池分密钥，多个密钥时并发的块分摊到不同账号
+            with trace_stage('upstream'):
+                texts = ocr.recognize_document(_dashscope_client, pages, question, profile['MAX_PIXELS'], deadline)
+
+            return JsonResponse({
+                'response': '\n\n'.join(texts),
+                'pages': [{'file_name': upload.name, 'tiles': len(page), 'text': text}
+                          for upload, page, text in zip(uploads, pages, texts)],
+                'tiles': tiles,
+            })
+
+        except TIMEOUT_ERRORS as e:
+            return JsonResponse({'error': str(e)}, status=504)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
 # 多模态语音对话
 class Qwenomni(APIView):
     def post(self, request):
+        # 整个流式输出的截止时间，默认 settings.UPSTREAM_DEADLINES['STREAM_SECONDS']
+        deadline = request_deadline(request, stream=True)
         try:
-            client = OpenAI(
-                api_key=config.QWEN_API_KEY,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
-            
             # 获取参数
-            content_type = request.POST.get('type', 'text')  # text/image/audio/video
+            with trace_stage('parse'):
+                content_type = request.POST.get('type', 'text')  # text/image/audio/video
             text = request.POST.get('text', '')
             voice = request.POST.get('voice', config.DEFAULT_VOICE)
             url = request.POST.get('url', '')  # 获取URL参数
@@ -757,7 +1228,8 @@ class Qwenomni(APIView):
                     ]
                 elif content_type == 'audio':
                     user_content = [
-                        {"type": "input_audio", "input_audio": {"data": url, "format": "mp3"}},
+                        {"type": "input_audio", "input_audio": {
+                            "data": url, "format": audio.AUDIO_FORMATS.get(mimetypes.guess_type(url)[0], 'mp3')}},
                         {"type": "text", "text": text}
                     ]
                 elif content_type == 'video':
@@ -769,8 +1241,18 @@ class Qwenomni(APIView):
                 file = request.FILES.get('file')
                 if not file:
                     return JsonResponse({'error': '未上传文件'}, status=400)
+                annotate(upload_bytes=file.size)
                 
-                file_data = base64.b64encode(file.read()).decode('utf-8')
+                if content_type == 'audio':
+                    # PCM WAV 转成 16kHz 单声道并去掉首尾静音，格式按文件头标注
+                    with trace_stage('preprocess'):
+                        normalized = audio.normalize_audio(file.read(), file.name, file.content_type)
+                    annotate(upstream_audio_bytes=len(normalized.data))
+                    with trace_stage('encode'):
+                        audio_url = normalized.data_url()
+                else:
+                    with trace_stage('encode'):
+                        file_data = base64.b64encode(file.read()).decode('utf-8')
                 
                 if content_type == 'image':
                     user_content = [
@@ -781,7 +1263,7 @@ class Qwenomni(APIView):
                 elif content_type == 'audio':
                     user_content = [
                         {"type": "input_audio", 
-                         "input_audio": {"data": f"data:;base64,{file_data}", "format": "mp3"}},
+                         "input_audio": {"data": audio_url, "format": normalized.format}},
                         {"type": "text", "text": text}
                     ]
                 elif content_type == 'video':
@@ -793,143 +1275,218 @@ class Qwenomni(APIView):
             
             # 添加用户消息到历史
             messages.append({"role": "user", "content": user_content})
+            annotate(model="qwen-omni-turbo")
+            
+            # stream_format=binary 时输出分帧二进制流（格式见 ai_app/omni.py），音频帧是解码后的 PCM
+            binary = request.POST.get('stream_format') == 'binary'
+            encode = omni.delta_frame if binary else omni.delta_line
+            
+            usage = StreamUsage('qwen-omni-api', "qwen-omni-turbo", request.user.id)
+            # 生成器在中间件返回后才执行，先记下排队的通道和用户
+            job = scheduler.current()
             
             def stream_generator():
-                completion = client.chat.completions.create(
-                    model="qwen-omni-turbo",
-                    messages=messages,
-                    modalities=["text", "audio"],
-                    audio={"voice": voice, "format": "wav"},
-                    stream=True
-                )
-                
+                if binary:
+                    yield omni.meta_frame()
                 assistant_response = []
-                for chunk in completion:
-                    if hasattr(chunk.choices[0].delta, "audio"):
-                        try:
-                            audio_data = chunk.choices[0].delta.audio['data']
-                            assistant_response.append({"type": "audio", "audio": {"data": audio_data}})
-                            yield f"audio:{audio_data}\n"
-                        except Exception as e:
-                            transcript = chunk.choices[0].delta.audio['transcript']
-                            assistant_response.append({"type": "text", "text": transcript})
-                            yield f"text:{transcript}\n"
-                    elif hasattr(chunk.choices[0].delta, "content"):
-                        content = chunk.choices[0].delta.content
-                        if content:
-                            assistant_response.append({"type": "text", "text": content})
-                            yield f"text:{content}\n"
+                try:
+                    # 密钥在整个流式输出期间占用，输出结束或客户端断开时释放
+                    with scheduler.bind(job), keypool.acquire('dashscope') as lease:
+                        # 建立流式连接时出错按重试策略重试，开始输出后不再重试
+                        completion = call_with_retry(lambda timeout: _dashscope_client(lease).chat.completions.create(
+                            model="qwen-omni-turbo",
+                            messages=messages,
+                            modalities=["text", "audio"],
+                            audio={"voice": voice, "format": "wav"},
+                            stream=True,
+                            stream_options={"include_usage": True},
+                            timeout=timeout
+                        ), 'dashscope', deadline, lease=lease)
+                        # 客户端断开时生成器在 yield 处被关闭，退出 with 时关闭上游连接，上游不再继续生成
+                        with UpstreamStream(completion, usage, deadline) as upstream:
+                            for kind, value in omni.iter_deltas(upstream):
+                                usage.add(kind, value)
+                                if kind == 'audio':
+                                    assistant_response.append({"type": "audio", "audio": {"data": value}})
+                                else:
+                                    assistant_response.append({"type": "text", "text": value})
+                                yield encode(kind, value)
+                except Exception as e:
+                    if not binary:
+                        raise
+                    logger.error('omni 流式输出失败: %s', e, exc_info=True)
+                    yield omni.error_frame(str(e))
+                    return
+                
+                if upstream.status == STATUS_DEADLINE:
+                    # 超时截断的回复不计入历史
+                    logger.warning('omni 流式输出超过截止时间（%s秒），已断开上游', deadline.seconds)
+                    if binary:
+                        yield omni.error_frame('上游响应超时')
+                    return
                 
                 # 添加助手回复到历史
                 messages.append({"role": "assistant", "content": assistant_response})
                 request.session['omni_dialog_history'] = messages
-            
+                if binary:
+                    yield omni.end_frame()
+            
+            if binary:
+                response = StreamingHttpResponse(stream_generator(), content_type=omni.BINARY_CONTENT_TYPE)
+                # 不让 nginx 攒够缓冲区再发，第一帧尽快到达客户端
+                response['X-Accel-Buffering'] = 'no'
+                response['Cache-Control'] = 'no-cache'
+                return response
             return StreamingHttpResponse(stream_generator(), content_type='text/plain; charset=utf-8')
             
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
 
 # Qwen 音频理解
+def _qwen_audio_call(audio_source, deadline):
+    """调用音频理解模型，audio_source 为 data URL；限流、5xx 按重试策略重试，每次按剩余时间设超时，每段单独分密钥"""
+    messages = [
+        {
+            "role": "system",
+            "content": [
+                {
+                    "text": "用最温柔的口气回复我"
+                }
+            ]
+        },
+        {
+            "role": "user",
+            "content": [
+                {"audio": audio_source},
+                {"text": "用最温柔的口气回复我"}
+            ]
+        }
+    ]
+    with keypool.acquire('dashscope') as lease:
+        return call_with_retry(lambda timeout: dashscope.MultiModalConversation.call(
+            api_key=lease.secret,
+            model="qwen-audio-turbo-latest",
+            messages=messages,
+            stream=False,
+            result_format="message",
+            request_timeout=timeout
+        ), 'dashscope', deadline, check=classify_dashscope, lease=lease)
+
+
+def _qwen_audio_text(response):
+    """从音频理解的响应里取出文字，兼容列表、字典和字符串几种格式"""
+    content = response.output.choices[0].message.content
+    if isinstance(content, list):
+        # 合并所有文本内容
+        texts = [item.get('text', '') for item in content if 'text' in item]
+        return '\n'.join(filter(None, texts))
+    if isinstance(content, dict):
+        return content.get('text', '')
+    return str(content)
+
+
 class QwenAudio(APIView):
     def post(self, request):
+        deadline = request_deadline(request)
         try:
-            # 从Constance配置获取API密钥
-            api_key = config.QWEN_API_KEY
-            
-            # 设置DashScope客户端
-            dashscope.api_key = api_key
-            
-            # 获取音频文件
-            file = request.FILES.get('file')
+            # 获取音频文件（API密钥在 _qwen_audio_call 里从密钥池分配）
+            with trace_stage('parse'):
+                file = request.FILES.get('file')
             if not file:
                 logger.warning('未提供音频文件')
                 return JsonResponse({'error': '未提供音频文件'}, status=400)
             
             # 记录文件信息
-            logger.info(f'接收到音频文件: {file.name}, 大小: {file.size} bytes')
-            
-            # 检查文件大小
-            if file.size > 10 * 1024 * 1024:  # 10MB
-                logger.warning(f'文件过大: {file.size} bytes')
-                return JsonResponse({'error': '音频文件不能超过10MB'}, status=400)
+            logger.info('接收到音频文件: %s, 大小: %s bytes', file.name, file.size)
+            annotate(model="qwen-audio-turbo-latest", upload_bytes=file.size)
+            
+            # 检查文件大小：上游限制的是预处理后的大小，原始上传可以更大
+            audio_options = audio.options()
+            if file.size > audio_options['MAX_UPLOAD_BYTES']:
+                logger.warning('文件过大: %s bytes', file.size)
+                return JsonResponse({'error': f"音频文件不能超过{audio_options['MAX_UPLOAD_BYTES'] // (1024 * 1024)}MB"},
+                                    status=400)
+            chunk_seconds = request.POST.get('chunk_seconds')
+            try:
+                chunk_seconds = float(chunk_seconds) if chunk_seconds else None
+            except ValueError:
+                return JsonResponse({'error': 'chunk_seconds 必须是数字'}, status=400)
             
             try:
-                # 读取并编码文件
-                file_data = file.read()
-                base64_audio = base64.b64encode(file_data).decode('utf-8')
-                audio_source = f"data:audio/wav;base64,{base64_audio}"
-                logger.info('音频文件编码成功')
+                # PCM WAV 转成 16kHz 单声道并去掉首尾静音，其他格式纠正 MIME
+                with trace_stage('preprocess'):
+                    normalized = audio.normalize_audio(file.read(), file.name, file.content_type)
+                    # 指定了 chunk_seconds，或预处理后仍超过上游限制的长录音，在静音处切段并发识别
+                    if chunk_seconds:
+                        chunks = audio.chunk_audio(normalized, chunk_seconds)
+                    elif len(normalized.data) > audio_options['MAX_UPSTREAM_BYTES']:
+                        chunks = audio.chunk_audio(normalized, audio_options['CHUNK_SECONDS'])
+                    else:
+                        chunks = [normalized]
+                annotate(upstream_audio_bytes=sum(len(chunk.data) for chunk in chunks), audio_chunks=len(chunks),
+                         audio_seconds=round(normalized.duration, 2) if normalized.duration else None)
+                if any(len(chunk.data) > audio_options['MAX_UPSTREAM_BYTES'] for chunk in chunks):
+                    logger.warning('预处理后文件过大: %s bytes', len(normalized.data))
+                    return JsonResponse({'error': f"音频文件不能超过{audio_options['MAX_UPSTREAM_BYTES'] // (1024 * 1024)}MB"},
+                                        status=400)
                 
-                # 构造消息内容
-                messages = [
-                    {
-                        "role": "system",
-                        "content": [
-                            {
-                                "text": "用最温柔的口气回复我"
-                            }
-                        ]
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"audio": audio_source},
-                            {"text": "用最温柔的口气回复我"}
-                        ]
-                    }
-                ]
+                with trace_stage('encode'):
+                    sources = [chunk.data_url() for chunk in chunks]
+                logger.info('音频文件编码成功: %s -> %s bytes, %s 段', file.size, len(normalized.data), len(chunks))
                 
-                # 调用通义千问音频理解模型
+                # 调用通义千问音频理解模型，多段时并发调用
                 logger.info('开始调用千问API')
-                response = dashscope.MultiModalConversation.call(
-                    model="qwen-audio-turbo-latest",
-                    messages=messages,
-                    stream=False,
-                    result_format="message"
-                )
-                logger.debug(f'完整API响应: {json.dumps(response, default=lambda o: o.__dict__)}')
+                with trace_stage('upstream'):
+                    if len(sources) == 1:
+                        responses = [_qwen_audio_call(sources[0], deadline)]
+                    else:
+                        # 排队的段开始调用时按剩余时间设超时
+                        workers = min(audio_options['CHUNK_WORKERS'], len(sources))
+                        # 线程池里沿用请求的追踪、排队通道和用户
+                        @with_request_context
+                        def call(source):
+                            return _qwen_audio_call(source, deadline)
+
+                        with ThreadPoolExecutor(max_workers=workers) as pool:
+                            responses = list(pool.map(call, sources))
                 
-                # 处理响应
-                if response.status_code == 200:
+                texts = []
+                for response in responses:
+                    logger.debug('完整API响应: %s', LazyJson(response))
+                    if response.status_code != 200:
+                        logger.error('千问API返回错误: %s - %s', response.code, response.message)
+                        return JsonResponse({
+                            'error': '音频处理服务暂时不可用',
+                            'detail': response.message
+                        }, status=503)
                     try:
-                        # 增强响应结构解析
-                        content = response.output.choices[0].message.content
-                        
-                        # 处理不同响应格式
-                        if isinstance(content, list):
-                            # 合并所有文本内容
-                            texts = [item.get('text', '') for item in content if 'text' in item]
-                            combined_text = '\n'.join(filter(None, texts))
-                        elif isinstance(content, dict):
-                            combined_text = content.get('text', '')
-                        else:
-                            combined_text = str(content)
-                        
-                        if combined_text:
-                            logger.info(f'成功获取回复内容: {combined_text[:200]}...')  # 截断长文本
-                            return JsonResponse({'text': combined_text})
-                        
-                        logger.warning('响应内容为空')
-                        return JsonResponse({'error': '未获取到有效回复'}, status=500)
-                        
+                        texts.append(_qwen_audio_text(response))
                     except Exception as e:
-                        logger.error(f'解析响应失败: {str(e)}\n{traceback.format_exc()}')
+                        logger.error('解析响应失败: %s', e, exc_info=True)
                         return JsonResponse({'error': '处理响应时发生错误'}, status=500)
-                else:
-                    logger.error(f'千问API返回错误: {response.code} - {response.message}')
-                    return JsonResponse({
-                        'error': '音频处理服务暂时不可用',
-                        'detail': response.message
-                    }, status=503)
                 
+                combined_text = '\n'.join(filter(None, texts))
+                if combined_text:
+                    logger.info('成功获取回复内容: %s', truncate(combined_text, 200))  # 截断长文本
+                    if len(chunks) > 1:
+                        return JsonResponse({'text': combined_text, 'chunks': texts})
+                    return JsonResponse({'text': combined_text})
+                
+                logger.warning('响应内容为空')
+                return JsonResponse({'error': '未获取到有效回复'}, status=500)
+                
+            except TIMEOUT_ERRORS as e:
+                # requests 的超时也是 IOError，要放在前面
+                logger.warning('千问API超时: %s', e)
+                return JsonResponse({'error': '音频处理超时', 'detail': str(e)}, status=504)
             except IOError as e:
-                logger.error(f'文件处理错误: {str(e)}')
+                logger.error('文件处理错误: %s', e)
                 return JsonResponse({'error': '文件读取失败'}, status=500)
             finally:
                 file.close()  # 确保文件资源释放
                 
         except Exception as e:
-            logger.error(f'系统错误: {str(e)}\n{traceback.format_exc()}')
+            logger.error('系统错误: %s', e, exc_info=True)
             return JsonResponse({'error': '服务器内部错误'}, status=500)
 
     @action(detail=False, methods=['get'])
@@ -946,11 +1503,13 @@ class QwenAudio(APIView):
                 ]
             }]
             
-            response = dashscope.MultiModalConversation.call(
-                model="qwen-audio-turbo-latest",
-                messages=messages,
-                result_format="message"
-            )
+            with keypool.acquire('dashscope') as lease:
+                response = dashscope.MultiModalConversation.call(
+                    api_key=lease.secret,
+                    model="qwen-audio-turbo-latest",
+                    messages=messages,
+                    result_format="message"
+                )
             
             return JsonResponse({
                 'status': 'success',
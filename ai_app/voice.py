@@ -0,0 +1,430 @@
+# ai_app/voice.py
+"""
+WebSocket 实时语音会话（ws://<host>/ws/voice/，在 config/asgi.py 里挂载，需要用 ASGI 服务器运行，如 uvicorn）
+每个登录用户同时只保留一个会话，新连接会顶掉旧连接；对话历史保存在服务端，客户端每轮只发本轮的音频
+上游调用仍是 HTTP（qwen-omni 流式、glm-4-voice 整段返回），但连接和历史不用每轮重建、重传
+
+客户端 -> 服务端
+  文本帧 JSON：
+    {"type": "start", "provider": "qwen-omni" | "glm-4-voice", "voice": "Chelsie", "system": "系统提示",
+     "input_format": "wav" | "mp3" | "pcm16", "sample_rate": 16000, "channels": 1}   开始/重新配置会话，清空历史
+    {"type": "audio_end", "text": "可选的文字说明"}   之前发来的二进制帧拼成一段音频，作为一轮提问
+    {"type": "text", "text": "..."}                    纯文字提问
+    {"type": "cancel"}                                 中断当前回复
+    {"type": "reset"}                                  清空历史
+  二进制帧：本轮音频数据（input_format 指定的格式，可以分多帧发送）
+服务端 -> 客户端
+  文本帧 JSON：ready（含输出音频格式）、text（文字增量）、turn_end、error
+  二进制帧：回复音频；qwen-omni 为 24kHz 单声道 16bit PCM 增量，glm-4-voice 为每轮一段完整的 WAV
+"""
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.http.request import validate_host
+from openai import OpenAI
+from zhipuai import ZhipuAI
+
+from . import audio, keypool, omni, scheduler
+from .cancellation import (STATUS_CANCELLED, STATUS_COMPLETED, STATUS_DEADLINE, STATUS_DISCONNECTED, STATUS_ERROR,
+                           TIMEOUT_ERRORS, CancelToken, Deadline, DeadlineExceeded, StreamUsage, UpstreamStream,
+                           options as deadline_options)
+from .retry import call_with_retry
+
+logger = logging.getLogger(__name__)
+
+PROVIDERS = ('qwen-omni', 'glm-4-voice')
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_REPLACED = 4409
+CLOSE_IDLE = 4408
+
+# 用户标识 -> 当前会话；按进程保存，多进程部署时同一用户连到不同进程不会互相顶掉
+_sessions = {}
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def options():
+    result = {
+        'PATH': '/ws/voice/',
+        'IDLE_TIMEOUT': 300,
+        'MAX_TURNS': 10,
+        'MAX_TURN_BYTES': 20 * 1024 * 1024,
+        'MAX_CONCURRENT_TURNS': 16,
+        'DEFAULT_PROVIDER': 'qwen-omni',
+    }
+    result.update(getattr(settings, 'VOICE_SESSIONS', {}))
+    return result
+
+
+def _get_executor():
+    """上游调用是同步的，放到专用线程池里执行，池大小就是全进程同时进行的回复数上限"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=options()['MAX_CONCURRENT_TURNS'],
+                                           thread_name_prefix='voice')
+        return _executor
+
+
+# =============== 握手 ===============
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+
+
+def origin_allowed(scope):
+    """浏览器跨站发起的 WebSocket 也会带上 Cookie，Origin 必须是本站或 CSRF_TRUSTED_ORIGINS 里的地址"""
+    origin = _headers(scope).get('origin')
+    if not origin:
+        # 非浏览器客户端不带 Origin
+        return True
+    if origin in getattr(settings, 'CSRF_TRUSTED_ORIGINS', []):
+        return True
+    host = urlsplit(origin).netloc
+    allowed = settings.ALLOWED_HOSTS or (['.localhost', '127.0.0.1', '[::1]'] if settings.DEBUG else [])
+    return bool(host) and validate_host(host, allowed)
+
+
+def session_owner(scope):
+    """按 Cookie 里的 Django 会话找到登录用户，返回用户ID，未登录返回None"""
+    from importlib import import_module
+
+    from django.contrib.auth import SESSION_KEY
+
+    cookie = SimpleCookie(_headers(scope).get('cookie', ''))
+    morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+    if morsel is None:
+        return None
+    try:
+        store = import_module(settings.SESSION_ENGINE).SessionStore(session_key=morsel.value)
+        return store.get(SESSION_KEY)
+    finally:
+        connections.close_all()
+
+
+# =============== 上游调用（在线程池里执行） ===============
+def _run_qwen(messages, voice, emit, cancelled, owner):
+    from .views import DASHSCOPE_COMPATIBLE_BASE_URL, config
+
+    deadline = Deadline(deadline_options()['STREAM_SECONDS'])
+    voice = voice or config.DEFAULT_VOICE
+    # 密钥一直占用到流式输出结束
+    with keypool.acquire('dashscope') as lease:
+        completion = call_with_retry(lambda timeout: lease.client(
+            OpenAI, base_url=DASHSCOPE_COMPATIBLE_BASE_URL, max_retries=0
+        ).chat.completions.create(
+            model="qwen-omni-turbo",
+            messages=messages,
+            modalities=["text", "audio"],
+            audio={"voice": voice, "format": "wav"},
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=timeout
+        ), 'dashscope', deadline, lease=lease)
+        usage = StreamUsage('voice-websocket', "qwen-omni-turbo", owner)
+        texts = []
+        # 取消或断开后收到下一块就停止，退出 with 时关闭上游连接并记录已生成的部分
+        with UpstreamStream(completion, usage, deadline, cancelled) as upstream:
+            for kind, value in omni.iter_deltas(upstream):
+                usage.add(kind, value)
+                if kind == 'text':
+                    texts.append(value)
+                emit(kind, value)
+    if upstream.status == STATUS_DEADLINE:
+        raise DeadlineExceeded(f'回复超过 {deadline.seconds:g} 秒，已中断')
+    if upstream.status != STATUS_COMPLETED:
+        return None
+    return {"role": "assistant", "content": [{"type": "text", "text": ''.join(texts)}]}
+
+
+def _run_glm(messages, voice, emit, cancelled, owner):
+    from .views import GLM_BASE_URL, config
+
+    deadline = Deadline(deadline_options()['STREAM_SECONDS'])
+    usage = StreamUsage('voice-websocket', 'glm-4-voice', owner)
+    try:
+        with keypool.acquire('glm') as lease:
+            response = call_with_retry(lambda timeout: lease.client(
+                ZhipuAI, base_url=GLM_BASE_URL, max_retries=0
+            ).chat.completions.create(
+                model='glm-4-voice', messages=messages, do_sample=True, stream=False, timeout=timeout
+            ), 'glm', deadline, lease=lease)
+    except Exception as e:
+        usage.status = STATUS_DEADLINE if isinstance(e, TIMEOUT_ERRORS) else STATUS_ERROR
+        usage.save()
+        raise
+    if getattr(response, 'usage', None):
+        usage.set_tokens(response.usage)
+    message = response.choices[0].message
+    if cancelled.is_set():
+        # 整段返回的接口没法中途停止，用量照记
+        usage.status = cancelled.reason or STATUS_CANCELLED
+        usage.save()
+        return None
+    reply_audio = getattr(message, 'audio', None)
+    data = omni._get(reply_audio, 'data') if reply_audio else None
+    if message.content:
+        usage.add('text', message.content)
+        emit('text', message.content)
+    if data:
+        usage.add('audio', data)
+        emit('audio', data)
+    usage.save()
+    # glm-4-voice 多轮对话里助手的语音回复用音频ID引用
+    audio_id = omni._get(reply_audio, 'id') if reply_audio else None
+    if audio_id:
+        return {"role": "assistant", "audio": {"id": audio_id}}
+    return {"role": "assistant", "content": message.content or ''}
+
+
+_RUNNERS = {'qwen-omni': _run_qwen, 'glm-4-voice': _run_glm}
+
+
+def _run_turn(provider, messages, voice, emit, cancelled, owner):
+    try:
+        # 实时语音排在 interactive 通道
+        with scheduler.bind(scheduler.Job(scheduler.INTERACTIVE, f'user:{owner}')):
+            return _RUNNERS[provider](messages, voice, emit, cancelled, owner)
+    finally:
+        # 线程池里的线程读配置时打开了数据库连接
+        connections.close_all()
+
+
+# =============== 会话 ===============
+class VoiceSession:
+    def __init__(self, owner, send):
+        self.owner = owner
+        self._send = send
+        self.closed = False
+        self.task = None
+        self.cancelled = CancelToken()
+        self.buffer = bytearray()
+        self.configure({})
+
+    def configure(self, data):
+        opts = options()
+        provider = data.get('provider') or opts['DEFAULT_PROVIDER']
+        if provider not in PROVIDERS:
+            raise ValueError(f'不支持的 provider: {provider}')
+        self.provider = provider
+        # 没指定时在上游调用的线程里读取 config.DEFAULT_VOICE（事件循环里不能查库）
+        self.voice = data.get('voice')
+        self.input_format = data.get('input_format', 'wav')
+        self.sample_rate = int(data.get('sample_rate', 16000))
+        self.channels = int(data.get('channels', 1))
+        self.messages = []
+        system = data.get('system')
+        if system:
+            self.messages.append({"role": "system", "content": system if provider == 'glm-4-voice'
+                                  else [{"type": "text", "text": system}]})
+        self.buffer.clear()
+
+    @property
+    def audio_format(self):
+        if self.provider == 'qwen-omni':
+            return omni.AUDIO_META
+        return {'format': 'wav'}
+
+    async def send_json(self, data):
+        await self.send({'type': 'websocket.send', 'text': json.dumps(data, ensure_ascii=False)})
+
+    async def send(self, message):
+        if self.closed:
+            return
+        try:
+            await self._send(message)
+        except (OSError, RuntimeError):
+            # 客户端已断开，不再等下一条消息就停止上游
+            self.closed = True
+            self.cancel(STATUS_DISCONNECTED)
+
+    async def close(self, code=1000):
+        if not self.closed:
+            await self.send({'type': 'websocket.close', 'code': code})
+            self.closed = True
+        self.cancel(STATUS_DISCONNECTED)
+
+    def cancel(self, reason=STATUS_CANCELLED):
+        self.cancelled.cancel(reason)
+
+    # ---------- 客户端消息 ----------
+    async def on_bytes(self, data):
+        if len(self.buffer) + len(data) > options()['MAX_TURN_BYTES']:
+            self.buffer.clear()
+            await self.send_json({'type': 'error', 'error': '本轮音频过大，已丢弃'})
+            return
+        self.buffer.extend(data)
+
+    async def on_text(self, text):
+        try:
+            data = json.loads(text)
+        except ValueError:
+            await self.send_json({'type': 'error', 'error': '消息必须是JSON'})
+            return
+        kind = data.get('type')
+        if kind == 'start':
+            self.cancel()
+            try:
+                self.configure(data)
+            except (ValueError, TypeError) as e:
+                await self.send_json({'type': 'error', 'error': str(e)})
+                return
+            await self.send_json({'type': 'ready', 'provider': self.provider, 'audio': self.audio_format})
+        elif kind == 'reset':
+            self.cancel()
+            self.messages = [message for message in self.messages if message['role'] == 'system']
+            self.buffer.clear()
+        elif kind == 'cancel':
+            self.cancel()
+        elif kind == 'text':
+            await self.start_turn(self.text_content(data.get('text', '')))
+        elif kind == 'audio_end':
+            if not self.buffer:
+                await self.send_json({'type': 'error', 'error': '没有收到音频'})
+                return
+            data_bytes, self.buffer = bytes(self.buffer), bytearray()
+            content = await asyncio.get_running_loop().run_in_executor(
+                _get_executor(), self.audio_content, data_bytes, data.get('text', ''))
+            await self.start_turn(content)
+        else:
+            await self.send_json({'type': 'error', 'error': f'未知消息类型: {kind}'})
+
+    def text_content(self, text):
+        if self.provider == 'glm-4-voice':
+            return text
+        return [{"type": "text", "text": text}]
+
+    def audio_content(self, data, text):
+        """把本轮音频转成上游的消息格式，PCM WAV 先做 16kHz 单声道预处理"""
+        if self.input_format == 'pcm16':
+            data = audio.wrap_pcm16(data, self.sample_rate, self.channels)
+        normalized = audio.normalize_audio(data, f'voice.{self.input_format}')
+        if self.provider == 'glm-4-voice':
+            content = [{"type": "input_audio", "input_audio": {
+                "data": base64.b64encode(normalized.data).decode('utf-8'), "format": normalized.format}}]
+        else:
+            content = [{"type": "input_audio", "input_audio": {
+                "data": normalized.data_url(), "format": normalized.format}}]
+        if text:
+            content.append({"type": "text", "text": text})
+        return content
+
+    # ---------- 一轮回复 ----------
+    async def start_turn(self, content):
+        if self.task is not None and not self.task.done():
+            await self.send_json({'type': 'error', 'error': '上一轮回复还没有结束，可以先发送 cancel'})
+            return
+        question = {"role": "user", "content": content}
+        self.messages.append(question)
+        self.cancelled = CancelToken()
+        self.task = asyncio.ensure_future(self.respond(question, self.cancelled))
+
+    def _discard(self, question):
+        # 中途 start/reset 过的历史里可能已经没有这条提问
+        if question in self.messages:
+            self.messages.remove(question)
+
+    async def respond(self, question, cancelled):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def emit(kind, value):
+            # 在线程池里调用：音频在这里解码一次，事件循环线程只负责发送
+            if kind == 'audio':
+                try:
+                    value = base64.b64decode(value)
+                except (binascii.Error, ValueError):
+                    return
+            loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+
+        future = loop.run_in_executor(_get_executor(), _run_turn, self.provider, list(self.messages),
+                                      self.voice, emit, cancelled, self.owner)
+        future.add_done_callback(lambda _: queue.put_nowait(None))
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            kind, value = item
+            if cancelled.is_set():
+                continue
+            if kind == 'audio':
+                await self.send({'type': 'websocket.send', 'bytes': value})
+            else:
+                await self.send_json({'type': 'text', 'text': value})
+
+        try:
+            reply = future.result()
+        except Exception as e:
+            logger.error('语音会话上游调用失败: %s', e, exc_info=True)
+            self._discard(question)
+            await self.send_json({'type': 'error', 'error': str(e)})
+            return
+        if cancelled.is_set() or reply is None:
+            # 被中断的这一轮不计入历史
+            self._discard(question)
+            await self.send_json({'type': 'turn_end', 'cancelled': True})
+            return
+        if question not in self.messages:
+            return
+        self.messages.insert(self.messages.index(question) + 1, reply)
+        self.trim_history()
+        await self.send_json({'type': 'turn_end'})
+
+    def trim_history(self):
+        """只保留最近 MAX_TURNS 轮（每轮一问一答），系统提示始终保留"""
+        system = [message for message in self.messages if message['role'] == 'system']
+        dialog = [message for message in self.messages if message['role'] != 'system']
+        self.messages = system + dialog[-options()['MAX_TURNS'] * 2:]
+
+
+# =============== ASGI 入口 ===============
+async def voice_websocket(scope, receive, send):
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    if not origin_allowed(scope):
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+    owner = await sync_to_async(session_owner, thread_sensitive=False)(scope)
+    if owner is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+
+    await send({'type': 'websocket.accept'})
+    session = VoiceSession(owner, send)
+    previous = _sessions.get(owner)
+    _sessions[owner] = session
+    if previous is not None:
+        await previous.close(CLOSE_REPLACED)
+    await session.send_json({'type': 'ready', 'provider': session.provider, 'audio': session.audio_format})
+
+    timeout = options()['IDLE_TIMEOUT']
+    try:
+        while not session.closed:
+            try:
+                message = await asyncio.wait_for(receive(), timeout)
+            except asyncio.TimeoutError:
+                await session.close(CLOSE_IDLE)
+                break
+            if message['type'] == 'websocket.disconnect':
+                break
+            if message['type'] != 'websocket.receive':
+                continue
+            if message.get('bytes') is not None:
+                await session.on_bytes(message['bytes'])
+            elif message.get('text') is not None:
+                await session.on_text(message['text'])
+    finally:
+        session.closed = True
+        session.cancel(STATUS_DISCONNECTED)
+        if _sessions.get(owner) is session:
+            del _sessions[owner]
@@ -0,0 +1,88 @@
+# ai_app/workers.py
+"""
+后台线程池：上传后的缩略图这类耗时处理放到这里做，不占用请求线程
+每个池的排队数量有上限，满了直接丢弃并记日志（可以用管理命令补做），避免上传高峰把内存撑爆
+请求里临时开线程池并发调用上游时，用 with_request_context 包装交给线程的函数
+"""
+import contextvars
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL = {'WORKERS': 2, 'MAX_PENDING': 100}
+
+_executors = {}
+_lock = threading.Lock()
+
+
+class BoundedExecutor:
+    """线程池 + 信号量，正在执行和排队的任务总数不超过 workers + max_pending"""
+
+    def __init__(self, name, workers, max_pending):
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'worker-{name}')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            logger.warning('后台任务队列已满，丢弃任务 %s', fn.__name__, extra={'pool': self.name})
+            return None
+        try:
+            return self._executor.submit(self._run, fn, args, kwargs)
+        except RuntimeError:
+            # 进程退出时线程池已关闭
+            self._slots.release()
+            raise
+
+    def _run(self, fn, args, kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            logger.exception('后台任务失败: %s', fn.__name__, extra={'pool': self.name})
+        finally:
+            # 线程里打开的数据库连接不会被请求结束信号关闭，这里自己关
+            connections.close_all()
+            self._slots.release()
+
+
+def with_request_context(fn):
+    """
+    在当前请求的上下文（追踪阶段、排队通道和用户等 contextvars）里运行 fn，结束时关闭线程里打开的数据库连接
+    要在请求线程里调用；返回的函数可以同时在多个线程里执行
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        try:
+            # 同一个 Context 不能同时在多个线程里进入，每次调用用一份副本
+            return context.copy().run(fn, *args, **kwargs)
+        finally:
+            # 线程里打开的数据库连接不会被请求结束信号关闭
+            connections.close_all()
+
+    return run
+
+
+def get_executor(name):
+    """按名字取线程池，第一次使用时才创建（gunicorn --preload 时不会在主进程里起线程）"""
+    executor = _executors.get(name)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(name)
+            if executor is None:
+                options = dict(DEFAULT_POOL)
+                options.update(getattr(settings, 'BACKGROUND_WORKERS', {}).get(name, {}))
+                executor = _executors[name] = BoundedExecutor(name, options['WORKERS'], options['MAX_PENDING'])
+    return executor
+
+
+def run_after_commit(pool, fn, *args, **kwargs):
+    """当前事务提交后再放进后台线程池，避免后台线程读到还没提交的数据"""
+    transaction.on_commit(lambda: get_executor(pool).submit(fn, *args, **kwargs))
@@ -13,4 +13,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# 需要在 Django 初始化之后导入
+from ai_app.voice import options as voice_options, voice_websocket  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """HTTP 交给 Django；/ws/voice/ 的 WebSocket 是实时语音会话（ai_app/voice.py）"""
+    if scope['type'] == 'websocket':
+        if scope['path'] == voice_options()['PATH']:
+            return await voice_websocket(scope, receive, send)
+        await receive()
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+    return await django_application(scope, receive, send)
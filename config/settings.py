@@ -40,11 +40,17 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    'ai_app.tracing.RequestTracingMiddleware',  # 请求分阶段计时（Server-Timing头、慢请求日志）
     'django.middleware.security.SecurityMiddleware',  # 安全中间件
     'django.contrib.sessions.middleware.SessionMiddleware',  # 会话中间件
     'django.middleware.common.CommonMiddleware',  # 通用中间件
     'django.middleware.csrf.CsrfViewMiddleware',  # CSRF保护中间件
     'django.contrib.auth.middleware.AuthenticationMiddleware',  # 认证中间件
+    'ai_app.ratelimit.RateLimitMiddleware',  # 按用户/IP和接口的令牌桶限流（超限返回429）
+    'ai_app.scheduler.SchedulerMiddleware',  # 按接口给上游调用分排队通道（interactive / standard / batch）
+    'ai_app.routing.ModelRoutingMiddleware',  # model=auto:<类型> 时把选中的模型写到响应头 X-Model-Route
+    'ai_app.jobs.AsyncJobMiddleware',  # async=true 的请求存为异步任务，由 run_jobs 的 worker 执行
+    'ai_app.profiling.MemoryProfilingMiddleware',  # 内存分析（MEMORY_PROFILING 未开启时自动跳过）
     'django.contrib.messages.middleware.MessageMiddleware',  # 消息中间件
     'django.middleware.clickjacking.XFrameOptionsMiddleware',  # 防止点击劫持
 ]
@@ -89,6 +95,20 @@ DATABASES = {
     }
 }
 
+# 缓存：default 是进程内缓存，只放后台配置这类各进程可以各自缓存的数据；
+# shared 是多个 gunicorn worker 共用的缓存（幂等键、API密钥冷却等），用数据库表 ai_shared_cache，部署时执行一次 python manage.py createcachetable
+# 有 Redis 时可以把 shared 换成 django.core.cache.backends.redis.RedisCache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'ai_shared_cache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
 # 密码验证
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 AUTH_PASSWORD_VALIDATORS = [
@@ -117,6 +137,200 @@ USE_TZ = False  # 关闭时区支持
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# 媒体文件下载：分块大小、缓存策略
+MEDIA_STREAM_CHUNK_SIZE = 64 * 1024
+MEDIA_CACHE_CONTROL = 'private, max-age=3600'
+# 生产环境把文件传输交给前端代理，Django 只做路由和权限检查：
+# nginx: {'MODE': 'nginx', 'PREFIX': '/protected-media/'}，并配置 location /protected-media/ { internal; alias <MEDIA_ROOT>/; }
+# Apache mod_xsendfile: {'MODE': 'sendfile'}
+MEDIA_ACCEL_REDIRECT = None
+
+# 媒体库缩略图（ai_app/thumbnails.py），上传后在后台线程生成；视频封面需要服务器装 ffmpeg
+THUMBNAILS = {
+    'ENABLED': True,
+    'SIZE': (320, 320),  # 最大宽高，按比例缩放
+    'FORMAT': 'WEBP',  # Pillow 不支持 WebP 时自动改用 JPEG
+    'QUALITY': 80,
+    'VIDEO_FRAME_AT': 1,  # 视频封面截取第几秒
+}
+
+# 后台线程池（ai_app/workers.py），排队满了新任务会被丢弃，可用 python3 manage.py build_thumbnails 补做
+BACKGROUND_WORKERS = {
+    'media': {'WORKERS': 2, 'MAX_PENDING': 200},
+}
+
+# 批量上传（/upload/bulk/）：单次请求最多文件数、计算哈希和写入存储的线程数
+BULK_UPLOAD_MAX_FILES = 500
+BULK_UPLOAD_WORKERS = 4
+DATA_UPLOAD_MAX_NUMBER_FILES = BULK_UPLOAD_MAX_FILES  # Django 默认只允许100个
+
+# 上传文件保留策略（ai_app/retention.py），由 python3 manage.py purge_media 定时执行（建议每天一次的 crontab）
+RETENTION = {
+    # 每种文件类型保留的天数，None 表示永久保留，例如 {'video': 30, 'audio': 90, 'other': 30}
+    'TTL_DAYS': {'image': None, 'audio': None, 'video': None, 'document': None, 'other': None},
+    'BATCH_SIZE': 500,  # 每批删除/对照的数量
+    'ORPHAN_MIN_AGE_HOURS': 24,  # 孤儿文件至少存在这么久才删，避免删掉正在批量上传还没插入记录的文件
+    'TEMP_FILES_TTL_HOURS': 6,  # temp_files 下的临时文件保留时间
+}
+TEMP_FILES_ROOT = os.path.join(BASE_DIR, 'temp_files')
+
+# 视觉/OCR接口上传前的图片预处理默认参数（ai_app/imaging.py），后台“所有接口配置”里按模型填写的优先
+# MAX_PIXELS 与模型自身的像素上限一致，超过的部分模型本来也会缩掉
+# 没超过上限、小于 MIN_BYTES 的图片不重新编码（省下的上传量抵不上编码的CPU）；
+# KEEP_LOSSLESS 为 True 时 PNG 等无损原图不转成有损格式：没超过上限原样上传，超过时缩小后仍编码成 PNG（OCR 用）
+IMAGE_PROFILES = {
+    'default': {'MAX_PIXELS': 28 * 28 * 1280, 'FORMAT': 'JPEG', 'QUALITY': 85, 'MIN_BYTES': 256 * 1024},
+    'qwen-vl-ocr': {'MAX_PIXELS': 28 * 28 * 1280, 'FORMAT': 'JPEG', 'QUALITY': 92, 'KEEP_LOSSLESS': True},
+    'glm-4v-flash': {'MAX_PIXELS': 1920 * 1080, 'FORMAT': 'JPEG', 'QUALITY': 85},
+}
+
+# 文档OCR（/QwenOCR/document/，ai_app/ocr.py）：单次最多图片数和切块数、并发识别的线程数，
+# 高宽比超过 TALL_RATIO 的长图切块，相邻块重叠块高的 TILE_OVERLAP
+OCR_DOCUMENT = {
+    'MAX_IMAGES': 20,
+    'MAX_TILES': 40,
+    'WORKERS': 4,
+    'TALL_RATIO': 2.0,
+    'TILE_OVERLAP': 0.1,
+}
+
+# 语音接口（QwenAudio、Qwenomni）的音频预处理（ai_app/audio.py）：PCM WAV 转成 SAMPLE_RATE 单声道并去掉首尾静音
+# MAX_UPSTREAM_BYTES 是上游对单个音频的限制，QwenAudio 预处理后仍超过时按 CHUNK_SECONDS 切段并发识别
+AUDIO_NORMALIZE = {
+    'SAMPLE_RATE': 16000,
+    'TRIM_SILENCE': True,
+    'SILENCE_DB': -45,
+    'SILENCE_PADDING_MS': 200,
+    'MAX_UPLOAD_BYTES': 100 * 1024 * 1024,
+    'MAX_UPSTREAM_BYTES': 10 * 1024 * 1024,
+    'CHUNK_SECONDS': 300,
+    'CHUNK_WORKERS': 4,
+}
+
+# WebSocket 实时语音会话（config/asgi.py 挂载 ai_app/voice.py，需用 ASGI 服务器运行：uvicorn config.asgi:application）
+# IDLE_TIMEOUT 秒内没有消息断开；历史只保留最近 MAX_TURNS 轮；MAX_CONCURRENT_TURNS 是本进程同时进行的回复数上限
+VOICE_SESSIONS = {
+    'PATH': '/ws/voice/',
+    'IDLE_TIMEOUT': 300,
+    'MAX_TURNS': 10,
+    'MAX_TURN_BYTES': 20 * 1024 * 1024,
+    'MAX_CONCURRENT_TURNS': 16,
+    'DEFAULT_PROVIDER': 'qwen-omni',
+}
+
+# 上游调用的截止时间（ai_app/cancellation.py）：客户端可用请求头 X-Request-Timeout（秒）指定，最多 MAX_SECONDS
+# 不传时非流式接口用后台配置 API_TIMEOUT，流式输出（Qwenomni、语音会话每轮）用 STREAM_SECONDS；超时返回 504
+UPSTREAM_DEADLINES = {
+    'STREAM_SECONDS': 300,
+    'MAX_SECONDS': 600,
+}
+
+# 上游调用的重试策略（ai_app/retry.py）：ATTEMPTS 为各类错误最多调用几次（含第一次），1 表示不重试
+# 两次之间在 0 ~ BASE_DELAY*2^n 秒之间随机等待（不超过 MAX_DELAY），有 Retry-After 时至少等这么久，总时间不超过 API_TIMEOUT
+# PROVIDERS 按服务商（glm / dashscope / coze）覆盖，如 {'coze': {'ATTEMPTS': {'server': 1}}}
+# IDEMPOTENCY_SECONDS：客户端 Idempotency-Key 对应结果的保留时间
+UPSTREAM_RETRY = {
+    'BASE_DELAY': 0.5,
+    'MAX_DELAY': 8,
+    'ATTEMPTS': {'rate_limit': 4, 'connect': 3, 'connection': 2, 'server': 2, 'timeout': 1, 'auth': 1},
+    'PROVIDERS': {},
+    'IDEMPOTENCY_SECONDS': 24 * 3600,
+}
+
+# 上游API密钥池（ai_app/keypool.py）：后台“API密钥”里按服务商配置多个密钥，没配置时用后台配置里的单个密钥
+# STRATEGY：least_in_flight 挑进行中请求最少的，remaining_quota 挑本分钟剩余配额最多的（需填每分钟请求上限）
+# 429 的密钥暂停 RATE_LIMIT_COOLDOWN 秒（有 Retry-After 时取较大值），401/403 暂停 AUTH_COOLDOWN 秒
+# 用量每 FLUSH_SECONDS 秒写一次数据库；冷却状态、每分钟请求数和视频任务所属的密钥存在 CACHES['shared'] 里，各 worker 共用
+API_KEY_POOL = {
+    'STRATEGY': 'least_in_flight',
+    'RATE_LIMIT_COOLDOWN': 20,
+    'AUTH_COOLDOWN': 300,
+    'FLUSH_SECONDS': 10,
+}
+
+# 接口限流（ai_app/ratelimit.py）：按 (登录用户或客户端IP, 接口) 的令牌桶，每 PERIOD 秒的预算
+# REQUESTS 为请求数，TOKENS 为上游返回的 token 用量（None 不限）；DEFAULT 用于所有调用模型的接口，
+# ENDPOINTS 按 URL name 覆盖，设为 None 不限流；部署在反向代理后面时 CLIENT_IP_HEADER 设为 'HTTP_X_FORWARDED_FOR'
+# 预算存在数据库表 ai_rate_limit_bucket 里（条件 UPDATE 原子扣减），多个 worker 进程共用
+RATE_LIMITS = {
+    'ENABLED': True,
+    'PERIOD': 60,
+    'DEFAULT': {'REQUESTS': 60, 'TOKENS': 200000},
+    'ENDPOINTS': {
+        'glm-cog-api': {'REQUESTS': 10},
+        'qwen-chat-file-api': {'REQUESTS': 10},
+        'qwen-ocr-document-api': {'REQUESTS': 10},
+    },
+    'CLIENT_IP_HEADER': None,
+}
+
+# 上游调用排队（ai_app/scheduler.py）：每个服务商本进程最多同时 SLOTS 个调用，满了按通道权重和用户加权公平排队
+# 通道按 URL name 划分（ENDPOINT_LANES，没列出的为 standard），客户端可用请求头 X-Priority 降级；
+# batch 最多占 MAX_SHARE 比例的空位；排队超过 MAX_WAIT 秒的优先，超过 QUEUE_TIMEOUT 秒返回 504
+# 每 STATS_SECONDS 秒把各通道排队时间的 p50 / p95 写进日志；需用 gthread worker 或 ASGI 部署（同步 worker 每进程只有一个线程）
+UPSTREAM_SCHEDULER = {
+    'ENABLED': True,
+    'SLOTS': {'glm': 16, 'dashscope': 16, 'coze': 16},
+    'LANES': {
+        'interactive': {'WEIGHT': 8, 'MAX_WAIT': 2},
+        'standard': {'WEIGHT': 4, 'MAX_WAIT': 10},
+        'batch': {'WEIGHT': 1, 'MAX_WAIT': 30, 'MAX_SHARE': 0.5},
+    },
+    'ENDPOINT_LANES': {
+        'qwen-omni-api': 'interactive',
+        'coze-chat-api': 'interactive',
+        'qwen-chat-file-api': 'batch',
+        'qwen-ocr-document-api': 'batch',
+        'glm-cogvideo-api': 'batch',
+    },
+    'QUEUE_TIMEOUT': 30,
+    'STATS_SECONDS': 60,
+}
+
+# 对冲请求：客户端传 hedge=true（或请求头 X-Hedge: 1）时，上游调用超过最近耗时的 PERCENTILE 分位还没返回就再发一次，先返回的为准
+# MAX_RATE：最近 WINDOW 秒内最多对冲这个比例的调用（另加 BURST 次）；对冲发给后台模型配置的“对冲备用模型”，没设时发给同一个模型
+HEDGING = {
+    'ENABLED': True,
+    'ENDPOINTS': ('glm-4-api', 'qwen-chat-api'),
+    'PERCENTILE': 0.9,
+    'MIN_SAMPLES': 20,
+    'DEFAULT_DELAY': 3.0,
+    'MIN_DELAY': 0.5,
+    'MAX_RATE': 0.1,
+    'BURST': 2,
+    'WINDOW': 60,
+}
+
+# 自动选模型：model=auto:<类型> 时按各模型最近耗时、出错率的指数移动平均（ALPHA 为新样本权重）挑得分最低的
+# 得分 = 平均耗时 × (1 + ERROR_PENALTY × 出错率)；样本不到 MIN_SAMPLES 的先试，EXPLORE 的比例改选最久没有样本的其他模型
+# MAX_COST：默认费用上限（按 ModelInfo.cost 里的第一个数字比较，单位与后台填写的一致），None 为不限，请求可用 max_cost 参数覆盖
+# 候选模型：类型相同、模型标识以接口对应的前缀开头（默认 GLM-4/GLM-4V 为 glm-，QwenChat 为 qwen，可用 ENDPOINT_MODELS 按 URL name 覆盖），或“接口路径”填的是该接口
+MODEL_ROUTING = {
+    'ENABLED': True,
+    'ALPHA': 0.2,
+    'ERROR_PENALTY': 4,
+    'MIN_SAMPLES': 3,
+    'EXPLORE': 0.05,
+    'MAX_COST': None,
+    'STATS_SECONDS': 60,
+}
+
+# 异步任务：async=true 提交的请求存进数据库，由 python manage.py run_jobs 启动的 PROCESSES 个 worker 进程执行
+# ENDPOINTS 为 None 时所有调用上游模型的接口都可以异步；LEASE_SECONDS 内没有续期（worker 退出）的任务由其他 worker 重新执行，最多 MAX_ATTEMPTS 次
+# TIMEOUT：任务默认的截止时间（不超过 UPSTREAM_DEADLINES['MAX_SECONDS']）；LONG_POLL_SECONDS：查询结果时最多等待的秒数；完成的任务保留 RETENTION_SECONDS 秒
+ASYNC_JOBS = {
+    'ENABLED': True,
+    'ENDPOINTS': None,
+    'PROCESSES': 2,
+    'LEASE_SECONDS': 60,
+    'HEARTBEAT_SECONDS': 15,
+    'MAX_ATTEMPTS': 2,
+    'TIMEOUT': 600,
+    'LONG_POLL_SECONDS': 30,
+    'RETENTION_SECONDS': 24 * 3600,
+    'MAX_BODY_BYTES': 50 * 1024 * 1024,
+}
+
 # 确保上传目录存在
 UPLOAD_ROOT = os.path.join(MEDIA_ROOT, 'uploads')
 if not os.path.exists(UPLOAD_ROOT):
@@ -185,13 +399,49 @@ AUTHENTICATION_BACKENDS = [
 WECHAT_SITE_HOST = '填写自己的域名'  # 你的域名
 WECHAT_SITE_HTTPS = False  # 开发环境可以设置为 False
 
+# 上游接口地址，压测时用环境变量指向 python3 manage.py stub_upstreams 启动的本地假服务
+GLM_BASE_URL = os.environ.get('GLM_BASE_URL', 'https://open.bigmodel.cn/api/paas/v4')
+DASHSCOPE_COMPATIBLE_BASE_URL = os.environ.get('DASHSCOPE_COMPATIBLE_BASE_URL', 'https://dashscope.aliyuncs.com/compatible-mode/v1')
+DASHSCOPE_HTTP_BASE_URL = os.environ.get('DASHSCOPE_HTTP_BASE_URL', 'https://dashscope.aliyuncs.com/api/v1')
+COZE_BASE_URL = os.environ.get('COZE_BASE_URL', 'https://api.coze.cn')
+
+# 慢请求阈值（毫秒），超过后把阶段耗时明细写入 ai_app.slow_requests 日志，设为 None 关闭
+SLOW_REQUEST_THRESHOLD_MS = 3000
+
+# 媒体类接口内存分析，开启后按采样率记录 tracemalloc 峰值和分配热点，结果在后台“内存分析”查看
+# 会拖慢被采样的请求，排查问题时再打开
+MEMORY_PROFILING = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.05,  # 采样率，后台用户带请求头 X-Memory-Profile: 1 时必定采样
+}
+
 # 日志配置
+# 请求线程只负责把记录放进队列，JSON格式化和写控制台都在后台线程（ai_app/log.py）
+LOG_MAX_FIELD_LENGTH = 2000  # 单个字段（消息、附加字段）最多保留的字符数
+LOG_INFO_SAMPLE_RATE = 1.0  # 接口INFO日志的采样比例，访问量大时调低，WARNING及以上不受影响
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'ai_app.log.JsonFormatter',
+            'max_length': LOG_MAX_FIELD_LENGTH,
+        },
+    },
+    'filters': {
+        'sample_info': {
+            '()': 'ai_app.log.SamplingFilter',
+            'rate': LOG_INFO_SAMPLE_RATE,
+            'level': 'INFO',
+            'loggers': ['ai_app.views'],
+        },
+    },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
+            '()': 'ai_app.log.BackgroundQueueHandler',
+            'stream': 'ext://sys.stderr',
+            'formatter': 'json',
+            'filters': ['sample_info'],
         },
     },
     'root': {
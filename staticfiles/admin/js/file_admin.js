@@ -51,4 +51,31 @@ function renameFile(fileId) {
             alert('重命名失败');
         });
     }
-} 
\ No newline at end of file
+} 
+
+// 列表页的视频/音频只显示封面或按钮，点击后才创建播放器加载原文件
+document.addEventListener('click', function (event) {
+    const placeholder = event.target.closest('.media-placeholder');
+    if (!placeholder) {
+        return;
+    }
+    event.preventDefault();
+    const player = document.createElement(placeholder.dataset.kind === 'audio' ? 'audio' : 'video');
+    player.controls = true;
+    player.autoplay = true;
+    player.preload = 'metadata';
+    if (player.tagName === 'VIDEO') {
+        player.width = 200;
+        const poster = placeholder.querySelector('img');
+        if (poster) {
+            player.poster = poster.src;
+        }
+    } else {
+        player.style.width = '200px';
+    }
+    const source = document.createElement('source');
+    source.src = placeholder.dataset.src;
+    source.type = placeholder.dataset.type;
+    player.appendChild(source);
+    placeholder.replaceWith(player);
+});